@@ -16,6 +16,8 @@ _CONFIG_DEFAULTS = {
       "general": {
           "poll_interval": 10,
           "averaging_time": 5,
+          "insert_buffer_size": 1,
+          "insert_buffer_max_age": 60,
       },
 
       "calibration" : {
@@ -24,9 +26,29 @@ _CONFIG_DEFAULTS = {
         "coffee_empty_decanter_value" : 100,
       },
 
+      "sensor" : {
+        "median_width" : 3,
+        "hampel_width" : 0,
+        "hampel_sigmas" : 3.0,
+        "trim" : 0.0,
+        "continuous_sampling" : False,
+        "sample_interval" : 0.01,
+      },
+
       "database" : {
+        "backend": "mongodb",
         "dbname": "kahvidb",
+        "sqlite_path": "",
+        "segment_path": "",
+        "retain_raw_days": 0,
+        "retain_minute_days": 0,
+        "retain_hour_days": 0,
+        "retain_day_days": 0,
         "range_query_max_items": 1000,
+        "range_query_downsample": "minmax",
+        "range_cache_size": 0,
+        "range_cache_ttl": 10,
+        "latest_cache_ttl": 5,
       },
 
       "telegram" : {
@@ -36,6 +58,13 @@ _CONFIG_DEFAULTS = {
         "group_trigger_threshold" : 20,
       },
 
+      "webserver" : {
+        "cache_max_age_past" : 86400,
+        "cache_max_age_open" : 10,
+        "max_concurrency" : 8,
+        "metrics" : False,
+      },
+
     }
 
 """
@@ -67,6 +96,24 @@ def get_config_dict(filename = None):
 
   #def __getitem__(self, i): self.configparser.
 
+# if the computed no. of cups exceeds the maximum by this factor, coffee is
+# assumed to be coming (see Sensor.poll).
+COFFEE_COMING_RATIO = 1.2
+
+"""
+Compute the number of cups a given raw sensor value corresponds to, using the
+calibration parameters in the dictionary calibration (e.g. the [calibration]
+section of the configuration). raw_value may also be a numpy array, in which
+case an array is returned.
+This is the formula used by the sensor, and when recomputing the stored data
+after a change of calibration (see db).
+"""
+def compute_nCups(raw_value, calibration):
+  empty_val = float(calibration["coffee_empty_decanter_value"])
+  full_val = float(calibration["coffee_full_value"])
+  max_nCups = float(calibration["max_ncups"])
+  return (raw_value - empty_val) / (full_val - empty_val) * max_nCups
+
 
 if __name__ == "__main__":
   import argparse
@@ -1,5 +1,7 @@
 """
-This module handles inserting to and reading from a mongodb database.
+This module handles inserting to and reading from a database. The database is
+either a mongodb database (default) or an SQLite file, chosen by 'backend' in
+the [database] section of the configuration, see get_database_manager.
 
 For each measurement, we store the raw value of the sensor, a timestamp, the
 number of cups the sensor value corresponds to and possible additional
@@ -14,35 +16,69 @@ calculating them is known.
 A user need not worry about this, as the no. of cups is assumed to be correct
 for each calibration.
 
-Possibly in the future, different collections (~tables, see mongodb docs) may
-be used corresponding to different levels of aggregation. In this case the db
-manager handles aggregation and querying the appropriate database if the query
-is a range.
-
-NOTE: The mongodb database is located in /var/lib/mongodb (default for debian
-(I think)). All db paths are handled automagically by mongodb, so we try not to
-fiddle with those at all.
+Besides the raw data, different collections (~tables, see mongodb docs) are
+used corresponding to different levels of aggregation (see ROLLUP_TIERS). The
+db manager keeps these up to date when inserting and queries the appropriate
+collection if the query is a range. Each rollup document corresponds to one
+time bucket and contains the count, sum, minimum and maximum of the fields in
+ROLLUP_FIELDS, the mean is computed when querying. The rollups can be rebuilt
+from the raw data using the --rollup option.
 """
-import pymongo
 import sys
 import os
+import math
+import itertools
 import syslog
 
 DUMMY_TAG = "dummy"
 
-#TODO: does the connection need to be closd manually w/ mongodb?
 """
-A class to handle database queries.
+Levels of aggregation as (name, bucket width in seconds), from the finest to the
+coarsest. The rollup collection corresponding to each level is called
+'data-<name>'.
+"""
+ROLLUP_TIERS = [
+    ("minute", 60),
+    ("hour", 60 * 60),
+    ("day", 24 * 60 * 60),
+    ]
+
+# the fields that are aggregated in the rollup collections
+ROLLUP_FIELDS = ["nCups", "rawValue"]
+
+# the bucket widths in seconds that are used for aggregating ranges when the
+# width is chosen automatically, see DatabaseManager.select_bucket_width
+BUCKET_WIDTHS = [
+    10, 30,
+    60, 5 * 60, 10 * 60, 30 * 60,
+    60 * 60, 3 * 60 * 60, 6 * 60 * 60, 12 * 60 * 60,
+    24 * 60 * 60, 7 * 24 * 60 * 60, 30 * 24 * 60 * 60,
+    ]
+
+# the number of data points read at once as numpy arrays, when querying columns
+# or recomputing nCups
+COLUMN_CHUNK_SIZE = 100000
+
+"""
+A class to handle database queries. This class contains the parts that don't
+depend on the storage backend, the backends are implemented as subclasses (see
+db/mongodb.py and db/sqlite.py) and an instance of the backend chosen in the
+configuration is created using get_database_manager. The methods that raise
+NotImplementedError here form the interface that a backend must implement.
 """
 class DatabaseManager(object):
 
   def __init__(self, config_dict, dummy = False):
-    #TODO
+
+    self.dummy = dummy
 
     # override query function with dummy function
     # note: this if-else structure is pretty stupid...
     if dummy:
       self.query_range = self.query_dummy_range
+      self.query_buckets = self.query_dummy_buckets
+      self.query_latest = self.query_dummy_latest
+      self.latest_cache = None
       self.query = self.query_dummy
       syslog.syslog(
           syslog.LOG_WARNING,
@@ -53,35 +89,62 @@ class DatabaseManager(object):
 
       db_config = config_dict["database"]
 
-      db_name = db_config["dbname"]
+      self.db_name = db_config["dbname"]
 
-      # test the connection with a client with a timeout of 10ms.
-      try:
-        pymongo.MongoClient("localhost", 27017, serverSelectionTimeoutMS = 10).server_info()
-      except pymongo.errors.ServerSelectionTimeoutError as e:
-        if "Errno 111" in e.args[0]:
-          raise ConnectionRefusedError("Database connection refused. Is mongodb running?") from e
-        else:
-          raise
+      self.range_query_max_items = int(db_config["range_query_max_items"])
+      self.range_query_downsample = db_config["range_query_downsample"]
+
+      # the resolution of the raw data, used for choosing the rollup tier.
+      self.poll_interval = float(config_dict["general"]["poll_interval"])
+
+      # how many days to keep each level of aggregation, 0 means forever.
+      self.retention_days = {
+          "data": float(db_config["retain_raw_days"]),
+          }
+      for name, _ in ROLLUP_TIERS:
+        self.retention_days["data-" + name] = float(db_config["retain_{}_days".format(name)])
+
+      # the range query cache, if enabled.
+      self.range_cache = None
+      cache_size = float(db_config["range_cache_size"])
+      if cache_size > 0:
+        from db.cache import RangeCache
+        self.range_cache = RangeCache(
+            int(cache_size * 1024 * 1024), float(db_config["range_cache_ttl"])
+            )
+
+      # the cache of the latest measurement, if enabled.
+      self.latest_cache = None
+      latest_ttl = float(db_config["latest_cache_ttl"])
+      if latest_ttl > 0:
+        from db.cache import LatestCache
+        self.latest_cache = LatestCache(self._query_latest, self._watch_latest, latest_ttl)
+
+      # the binary segment store, if enabled.
+      self.segments = None
+      if db_config["segment_path"]:
+        from db.segments import SegmentStore
+        self.segments = SegmentStore(db_config["segment_path"])
 
-      self.client = pymongo.MongoClient("localhost", 27017) # hard-coded local db.
-      self.db = self.client[db_name]
-      self.datacollection = self.db["data"]
-      self.data_latest_collection = self.db["data-latest"]
 
-      self.range_query_max_items = int(db_config["range_query_max_items"])
+  ############
+  # INDEXING #
+  ############
 
-      """
-      A collection holding a single entry: the latest calibration parameters
-      in dictionary form. Another collection keeps track of the history of
-      calibration parameters. These are updated only when the calibration
-      values change.
-      """
-      #TODO: this whole thing
-      #TODO: check for changed parameters
-      self.calibration_latest_collection = self.db["calibration-latest"]
-      # this contains a history of calibration dictionaries.
-      self.calibration_history_collection = self.db["calibration-history"]
+  """
+  Create the indexes needed by the range queries, dumping and cleaning. This is
+  done on every startup, so it must do nothing if the indexes already exist.
+  """
+  def ensure_indexes(self):
+    raise NotImplementedError()
+
+  """
+  Explain the queries that are run often or on large collections.
+  Returns a list of tuples (description, list of stages in the winning query
+  plan), where a full scan of a collection is marked with 'COLLSCAN'.
+  """
+  def explain_queries(self):
+    raise NotImplementedError()
 
 
   #############
@@ -89,32 +152,97 @@ class DatabaseManager(object):
   #############
 
   """
-  Insert a data point into the database.
-  Perform simple verification that the given data dictionary contains some
+  Insert a data point or a sequence of data points into the database.
+  Perform simple verification that the given data dictionaries contain some
   required fields.
 
-  Might add support for inserting multiple data points in the future.
+  Multiple data points are written with a single insert_many, and the latest
+  data point is updated only once per call, so inserting in batches saves
+  round-trips to the database.
+
+  If inserting the same data points failed before, retry must be True, so that
+  the data points or their aggregates that were stored before the failure are
+  not stored twice.
   """
-  #TODO: inserting multiple data points?
-  def insert_data(self, data_dict):
+  def insert_data(self, data, retry = False):
+
+    if isinstance(data, dict):
+      datapoints = [data]
+    else:
+      datapoints = list(data)
 
-    if type(data_dict) != dict:
-      raise NotImplementedError("Insert_data can only handle single data point dictionaries as of now.")
+    if not datapoints:
+      return
 
     # simple (and dirty) data validation, raises a KeyError if a required field is missing
     # TODO: is there a better place for defining the required fields??
     required_fields = ["timestamp", "rawValue", "isCoffee"]
-    [data_dict[field] for field in required_fields]
+    for data_dict in datapoints:
+      if type(data_dict) != dict:
+        raise TypeError("Data points must be dictionaries, got {}.".format(type(data_dict)))
+      [data_dict[field] for field in required_fields]
+
+    rollups = [
+        (width, compute_rollup_buckets(datapoints, width))
+        for _, width in ROLLUP_TIERS
+        ]
 
-    # handle multiple datapoints #TODO (this check isn't good if we're using a dict)
-    #if hasattr(timestamp, "__iter__"): 
-    #  #TODO
-    #  pass
+    latest = dict(max(datapoints, key = lambda d: d["timestamp"]))
 
-    # insert a copy as insert_one modifies the dict ...
-    self.datacollection.insert_one(data_dict.copy())
-    data_dict["_id"] = 0
-    self.data_latest_collection.replace_one({u"_id" : 0}, data_dict.copy(), upsert = True)
+    if retry:
+      self._retry_store_datapoints(datapoints, rollups, latest)
+    else:
+      self._store_datapoints(datapoints, rollups, latest)
+
+    if self.latest_cache is not None:
+      self.latest_cache.set(latest)
+
+    if self.range_cache is not None:
+      self.range_cache.invalidate((
+          min(d["timestamp"] for d in datapoints), latest["timestamp"]
+          ))
+
+  """
+  Store the given data points, add the aggregates in rollups to the rollup
+  buckets and replace the latest data point. rollups is a list of tuples
+  (bucket width, dictionary returned by compute_rollup_buckets). The data point
+  dictionaries must not be modified.
+  """
+  def _store_datapoints(self, datapoints, rollups, latest):
+    raise NotImplementedError()
+
+  """
+  Store data points like _store_datapoints, after a previous call with the
+  same data points failed and may have stored some of them. Nothing may be
+  stored twice. This default is for backends whose _store_datapoints is
+  atomic.
+  """
+  def _retry_store_datapoints(self, datapoints, rollups, latest):
+    self._store_datapoints(datapoints, rollups, latest)
+
+  """
+  Recompute the rollups from the raw data within the given tuple (start, end),
+  or within all of the raw data if r is None. This is needed after the raw data
+  has been modified by other means than insert_data, e.g. when creating the
+  rollups for an existing database. The rollups older than the oldest raw data
+  point are kept, as the raw data they were computed from may have been
+  deleted by apply_retention.
+  Returns the number of buckets written.
+  """
+  def rebuild_rollups(self, r = None):
+    if r is None:
+      oldest = self.oldest_timestamp("data")
+      if oldest is None:
+        return 0
+      r = (oldest, math.inf)
+    return self._rebuild_rollups(r)
+
+  """
+  Recompute the rollups from the raw data within the tuple (start, end), where
+  end may be infinite, extended to whole buckets of each rollup.
+  """
+  def _rebuild_rollups(self, r):
+    raise NotImplementedError()
 
   """
   Compare the given calibration_dict to the latest calibration in the database.
@@ -124,60 +252,193 @@ class DatabaseManager(object):
   def update_calibration(self, calibration_dict, timestamp):
     calibration_dict = dict(calibration_dict) # just to be sure.
 
-    calibration_dict_key = "calibrationDict"
-
-    old_calibration_doc = self.calibration_latest_collection.find({"_id": 0}) #["calibrationDict"]
-    assert old_calibration_doc.count() <= 1
-
-    try:
-      old_calibration_dict = old_calibration_doc[0][calibration_dict_key]
-    except IndexError:
-      # There were no records in the latest collection.
-      # A KeyError here indicates something more serious.
-      old_calibration_dict = None
-
+    old_calibration_dict = self._get_latest_calibration()
 
     if not old_calibration_dict == calibration_dict:
       syslog.syslog(syslog.LOG_INFO, "db: Calibration changed. Saving new calibration in database.")
       #syslog.syslog(syslog.LOG_DEBUG,
       #    "db: (old calibration: {}, new calibration: {})".format(old_calibration_dict, calibration_dict))
 
-      self.calibration_latest_collection.replace_one(
-        {"_id": 0},  # this ensures that calibrationParams will only have one value.
-        {"_id": 0, calibration_dict_key: calibration_dict},
-        upsert = True
-      )
-      self.calibration_history_collection.insert_one({"timestamp" : timestamp, calibration_dict_key: calibration_dict})
+      self._store_calibration(calibration_dict, timestamp)
     else:
       syslog.syslog(syslog.LOG_INFO, "db: Calibration parameters not changed.")
 
+  """
+  Return the calibration history as a list of tuples (timestamp, calibration
+  dictionary) in ascending time order.
+  """
+  def calibration_history(self):
+    raise NotImplementedError()
+
+  """
+  Return the latest calibration dictionary, or None if there is none.
+  """
+  def _get_latest_calibration(self):
+    raise NotImplementedError()
+
+  """
+  Replace the latest calibration and add it to the calibration history.
+  """
+  def _store_calibration(self, calibration_dict, timestamp):
+    raise NotImplementedError()
+
 
   ############
   # QUERYING #
   ############
 
   """
-  Query the latest measurement.
-  This assumes that data_latest_collection contains always only one record.
+  Query the latest measurement. Returns None if it's not available.
+  If latest_cache_ttl is set, this is read from memory, see LatestCache.
   """
   def query_latest(self):
+    if self.latest_cache is None:
+      return self._query_latest()
+    return self.latest_cache.get()
+
+  def _query_latest(self):
+    raise NotImplementedError()
+
+  """
+  Start watching for changes of the latest measurement. Returns an iterator
+  yielding the new latest measurement every time it changes, which blocks while
+  waiting, or None if the backend can't do this. Raises NotImplementedError if
+  the database doesn't support watching, and other exceptions if watching fails
+  e.g. due to a lost connection.
+  """
+  def _watch_latest(self):
+    return None
+
+  """
+  Choose the level of aggregation to query for the given range: the coarsest
+  one that still has at least self.range_query_max_items points in the range,
+  or the raw data if even it has fewer. The result is then downsampled to about
+  range_query_max_items points (see query_range), so that e.g. a 17 hour range
+  is shown with minute aggregates instead of 17 hourly points. If the range
+  starts before the data of that level may have been deleted according to the
+  retention times (see apply_retention), the next coarser level that is still
+  kept there is chosen instead.
+  Returns the bucket width of the rollup, or None for the raw data.
+  """
+  def select_tier(self, r):
+    import time
+
+    (start, end) = r
+    span = end - start
+
+    # the levels from the finest to the coarsest
+    tiers = [("data", None)] + [("data-" + name, width) for name, width in ROLLUP_TIERS]
+
+    i = 0
+    for j in reversed(range(1, len(tiers))):
+      if span / tiers[j][1] >= self.range_query_max_items:
+        i = j
+        break
+
+    now = time.time()
+    for name, width in tiers[i:]:
+      days = self.retention_days[name]
+      if days <= 0 or start >= now - days * 24 * 60 * 60:
+        return width
+
+    # everything in the range has expired
+    return tiers[i][1]
+
+  """
+  Choose a bucket width for aggregating the range r with query_buckets, such
+  that there are at most self.range_query_max_items buckets. The width is the
+  smallest one in BUCKET_WIDTHS that is at least the poll interval, or a
+  multiple of the largest one for very long ranges.
+  """
+  def select_bucket_width(self, r):
+    (start, end) = r
+    span = end - start
+
+    for width in BUCKET_WIDTHS:
+      if width >= self.poll_interval and count_buckets(r, width) <= self.range_query_max_items:
+        return width
+
+    largest = BUCKET_WIDTHS[-1]
+    width = largest * max(math.ceil(span / self.range_query_max_items / largest), 1)
+    # the range may touch one more bucket than fits within its span
+    while count_buckets(r, width) > self.range_query_max_items:
+      width += largest
+    return width
+
+  """
+  Aggregate the values of field within the tuple (start, end) in buckets of
+  width seconds, starting from the bucket containing start. If width is None,
+  it's chosen with select_bucket_width. The aggregation is done by the
+  database, from the coarsest rollup whose buckets fit evenly into the
+  requested ones, or from the raw data.
+  Returns an iterable of dictionaries in ascending time order, containing the
+  'timestamp' (the start of the bucket), the 'count' of data points and the
+  mean of the field. If agg is 'minmax', also the minimum and maximum, e.g.
+  'nCupsMin' and 'nCupsMax', are included.
+  Raises a DBException if there would be more than range_query_max_items
+  buckets.
+  """
+  def query_buckets(self, r, width = None, agg = "mean", field = "nCups"):
     try:
-      #TODO: adjust timeout...
-      return self.data_latest_collection.find_one()
-    except pymongo.errors.ServerSelectionTimeoutError:
-      return None
+      (start, end) = r
+      start, end = float(start), float(end)
+
+      if width is None:
+        width = self.select_bucket_width((start, end))
+      width = float(width)
+
+      assert width > 0, "Bucket width must be positive, got {}".format(width)
+      assert agg in ["mean", "minmax"], "Invalid aggregation: {}".format(agg)
+      assert field in ROLLUP_FIELDS, "Can't aggregate field {}".format(field)
+
+      n_buckets = count_buckets((start, end), width)
+      assert n_buckets <= self.range_query_max_items, \
+          "Too many buckets ({:.0f}, the maximum is {})".format(n_buckets, self.range_query_max_items)
+
+    except (ValueError, TypeError, AssertionError) as e:
+      raise DBException("Invalid bucket query: {}.".format(e))
+
+    # the coarsest rollup whose buckets fit evenly into the requested ones
+    source_width = None
+    for _, tier_width in ROLLUP_TIERS:
+      if width % tier_width == 0:
+        source_width = tier_width
+
+    return self._query_buckets(width, source_width, (start, end), agg == "minmax", field)
+
+  """
+  Group the raw data (if source_width is None) or the rollup with the given
+  width by buckets of width seconds overlapping the range r, see
+  query_buckets. The minimum and maximum are computed only if minmax is True.
+  """
+  def _query_buckets(self, width, source_width, r, minmax, field):
+    raise NotImplementedError()
 
   """
   Query all datapoints within the given tuple (start, end), inclusive, where
   start and end are floats representing unix time.
-  Returs a pymongo cursor object which can then be iterated over.
+  For long ranges, the items are queried from a rollup collection (see
+  select_tier). In this case each item corresponds to a bucket, whose
+  'timestamp' is the start of the bucket, 'nCups' and 'rawValue' are the mean
+  values and in addition the fields 'count', 'nCupsMin', 'nCupsMax',
+  'rawValueMin' and 'rawValueMax' are present.
+
   Returns a maximum of self.range_query_max_items items, which is set in the
-  configuration.
-  If the item limit is exceeded, returns the latest items instead of every nth
-    item...
+  configuration. How the items are chosen if there are more of them in the
+  range depends on downsample, which defaults to range_query_downsample in the
+  configuration:
+    "truncate": return the earliest items as an iterable (for MongoDB, a
+      pymongo cursor).
+    "minmax": return the minimum and maximum of downsample_field for equally
+      wide time buckets, see downsample_minmax.
+    "lttb": return the points chosen by the largest-triangle-three-buckets
+      algorithm, see downsample_lttb.
+  If the range contains at most range_query_max_items items, they are
+  returned unchanged as a list. Otherwise the downsampling modes stream the
+  query result once and return a generator.
   """
-  #TODO: if count is more than max_items, return every nth item, where n = count // MAX_ITEMS (or sth)
-  def query_range(self, r, projection = {}):
+  def query_range(self, r, projection = {}, downsample = None,
+                  downsample_field = "nCups"):
     try:
       (start, end) = r
 
@@ -187,20 +448,47 @@ class DatabaseManager(object):
           (type(end) == float or type(end) == int)
           ), "Start or end wasn't float or int: {}".format(r)
 
-      
-      #TODO: aggregate collections
-
-      proj = {"_id": False}
-      proj.update(projection)
-
-      query_result = (
-          self
-          .datacollection
-          .find({"timestamp": {"$gte": start, "$lte": end}}, projection = proj)
-          .sort("timestamp", pymongo.ASCENDING)
-          # don't return more than this many items
-          .limit(self.range_query_max_items)
-          )
+      if downsample is None:
+        downsample = self.range_query_downsample
+
+      downsample_functions = {
+          "minmax": downsample_minmax,
+          "lttb": downsample_lttb,
+          }
+      assert downsample == "truncate" or downsample in downsample_functions, \
+          "Invalid downsampling mode: {}".format(downsample)
+
+      # when downsampling, the whole range is needed.
+      limit = self.range_query_max_items if downsample == "truncate" else 0
+
+      width = self.select_tier(r)
+
+      projection = dict(projection)
+      if limit == 0 and any(v and k != "_id" for k, v in projection.items()):
+        # make sure that the downsampling field and timestamp are included
+        projection[downsample_field] = True
+        projection["timestamp"] = True
+        if width is not None:
+          projection[downsample_field + "Min"] = True
+          projection[downsample_field + "Max"] = True
+
+      if self.range_cache is not None:
+        query_result = self._query_range_cached(width, r, projection, limit)
+      elif width is not None:
+        query_result = self._query_rollup_range(width, r, projection, limit)
+      else:
+        query_result = self._query_raw_range(r, projection, limit)
+
+      if limit == 0:
+        query_result = iter(query_result)
+        head = list(itertools.islice(query_result, self.range_query_max_items + 1))
+        if len(head) <= self.range_query_max_items:
+          # everything fits, don't drop any points
+          return head
+
+        return downsample_functions[downsample](
+            itertools.chain(head, query_result), r, self.range_query_max_items, downsample_field
+            )
 
       return query_result
 
@@ -208,25 +496,451 @@ class DatabaseManager(object):
       #TODO: do this properly...
       raise DBException("Invalid database range: {}.".format(e))
 
+  """
+  Iterate over all raw data points within the tuple (start, end), inclusive,
+  in ascending time order, without limiting or downsampling and applying the
+  (mongodb-style) projection. The data points are read from the database in
+  batches as the iteration proceeds, so this can be used for exporting long
+  ranges with constant memory use.
+  """
+  def iter_range(self, r, projection = {}):
+    try:
+      (start, end) = r
+      return self._query_raw_range((float(start), float(end)), projection)
+    except (ValueError, TypeError) as e:
+      raise DBException("Invalid database range: {}.".format(e))
+
+  """
+  Query the raw data (if width is None) or the rollup of the given width using
+  the range cache. The range is extended to whole buckets (or minutes for the
+  raw data), so that the following queries of roughly the same range, e.g. the
+  last 24 hours, use the same cache entry. Returns a list.
+  """
+  def _query_range_cached(self, width, r, projection, limit):
+    import bisect
+
+    (start, end) = r
+
+    if any(v and k != "_id" for k, v in projection.items()):
+      # the cached items are sliced by their timestamp
+      projection = dict(projection, timestamp = True)
+
+    unit = width if width is not None else ROLLUP_TIERS[0][1]
+    window = (start - start % unit, end - end % unit + unit)
+    key = (width, window, tuple(sorted(projection.items())))
+
+    entry = self.range_cache.get(key)
+    if entry is None:
+      if width is not None:
+        items = list(self._query_rollup_range(width, window, projection))
+        # the last bucket contains data until the end of the bucket
+        reach = (window[0], window[1] + width)
+      else:
+        items = list(self._query_raw_range(window, projection))
+        reach = window
+
+      # data is inserted in time order, so older data doesn't change.
+      latest = self.query_latest()
+      immutable = latest is not None and reach[1] < latest["timestamp"]
+
+      entry = self.range_cache.put(key, items, reach, immutable)
+
+    if width is not None:
+      # include the bucket containing the start of the range
+      start -= start % width
+    i = bisect.bisect_left(entry.timestamps, start)
+    j = bisect.bisect_right(entry.timestamps, end)
+    if limit:
+      j = min(j, i + limit)
+
+    return entry.items[i:j]
+
+  """
+  Query the raw data points within the range r in ascending time order,
+  excluding _id and applying the (mongodb-style) projection. Returns an
+  iterable with at most limit items (0 means no limit).
+  """
+  def _query_raw_range(self, r, projection = {}, limit = 0):
+    raise NotImplementedError()
+
+  """
+  Query the rollup buckets of the given width overlapping the range r in
+  ascending time order, computing the mean values from the sums. Only
+  inclusive projections are applied to the resulting documents. Returns an
+  iterable with at most limit items (0 means no limit).
+  """
+  def _query_rollup_range(self, width, r, projection = {}, limit = 0):
+    raise NotImplementedError()
+
+  """
+  Query the given fields of the raw data points within the tuple (start, end),
+  inclusive, in ascending time order. Returns a dictionary field name:
+  contiguous numpy float array, with NaN for missing values. Only the needed
+  fields are fetched, in large batches and in a single pass, so this is much
+  faster than query_range for plotting and analysis, e.g.
+    c = dbm.query_range_columns(r, ["timestamp", "nCups"])
+    plt.plot(c["timestamp"], c["nCups"])
+  No downsampling is done, so the range should be limited accordingly.
+  """
+  def query_range_columns(self, r, fields = ["timestamp", "nCups"], chunk_size = COLUMN_CHUNK_SIZE):
+    import numpy as np
+
+    try:
+      (start, end) = r
+      # the chunks are half-open ranges, include the end
+      end = np.nextafter(float(end), float("inf"))
+
+      chunks = [c for _, c in self._iter_column_chunks((start, end), fields, chunk_size)]
+
+    except (ValueError, TypeError) as e:
+      raise DBException("Invalid database range: {}.".format(e))
+
+    if len(chunks) == 1:
+      return chunks[0]
+
+    return {
+        f: np.concatenate([c[f] for c in chunks]) if chunks else np.empty(0)
+        for f in fields
+        }
+
+  """
+  Read the data points within the given tuple (start, end), inclusive, from the
+  binary segment store as a list of dictionaries with the numpy arrays
+  'timestamp', 'nCups' and 'rawValue', one dictionary per day, or as a single
+  dictionary if concatenate is True. For short ranges, the arrays are views of
+  memory mapped files, so no data is copied. See db/segments.py.
+  """
+  def query_range_segments(self, r, concatenate = False):
+    if self.segments is None:
+      raise DBException("The segment store is not enabled (set segment_path in the configuration).")
+
+    return self.segments.read_range(r, concatenate = concatenate)
+
   def query_dummy_range(self, r):
     import random
     max_num_points = 100
     lo, hi = r
-    num_points = min(max(hi - lo, 0), max_num_points)
+    num_points = int(min(max(hi - lo, 0), max_num_points))
     y = random.sample(range(1024), num_points)
     x = [int(lo + 1.0 * x * (hi - lo) / num_points) for x in range(num_points)]
     return zip(x, y)
 
+  def query_dummy_buckets(self, r, width = None, agg = "mean", field = "nCups"):
+    buckets = []
+    for t, y in self.query_dummy_range(r):
+      b = {"timestamp": t, "count": 1, field: y / 100}
+      if agg == "minmax":
+        b[field + "Min"] = b[field + "Max"] = b[field]
+      buckets.append(b)
+    return buckets
+
+  def query_dummy_latest(self):
+    import random, time
+    nCups = random.uniform(0, 10)
+    return {"timestamp": time.time(), "nCups": nCups, "isCoffee": nCups > 0}
+
   def query_dummy(self):
     import random
     return random.randint(0, 1024)
 
+
+  ###############
+  # RECOMPUTING #
+  ###############
+
+  """
+  Recompute nCups (and isCoffee and coffeeComing, which depend on it) of the
+  stored data points from their rawValue, using the same formula as the sensor
+  (config.compute_nCups). By default, each data point is recomputed with the
+  calibration that was active when it was measured according to the
+  calibration history; data older than the first calibration uses the first
+  one. If calibration is given, it is used for all data instead.
+  Only the data within the tuple r is recomputed, if given.
+
+  The data is read in chunks of chunk_size points as numpy arrays, computed
+  with vectorized operations and written back with one bulk update per chunk.
+  The rollups and the segment store are updated afterwards.
+  Returns the number of updated data points.
+  """
+  def recompute_nCups(self, calibration = None, r = None, chunk_size = COLUMN_CHUNK_SIZE):
+    import numpy as np
+    import config
+
+    inf = float("inf")
+
+    if calibration is None:
+      history = self.calibration_history()
+      spans = []
+      for i, (t, cal) in enumerate(history):
+        span_start = -inf if i == 0 else t
+        span_end = history[i + 1][0] if i + 1 < len(history) else inf
+        spans.append(((span_start, span_end), cal))
+    else:
+      spans = [((-inf, inf), calibration)]
+
+    if r is not None:
+      # NOTE: r is inclusive, the spans are not.
+      spans = [
+          ((max(s, r[0]), min(e, np.nextafter(r[1], inf))), cal)
+          for (s, e), cal in spans
+          if s <= r[1] and e > r[0]
+          ]
+
+    def compute(raw_values, cal):
+      nCups = config.compute_nCups(raw_values, cal)
+      max_nCups = float(cal["max_ncups"])
+      # as in Sensor.poll
+      coffeeComing = nCups / max_nCups > config.COFFEE_COMING_RATIO
+      nCups = np.clip(nCups, 0., max_nCups)
+      return nCups, nCups > 0., coffeeComing
+
+    n_updated = 0
+    # the range of the recomputed data points
+    first = last = None
+
+    for span, cal in spans:
+      for keys, columns in self._iter_column_chunks(span, ["timestamp", "rawValue"], chunk_size):
+        nCups, isCoffee, coffeeComing = compute(columns["rawValue"], cal)
+        self._update_columns(keys, {
+          "nCups": nCups,
+          "isCoffee": isCoffee,
+          "coffeeComing": coffeeComing,
+          })
+        n_updated += len(keys)
+
+        t = columns["timestamp"]
+        first = t[0] if first is None else min(first, t[0])
+        last = t[-1] if last is None else max(last, t[-1])
+
+      if self.segments is not None:
+        self.segments.update_range(
+            span, "nCups", lambda records: compute(records["rawValue"], cal)[0]
+            )
+
+    if first is not None:
+      self.rebuild_rollups((float(first), float(last)))
+    if self.range_cache is not None:
+      self.range_cache.clear()
+
+    syslog.syslog(syslog.LOG_INFO,
+        "db: Recomputed nCups for {} data points using {} calibration(s).".format(n_updated, len(spans)))
+
+    return n_updated
+
+  """
+  Iterate over the data points with start <= timestamp < end, where (start,
+  end) = r, in ascending time order and in chunks of at most chunk_size
+  points. Yields tuples (keys, columns), where keys is a list identifying the
+  data points for _update_columns and columns is a dictionary field name: numpy
+  float array. Missing values are NaN.
+  """
+  def _iter_column_chunks(self, r, fields, chunk_size):
+    raise NotImplementedError()
+
+  """
+  Set the fields of the data points identified by keys (as yielded by
+  _iter_column_chunks) to the values in the dictionary columns, field name:
+  numpy array, with a single bulk update.
+  """
+  def _update_columns(self, keys, columns):
+    raise NotImplementedError()
+
+
+  #############
+  # RETENTION #
+  #############
+
+  """
+  True if any of the collections has a limited retention time.
+  """
+  @property
+  def retention_enabled(self):
+    return any(days > 0 for days in self.retention_days.values())
+
+  """
+  Delete data that is older than the retention time of its collection, as
+  configured with the retain_*_days options. Before raw data points are
+  deleted, the rollups covering them are rebuilt, so that the aggregates stay
+  correct even if they were incomplete. The deletion proceeds one day at a
+  time, from the oldest data on, with a single bulk delete per day and
+  collection, so an interrupted run leaves no gaps.
+  Returns a dictionary collection name: number of deleted records.
+  """
+  def apply_retention(self, now = None):
+    import time
+
+    if now is None:
+      now = time.time()
+
+    day = ROLLUP_TIERS[-1][1]
+    deleted = {}
+
+    for name, days in self.retention_days.items():
+      if days <= 0:
+        continue
+
+      # delete whole days only, so that the rollups of the remaining raw data
+      # can still be rebuilt.
+      cutoff = now - days * 24 * 60 * 60
+      cutoff -= cutoff % day
+
+      oldest = self.oldest_timestamp(name)
+      if oldest is None or oldest >= cutoff:
+        continue
+
+      n_deleted = 0
+      chunk_start = oldest - oldest % day
+      while chunk_start < cutoff:
+        chunk_end = chunk_start + day
+
+        if name == "data":
+          self.rebuild_rollups((chunk_start, chunk_end - 1))
+
+        n_deleted += self.delete_range(name, (chunk_start, chunk_end))
+        chunk_start = chunk_end
+
+      if self.range_cache is not None:
+        self.range_cache.clear()
+
+      syslog.syslog(syslog.LOG_INFO,
+          "db: Retention: deleted {} records older than {} days from {}.".format(n_deleted, days, name))
+      deleted[name] = n_deleted
+
+    return deleted
+
+  """
+  Return the timestamp of the oldest record in the given collection, or None
+  if it's empty.
+  """
+  def oldest_timestamp(self, name):
+    raise NotImplementedError()
+
+  """
+  Delete the records with start <= timestamp < end, where (start, end) = r,
+  from the given collection with a single bulk delete. Returns the number of
+  deleted records.
+  """
+  def delete_range(self, name, r):
+    raise NotImplementedError()
+
+
+  ########################
+  # DUMPING AND CLEANING #
+  ########################
+
+  """
+  Return the names of the collections (or tables) in the database.
+  """
+  def collection_names(self):
+    raise NotImplementedError()
+
+  """
+  Return a string identifying the backend and the database, e.g. for keeping
+  track of which database a dump was made from.
+  """
+  def database_id(self):
+    raise NotImplementedError()
+
+  """
+  Iterate over the records in the given collection as JSON-serializable
+  dictionaries. If count is given, return only the count latest records by
+  timestamp. If since is given, return only records with a timestamp later
+  than since. batch_size is the number of records fetched at a time, if the
+  backend supports it.
+  """
+  def iter_collection(self, name, count = None, since = None, batch_size = None):
+    raise NotImplementedError()
+
+  """
+  Insert records in the format produced by iter_collection into the given
+  collection, e.g. when restoring a dump. Records whose _id already exists are
+  skipped, except for records with a non-generated _id (rollup buckets and the
+  '-latest' records), which replace the existing ones. Records without an _id
+  (e.g. from a dump of another backend) are skipped if a record with the same
+  timestamp exists.
+  Returns the number of inserted records.
+  """
+  def insert_records(self, name, records):
+    raise NotImplementedError()
+
+  """
+  Drop the indexes created by ensure_indexes, e.g. before loading lots of data.
+  """
+  def drop_indexes(self):
+    raise NotImplementedError()
+
+  """
+  Delete the given collection and all records in it.
+  """
+  def drop_collection(self, name):
+    raise NotImplementedError()
+
+  """
+  Return the number of data points marked as dummy.
+  """
+  def count_dummy(self):
+    raise NotImplementedError()
+
+  """
+  Delete all data points marked as dummy and recompute the rollups of the
+  time span they covered, as the rollups are only updated when inserting.
+  Returns the number of deleted data points.
+  """
+  def delete_dummy(self):
+    r = self.dummy_range()
+    if r is None:
+      return 0
+
+    n_deleted = self._delete_dummy()
+    self.rebuild_rollups(r)
+
+    if self.range_cache is not None:
+      self.range_cache.invalidate(r)
+
+    return n_deleted
+
+  """
+  Return a tuple (timestamp of the first, timestamp of the last) data point
+  marked as dummy, or None if there are none.
+  """
+  def dummy_range(self):
+    raise NotImplementedError()
+
+  """
+  Delete the data points marked as dummy from the raw data only. Returns the
+  number of deleted data points.
+  """
+  def _delete_dummy(self):
+    raise NotImplementedError()
+
 # necessary?
 class DBException(Exception):
   #TODO
   pass
 
 
+"""
+Create a database manager using the backend specified in the configuration.
+The backend modules are imported only when needed, so e.g. pymongo doesn't
+have to be installed when using SQLite.
+"""
+def get_database_manager(config_dict, dummy = False):
+  if dummy:
+    return DatabaseManager(config_dict, dummy = True)
+
+  backend = config_dict["database"]["backend"].lower()
+
+  if backend == "mongodb":
+    from db.mongodb import MongoDatabaseManager
+    return MongoDatabaseManager(config_dict)
+
+  elif backend == "sqlite":
+    from db.sqlite import SQLiteDatabaseManager
+    return SQLiteDatabaseManager(config_dict)
+
+  raise ValueError("Unknown database backend: {}".format(backend))
+
+
 """
 Return a suitable folder name for dumping database contents by using a
 timestamp. Don't create the folder, that must be done elsewhere.
@@ -248,26 +962,177 @@ def get_default_dump_path():
 
   return folderName
 
+# file name extensions of the dump files for each compression method
+DUMP_EXTENSIONS = {
+    "none": ".json",
+    "gzip": ".json.gz",
+    "zstd": ".json.zst",
+    }
+
+# the number of records fetched from the database at a time when dumping
+DUMP_BATCH_SIZE = 10000
+
+"""
+The file where the latest exported timestamp of each collection is stored, used
+for incremental dumps. It's kept in the folder containing the dump folder
+dump_path, so that the incremental dumps into each output folder continue from
+the previous dump into the same folder.
+"""
+def get_high_water_mark_path(dump_path):
+  return os.path.join(os.path.dirname(os.path.abspath(dump_path)), "high-water-mark.json")
+
+"""
+Load the high-water marks of the database with the given id (see
+DatabaseManager.database_id) from the file path. Returns a dictionary
+collection name: latest exported timestamp.
+"""
+def load_high_water_marks(path, database_id):
+  import json
+
+  if not os.path.exists(path):
+    return {}
+
+  with open(path) as f:
+    marks = json.load(f)
+
+  # earlier versions stored the marks of a single, unknown database
+  if any(not isinstance(v, dict) for v in marks.values()):
+    print("Ignoring the high-water marks in {} as they don't tell which database they belong to.".format(path))
+    return {}
+
+  return marks.get(database_id, {})
+
 """
-Dump database contents using mongoexport and drop collections if specified.
+Store the high-water marks of the database with the given id in the file path,
+keeping the ones of other databases.
 """
-def dump_database(dump_path, config_dict, count = None, purge = False):
+def save_high_water_marks(path, database_id, high_water_marks):
   import json
 
-  dbm = DatabaseManager(config_dict)
-  db = dbm.db
+  marks = {}
+  if os.path.exists(path):
+    with open(path) as f:
+      marks = json.load(f)
+    marks = {k: v for k, v in marks.items() if isinstance(v, dict)}
+
+  marks[database_id] = high_water_marks
+
+  if not os.path.exists(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  with open(path, "w") as f:
+    json.dump(marks, f)
+
+"""
+Open a dump file for reading or writing text, choosing the compression based on
+the file name extension (see DUMP_EXTENSIONS). zstd requires the 'zstandard'
+package.
+"""
+def open_dump_file(fname, mode = "r"):
+  import io
+
+  if fname.endswith(".gz"):
+    import gzip
+    # level 6 is considerably faster than the default 9 and almost as small.
+    return gzip.open(fname, mode + "t", compresslevel = 6, encoding = "utf-8")
+
+  if fname.endswith(".zst"):
+    try:
+      import zstandard
+    except ImportError as e:
+      raise RuntimeError("zstd compression requires the 'zstandard' package.") from e
+
+    if mode == "w":
+      stream = zstandard.ZstdCompressor().stream_writer(open(fname, "wb"))
+    else:
+      stream = zstandard.ZstdDecompressor().stream_reader(open(fname, "rb"))
+    return io.TextIOWrapper(stream, encoding = "utf-8")
+
+  return open(fname, mode, encoding = "utf-8")
+
+"""
+Ask the user the given yes/no question, unless assume_yes is True. Returns
+True if the answer was yes, and False if there's no one to answer (e.g. no
+terminal).
+"""
+def _confirm(question, assume_yes = False):
+  if assume_yes:
+    return True
+  try:
+    ans = input(question + " (y/n) ").lower()
+  except EOFError:
+    print()
+    return False
+  return ans in ["y", "yes"]
+
+"""
+Export a single collection to the file fname. Returns a tuple (number of
+exported records, latest exported timestamp or None).
+"""
+def _export_collection(dbm, collName, fname, count, since):
+  import json
+
+  # reuse a single encoder instead of creating one for every record
+  encode = json.JSONEncoder().encode
+
+  n_exported = 0
+  latest = None
+
+  with open_dump_file(fname, "w") as f:
+    lines = []
+    for record in dbm.iter_collection(collName, count, since = since, batch_size = DUMP_BATCH_SIZE):
+      lines.append(encode(record))
+      n_exported += 1
+
+      t = record.get("timestamp")
+      if t is not None and (latest is None or t > latest):
+        latest = t
+
+      if len(lines) >= DUMP_BATCH_SIZE:
+        f.write("\n".join(lines) + "\n")
+        lines = []
 
-  # filter out system collections
-  collectionNames = list(filter(
-      lambda x: not x.startswith("system."),
-      db.collection_names()
-      ))
+    if lines:
+      f.write("\n".join(lines) + "\n")
+
+  return (n_exported, latest)
+
+"""
+Dump database contents in JSON format, one file per collection, and drop
+collections if specified. The collections are exported in parallel, one thread
+per collection, and compressed with gzip or zstd if specified.
+
+If since is given, only records with a timestamp later than since are exported
+(the single-record '-latest' collections are always exported completely). If
+since is "last", each collection is exported starting from the latest
+timestamp of the previous dump of the same database into the same folder (see
+get_high_water_mark_path), so that the dumps can be run e.g. hourly.
+
+If assume_yes is True, don't ask before overwriting files or purging.
+"""
+def dump_database(dump_path, config_dict, count = None, purge = False,
+                  compression = "none", since = None, assume_yes = False):
+  from concurrent.futures import ThreadPoolExecutor
+
+  if purge and since is not None:
+    print("Error: an incremental dump can't be used for purging. Aborting.")
+    sys.exit(1)
+
+  dbm = get_database_manager(config_dict)
+
+  collectionNames = dbm.collection_names()
 
   # doing this check here prevents from creating folders if it's not necessary.
   if not collectionNames:
-    print("Database {} appears to be empty. Exiting.".format(db.name))
+    print("Database {} appears to be empty. Exiting.".format(dbm.db_name))
     sys.exit(0)
 
+  high_water_mark_path = get_high_water_mark_path(dump_path)
+  high_water_marks = load_high_water_marks(high_water_mark_path, dbm.database_id())
+
+  if since == "last" and not high_water_marks:
+    print("No previous dump of {} found in {}, dumping everything.".format(
+      dbm.database_id(), high_water_mark_path))
+
   if not os.path.exists(dump_path):
     # TODO: create folder as necessary
     os.makedirs(dump_path)
@@ -278,20 +1143,14 @@ def dump_database(dump_path, config_dict, count = None, purge = False):
       print("Error: {} is not a directory. Aborting.".format(dump_path))
       sys.exit(1)
 
-    ans = input(
-        "WARNING: the folder {} already exists. Do you want to overwrite its contents? (y/n) ".format(dump_path)
-        ).lower()
-
-    if not ans in ["y", "yes"]:
+    if not _confirm(
+        "WARNING: the folder {} already exists. Do you want to overwrite its contents?".format(dump_path),
+        assume_yes):
       print("Aborting.")
       sys.exit(1)
 
   if purge:
-    ans = input(
-        "Are you sure you want to erase ALL data from the database? (y/n) "
-        ).lower()
-
-    if not ans in ["y", "yes"]:
+    if not _confirm("Are you sure you want to erase ALL data from the database?", assume_yes):
       print("Aborting.")
       sys.exit(1)
 
@@ -300,52 +1159,398 @@ def dump_database(dump_path, config_dict, count = None, purge = False):
 
   print("Dumping database content to {}.".format(os.getcwd()))
 
-  for collName in collectionNames:
+  with ThreadPoolExecutor(max_workers = len(collectionNames)) as executor:
+    futures = []
+
+    for collName in collectionNames:
 
-    fname = collName + ".json"
+      fname = collName + DUMP_EXTENSIONS[compression]
 
-    n_exported = 0
+      collSince = since
+      if collName.endswith("-latest"):
+        collSince = None
+      elif since == "last":
+        collSince = high_water_marks.get(collName)
+
+      if collSince is not None and collName in ["data-" + name for name, _ in ROLLUP_TIERS]:
+        # the latest bucket may have been updated after it was dumped, so
+        # include it again (the bucket starts are whole seconds).
+        collSince -= 1
 
-    with open(fname, "w") as f:
       print("Exporting collection {} to {}".format(collName, fname))
-      cursor = db[collName].find()
-      if count is not None:
-        cursor = cursor.sort("timestamp", pymongo.DESCENDING).limit(count)
+      futures.append((collName, executor.submit(_export_collection, dbm, collName, fname, count, collSince)))
+
+    for collName, future in futures:
+      n_exported, latest = future.result()
+      print("Exported {} records from {}.".format(n_exported, collName))
 
-      for record in cursor:
-        record["_id"] = {"$oid" : str(record["_id"])}
-        f.write(json.dumps(record) + "\n")
-        n_exported += 1
+      if latest is not None and count is None:
+        high_water_marks[collName] = max(latest, high_water_marks.get(collName, latest))
 
-    print("Exported {} records.".format(n_exported))
+  # a dump with a count doesn't contain everything before the latest record.
+  if count is None:
+    save_high_water_marks(high_water_mark_path, dbm.database_id(), high_water_marks)
 
-    if purge:
+  if purge:
+    for collName in collectionNames:
       print("Dropping collection {}.".format(collName))
-      db.drop_collection(collName)
+      dbm.drop_collection(collName)
+
+
+# the number of records inserted at a time when restoring
+RESTORE_BATCH_SIZE = 10000
+
+"""
+Load a single dump file into the given collection. Returns the number of
+inserted records.
+"""
+def _restore_collection(dbm, collName, fname):
+  import json
+
+  decode = json.JSONDecoder().decode
+
+  n_inserted = 0
+
+  with open_dump_file(fname, "r") as f:
+    batch = []
+    for line in f:
+      if not line.strip():
+        continue
+      batch.append(decode(line))
+      if len(batch) >= RESTORE_BATCH_SIZE:
+        n_inserted += dbm.insert_records(collName, batch)
+        batch = []
+
+    if batch:
+      n_inserted += dbm.insert_records(collName, batch)
+
+  return n_inserted
+
+"""
+Restore a dump created with dump_database from the folder dump_path. Each
+collection is loaded in its own thread, in large batches. When restoring into
+an empty database, the indexes are dropped before loading and rebuilt
+afterwards, which is much faster than updating them for every batch. Records
+that already exist are not duplicated, so restoring a dump twice or restoring
+overlapping dumps is safe.
+
+If assume_yes is True, don't ask before adding records to non-empty
+collections.
+"""
+def restore_database(dump_path, config_dict, assume_yes = False):
+  import time
+  from concurrent.futures import ThreadPoolExecutor
+
+  if not os.path.isdir(dump_path):
+    print("Error: {} is not a directory. Aborting.".format(dump_path))
+    sys.exit(1)
+
+  # (collection name, file name) pairs
+  files = []
+  for fname in sorted(os.listdir(dump_path)):
+    for ext in DUMP_EXTENSIONS.values():
+      if fname.endswith(ext):
+        files.append((fname[:-len(ext)], os.path.join(dump_path, fname)))
+        break
+
+  if not files:
+    print("No dump files found in {}. Exiting.".format(dump_path))
+    sys.exit(0)
+
+  dbm = get_database_manager(config_dict)
+
+  # the SQLite backend creates all of its tables when opened, so look for
+  # records instead of collections.
+  existing = set(dbm.collection_names()) & {collName for collName, _ in files}
+  nonempty = [
+      collName for collName in sorted(existing)
+      if any(True for _ in dbm.iter_collection(collName, count = 1))
+      ]
+  if nonempty:
+    if not _confirm(
+        "WARNING: the collections {} in database {} already contain records. Records will be added to them. Continue?"
+        .format(", ".join(nonempty), dbm.db_name),
+        assume_yes):
+      print("Aborting.")
+      sys.exit(1)
+
+  print("Restoring database content from {}.".format(dump_path))
+
+  # the indexes are needed for merging the records into the existing ones
+  if not nonempty:
+    dbm.drop_indexes()
+
+  start = time.time()
+  n_total = 0
+
+  with ThreadPoolExecutor(max_workers = len(files)) as executor:
+    futures = []
+
+    for collName, fname in files:
+      print("Importing collection {} from {}".format(collName, fname))
+      futures.append((collName, executor.submit(_restore_collection, dbm, collName, fname)))
+
+    for collName, future in futures:
+      n_inserted = future.result()
+      n_total += n_inserted
+      elapsed = time.time() - start
+      print("Imported {} records to {} ({:.0f} records/s).".format(
+        n_inserted, collName, n_inserted / max(elapsed, 1e-6)))
+
+  print("Rebuilding indexes.")
+  dbm.ensure_indexes()
+
+  elapsed = time.time() - start
+  print("Imported {} records in {:.1f} s ({:.0f} records/s).".format(
+    n_total, elapsed, n_total / max(elapsed, 1e-6)))
 
 
 """
-Remove all entries from the database that are marked as 'dummy'.
+Compute aggregates of the given data points for the buckets of the given width.
+Returns a dictionary bucket start: aggregate dictionary, which contains the
+count and the sum, minimum and maximum of each field in ROLLUP_FIELDS, in the
+same format as the rollup collections. Data points that lack any of the fields
+are ignored.
 """
-def clean_database(config_dict):
-  dbm = DatabaseManager(config_dict)
-  dc = dbm.datacollection
+def compute_rollup_buckets(datapoints, width):
+  buckets = {}
+
+  for d in datapoints:
+    if not all(field in d for field in ROLLUP_FIELDS):
+      continue
+
+    t = d["timestamp"]
+    bucket_start = t - t % width
+
+    b = buckets.get(bucket_start)
+    if b is None:
+      b = {"count": 0}
+      for field in ROLLUP_FIELDS:
+        b[field + "Sum"] = 0.
+        b[field + "Min"] = d[field]
+        b[field + "Max"] = d[field]
+      buckets[bucket_start] = b
 
-  tagged = dc.find({DUMMY_TAG: {"$exists" : True}})
+    b["count"] += 1
+    for field in ROLLUP_FIELDS:
+      v = d[field]
+      b[field + "Sum"] += v
+      b[field + "Min"] = min(b[field + "Min"], v)
+      b[field + "Max"] = max(b[field + "Max"], v)
 
-  c = tagged.count()
+  return buckets
+
+
+"""
+Return the number of buckets of the given width touched by the range
+r = (start, end), inclusive, i.e. the number of buckets returned by
+DatabaseManager.query_buckets. Extending the range to whole buckets doesn't
+change this.
+"""
+def count_buckets(r, width):
+  (start, end) = r
+  return math.floor(end / width) - math.floor(start / width) + 1
+
+"""
+Extend the range r = (start, end), inclusive, to whole buckets of the given
+width. Returns a tuple (start, end), where end is exclusive, i.e. the start of
+the bucket after the one containing end. An infinite end is kept.
+"""
+def whole_buckets(r, width):
+  (start, end) = r
+  if math.isfinite(end):
+    end = end - end % width + width
+  return (start - start % width, end)
+
+
+"""
+Downsample the time-ordered data points of the range r = (start, end) to at most
+max_items points by dividing the range into max_items // 2 buckets of equal
+width and keeping the data points with the minimum and maximum value of field
+in each bucket, in time order. This keeps spikes and drops visible at any zoom
+level. For rollup documents, the minimum and maximum are compared using
+<field>Min and <field>Max. Data points without field are skipped.
+Consumes the data points once and yields the result, keeping only a single
+bucket in memory.
+"""
+def downsample_minmax(datapoints, r, max_items, field = "nCups"):
+  (start, end) = r
+  n_buckets = max(max_items // 2, 1)
+  width = (end - start) / n_buckets or 1.
+
+  current = None
+  lo = hi = None
+  for d in datapoints:
+    if field not in d:
+      continue
+
+    i = min(max(int((d["timestamp"] - start) // width), 0), n_buckets - 1)
+    if i != current:
+      if lo is not None:
+        yield from _ordered_pair(lo, hi)
+      current = i
+      lo = hi = d
+      continue
+
+    if d.get(field + "Min", d[field]) < lo.get(field + "Min", lo[field]):
+      lo = d
+    if d.get(field + "Max", d[field]) > hi.get(field + "Max", hi[field]):
+      hi = d
+
+  if lo is not None:
+    yield from _ordered_pair(lo, hi)
+
+def _ordered_pair(a, b):
+  if a is b:
+    return (a,)
+  return (a, b) if a["timestamp"] <= b["timestamp"] else (b, a)
+
+"""
+Downsample the time-ordered data points of the range r = (start, end) to at most
+max_items points using the largest-triangle-three-buckets algorithm (Steinarsson
+2013), which keeps the points that affect the visual shape of the line the most.
+The first and last points are always kept, and in between, one point is chosen
+from each of max_items - 2 buckets of equal width in time (instead of an equal
+number of points as in the original algorithm, which would need the total count
+beforehand). Data points without field are skipped.
+Consumes the data points once and yields the result, keeping at most two
+buckets in memory.
+"""
+def downsample_lttb(datapoints, r, max_items, field = "nCups"):
+  (start, end) = r
+  n_buckets = max(max_items - 2, 1)
+  width = (end - start) / n_buckets or 1.
+
+  selected = None # the previously chosen point
+  current = [] # points of the bucket from which a point is chosen next
+  following = [] # points of the bucket after that
+  following_index = None
+
+  for d in datapoints:
+    if field not in d:
+      continue
+
+    if selected is None:
+      selected = d
+      yield d
+      continue
+
+    i = min(max(int((d["timestamp"] - start) // width), 0), n_buckets - 1)
+    if i != following_index:
+      if current:
+        selected = _largest_triangle(selected, current, following, field)
+        yield selected
+      current = following
+      following = []
+      following_index = i
+
+    following.append(d)
+
+  if not following:
+    return
+
+  # the last point is always kept, the remaining ones are chosen using it.
+  last = following.pop()
+  if current:
+    selected = _largest_triangle(selected, current, following or [last], field)
+    yield selected
+  if following:
+    yield _largest_triangle(selected, following, [last], field)
+  yield last
+
+"""
+Return the point in candidates forming the largest triangle with the point a
+and the average of the points in following.
+"""
+def _largest_triangle(a, candidates, following, field):
+  ax, ay = a["timestamp"], a[field]
+  cx = sum(d["timestamp"] for d in following) / len(following)
+  cy = sum(d[field] for d in following) / len(following)
+
+  return max(candidates, key = lambda b:
+      abs((ax - cx) * (b[field] - ay) - (ax - b["timestamp"]) * (cy - ay))
+      )
+
+
+"""
+Check that none of the frequent queries falls back to a collection scan, i.e.
+that the indexes are in place. Returns True if all queries use an index.
+"""
+def check_query_plans(config_dict):
+  dbm = get_database_manager(config_dict)
+
+  ok = True
+  for desc, stages in dbm.explain_queries():
+    collscan = any(stage.startswith("COLLSCAN") for stage in stages)
+    ok = ok and not collscan
+    print("{:<35} {:<5} {}".format(desc, "FAIL" if collscan else "OK", " <- ".join(stages)))
+
+  return ok
+
+
+"""
+Recompute nCups of the stored data, see DatabaseManager.recompute_nCups. If
+use_latest is True, the latest calibration is applied to all data, otherwise
+the calibration history is used.
+"""
+def recompute_nCups(config_dict, use_latest = False):
+  import time
+
+  dbm = get_database_manager(config_dict)
+
+  calibration = None
+  if use_latest:
+    calibration = dbm._get_latest_calibration()
+    if calibration is None:
+      print("No calibration stored in the database. Exiting.")
+      return
+  elif not dbm.calibration_history():
+    print("The calibration history is empty. Exiting.")
+    return
+
+  t = time.time()
+  n = dbm.recompute_nCups(calibration)
+  elapsed = time.time() - t
+  print("Recomputed {} data points in {:.1f} s.".format(n, elapsed))
+
+
+"""
+Delete the data that is older than the configured retention times.
+"""
+def apply_retention(config_dict):
+  dbm = get_database_manager(config_dict)
+
+  if not dbm.retention_enabled:
+    print("No retention times configured. Exiting.")
+    return
+
+  for name, days in sorted(dbm.retention_days.items()):
+    print("{:<15} {}".format(name, "keep {:g} days".format(days) if days > 0 else "keep forever"))
+
+  deleted = dbm.apply_retention()
+
+  for name, n_deleted in deleted.items():
+    print("Deleted {} records from {}.".format(n_deleted, name))
+
+  if not deleted:
+    print("Nothing to delete.")
+
+
+"""
+Remove all entries from the database that are marked as 'dummy'. If
+assume_yes is True, don't ask for confirmation.
+"""
+def clean_database(config_dict, assume_yes = False):
+  dbm = get_database_manager(config_dict)
+
+  c = dbm.count_dummy()
 
   if c > 0:
-    ans = input("Found {} dummy entries. Are you sure you want to remove them? (y/n) ".format(c)).lower()
-    if not ans in ["yes", "y"]:
+    if not _confirm("Found {} dummy entries. Are you sure you want to remove them?".format(c), assume_yes):
       print("Aborting.")
       return
 
-    removedCount = 0
-    for entry in tagged:
-      res = dc.delete_one(entry)
-      if res.acknowledged:
-        removedCount += res.deleted_count
+    removedCount = dbm.delete_dummy()
 
     print("Removed {} entries.".format(removedCount))
 
@@ -354,9 +1559,24 @@ def clean_database(config_dict):
 
 
 """
-Main function for testing and manual database management
+Parse the value of --since: a unix timestamp or "last".
 """
-if __name__ == "__main__":
+def _parse_since(value):
+  import argparse
+
+  if value == "last":
+    return value
+  try:
+    return float(value)
+  except ValueError:
+    raise argparse.ArgumentTypeError("expected a unix timestamp or 'last', got '{}'".format(value))
+
+
+"""
+Main function for testing and manual database management, run with
+'python3 -m db'.
+"""
+def main():
   import argparse
   try:
     import config
@@ -364,7 +1584,7 @@ if __name__ == "__main__":
     print("Could not import config, try adding the kiltiskahvi folder to your PYTHONPATH. Exiting.")
     sys.exit(1)
 
-  ap = argparse.ArgumentParser(description = "Dump or delete database contents or run whatever is in the main function.")
+  ap = argparse.ArgumentParser(prog = "python3 -m db", description = "Dump or delete database contents or run whatever is in the main function.")
 
   ap.add_argument("-c", "--config",
       dest = "config_file",
@@ -376,7 +1596,7 @@ if __name__ == "__main__":
       nargs = "?",
       const = get_default_dump_path(),
       default = None,
-      help = "Dump entire kiltiskahvi database contents in JSON format using mongoexport. Data is dumped to the specified folder or to kiltiskahvi/db/dump/ by default."
+      help = "Dump entire kiltiskahvi database contents in JSON format. Data is dumped to the specified folder or to kiltiskahvi/db/dump/ by default."
       )
 
   ap.add_argument("--purge",
@@ -387,12 +1607,66 @@ if __name__ == "__main__":
       help = "Same as --dump but also delete database contents. Use at your own risk."
       )
 
+  ap.add_argument("--restore",
+      dest = "restore_path",
+      default = None,
+      help = "Load the contents of a dump created with --dump or --purge from the folder RESTORE_PATH into the database."
+      )
+
   ap.add_argument("--clean",
       dest = "clean",
       action = "store_true",
       help = "Remove dummy entries from the database and exit. Dummy entries are created when the daemon runs but GPIO pins are not available."
       )
 
+  ap.add_argument("--recompute",
+      dest = "recompute",
+      nargs = "?",
+      const = "history",
+      choices = ["history", "latest"],
+      help = "Recompute nCups of all stored data from the raw values and exit. With 'history' (default), use the calibration that was active at the time of each measurement, with 'latest' use the latest calibration for all data. The rollups are rebuilt afterwards."
+      )
+
+  ap.add_argument("--retention",
+      dest = "retention",
+      action = "store_true",
+      help = "Delete data older than the retention times configured with the retain_*_days options and exit. Raw data is aggregated into the rollups before deleting."
+      )
+
+  ap.add_argument("--check-indexes",
+      dest = "check_indexes",
+      action = "store_true",
+      help = "Create missing indexes and print the query plans of the frequent queries. Exits with status 1 if any of them uses a collection scan (COLLSCAN)."
+      )
+
+  ap.add_argument("--rollup",
+      dest = "rollup",
+      action = "store_true",
+      help = "Rebuild the rollup collections (minute, hour and day aggregates) from the raw data and exit. Necessary when upgrading an existing database. The aggregates older than the raw data (see the retain_*_days options) are kept."
+      )
+
+  ap.add_argument("--compress",
+      dest = "compression",
+      choices = sorted(DUMP_EXTENSIONS),
+      default = "none",
+      help = "When used with --dump or --purge, compress the dumped files. zstd requires the 'zstandard' package. Default none."
+      )
+
+  ap.add_argument("--since",
+      dest = "since",
+      nargs = "?",
+      const = "last",
+      default = None,
+      type = _parse_since,
+      help = "When used with --dump, only dump records newer than the unix timestamp SINCE. Without a value (or with 'last'), continue from the latest record of the previous dump of the database into the same folder."
+      )
+
+  ap.add_argument("-y", "--yes",
+      dest = "assume_yes",
+      action = "store_true",
+      help = "Answer yes to all questions, e.g. when running --dump, --purge, --restore or --clean without a terminal."
+      )
+
   ap.add_argument("-n", "--count",
       dest = "dump_count",
       default = None,
@@ -405,24 +1679,54 @@ if __name__ == "__main__":
   # TODO: is config even necessary for the DB manager? -- yes, for checking changes in the calibration (might not be the smartest way to do it though.
   cfg = config.get_config_dict(args.config_file)
 
+  since = args.since
+
   if args.purge_dump_path:
-    dump_database(args.purge_dump_path, cfg, count = args.dump_count, purge = True)
+    dump_database(args.purge_dump_path, cfg, count = args.dump_count, purge = True,
+                  compression = args.compression, since = since, assume_yes = args.assume_yes)
     sys.exit(0)
 
   elif args.dump_path:
-    dump_database(args.dump_path, cfg, count = args.dump_count)
+    dump_database(args.dump_path, cfg, count = args.dump_count,
+                  compression = args.compression, since = since, assume_yes = args.assume_yes)
+    sys.exit(0)
+
+  elif args.restore_path:
+    restore_database(args.restore_path, cfg, assume_yes = args.assume_yes)
     sys.exit(0)
 
   elif args.clean:
-    clean_database(cfg)
+    clean_database(cfg, assume_yes = args.assume_yes)
+    sys.exit(0)
+
+  elif args.recompute:
+    recompute_nCups(cfg, use_latest = args.recompute == "latest")
+    sys.exit(0)
+
+  elif args.retention:
+    apply_retention(cfg)
+    sys.exit(0)
+
+  elif args.check_indexes:
+    sys.exit(0 if check_query_plans(cfg) else 1)
+
+  elif args.rollup:
+    dbm = get_database_manager(cfg)
+    print("Rebuilding rollup collections.")
+    n = dbm.rebuild_rollups()
+    print("Wrote {} buckets.".format(n))
     sys.exit(0)
 
 
 
-  dbm = DatabaseManager(cfg)
+  dbm = get_database_manager(cfg)
 
 
   #TODO: tests...
   #dbm.query_range((0, 100))
   #dbm.query_range((50, 0)) # should raise an exception
   #...
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,11 @@
+"""
+Command line interface for managing the database, e.g.
+
+  python3 -m db --dump
+  python3 -m db --retention
+
+See 'python3 -m db --help'.
+"""
+from db import main
+
+main()
@@ -0,0 +1,324 @@
+"""
+A small script for comparing the cost of the range query downsampling methods
+(see query_range) against truncating the result at range_query_max_items. The
+data points are generated in memory, imitating a coffee maker being filled and
+emptied every few hours at a 10 s poll interval, so no database is required
+and only the cost of processing the query result is measured.
+
+With --backend, the data points are inserted into a temporary SQLite database
+or an in-memory mongomock database instead, and the timings include reading
+them from the database, which is where truncating with a query limit saves the
+most. The full query_range (with the rollup tier selection) is timed as well.
+
+With --singleflight, it instead measures how many database queries are made
+when many clients request the same data from the web server at once, with and
+without coalescing the identical requests (see db.cache.SingleFlight). The
+Flask app of webserver.py is driven with its test client from concurrent
+threads, on a database created as with --backend (SQLite by default), and the
+backend queries are counted.
+"""
+
+import db
+import os
+import sys
+import time
+import itertools
+import random
+import tracemalloc
+import threading
+
+"""
+Generate n synthetic data points in the same format as a range query result.
+"""
+def generate_datapoints(n, poll_interval = 10., start = 0.):
+  rng = random.Random(0)
+  brew_interval = 3 * 60 * 60
+  for i in range(n):
+    t = start + i * poll_interval
+    phase = (t % brew_interval) / brew_interval
+    nCups = max(10. * (1 - 4 * phase), 0.) + rng.gauss(0, 0.1)
+    yield {"timestamp": t, "nCups": nCups, "rawValue": 340000 + 16300 * nCups}
+
+"""
+The current behaviour, i.e. returning only the first max_items data points.
+"""
+def truncate(datapoints, r, max_items, field = "nCups"):
+  return itertools.islice(datapoints, max_items)
+
+METHODS = [
+    ("truncate", truncate),
+    ("minmax", db.downsample_minmax),
+    ("lttb", db.downsample_lttb),
+    ]
+
+"""
+Run each method on n generated data points and return a list of tuples (method
+name, elapsed time in seconds, number of returned items, peak memory in bytes).
+"""
+def run_benchmark(n, max_items):
+  poll_interval = 10.
+  r = (0., n * poll_interval)
+  results = []
+
+  for name, fun in METHODS:
+    t = time.perf_counter()
+    n_returned = sum(1 for _ in fun(generate_datapoints(n, poll_interval), r, max_items))
+    elapsed = time.perf_counter() - t
+
+    # measure memory separately, as tracing slows down the processing a lot.
+    tracemalloc.start()
+    for _ in fun(generate_datapoints(n, poll_interval), r, max_items):
+      pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    results.append((name, elapsed, n_returned, peak))
+
+  return results
+
+"""
+Create a database manager for the given backend, 'sqlite' (a temporary file)
+or 'mongomock' (an in-memory mongodb), containing n generated data points.
+"""
+def create_database(backend, n, poll_interval = 10.):
+  import config
+  import tempfile
+  import shutil
+  import atexit
+
+  cfg = config.get_config_dict()
+  db_config = cfg["database"]
+  db_config["dbname"] = "kahvidb_benchmark"
+  db_config["segment_path"] = ""
+  db_config["range_cache_size"] = "0"
+  cfg["general"]["poll_interval"] = str(poll_interval)
+
+  if backend == "sqlite":
+    path = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, path, True)
+    db_config["backend"] = "sqlite"
+    db_config["sqlite_path"] = os.path.join(path, "benchmark.sqlite")
+
+  elif backend == "mongomock":
+    import mongomock
+    import pymongo
+    # a new database for each call, shared by all connections
+    client = mongomock.MongoClient()
+    pymongo.MongoClient = lambda *a, **kw: client
+    db_config["backend"] = "mongodb"
+
+  else:
+    raise ValueError("Unknown backend: {}".format(backend))
+
+  dbm = db.get_database_manager(cfg)
+  dbm.ensure_indexes()
+
+  datapoints = (
+      dict(d, isCoffee = d["nCups"] > 0.5)
+      for d in generate_datapoints(n, poll_interval)
+      )
+  while True:
+    batch = list(itertools.islice(datapoints, 10000))
+    if not batch:
+      break
+    dbm.insert_data(batch)
+
+  return dbm
+
+"""
+Run each method on the raw data of a database containing n data points, see
+create_database, including reading the data from the database. Returns a list
+of tuples (method name, elapsed time in seconds, number of returned items).
+"""
+def run_backend_benchmark(backend, n, max_items):
+  poll_interval = 10.
+  dbm = create_database(backend, n, poll_interval)
+  dbm.range_query_max_items = max_items
+  r = (0., n * poll_interval)
+
+  methods = [
+      ("truncate", lambda: dbm._query_raw_range(r, {}, max_items)),
+      ("minmax", lambda: db.downsample_minmax(dbm._query_raw_range(r), r, max_items)),
+      ("lttb", lambda: db.downsample_lttb(dbm._query_raw_range(r), r, max_items)),
+      # with the tier selection and the configured downsampling
+      ("query", lambda: dbm.query_range(r)),
+      ]
+
+  results = []
+  for name, fun in methods:
+    t = time.perf_counter()
+    n_returned = sum(1 for _ in fun())
+    results.append((name, time.perf_counter() - t, n_returned))
+
+  return results
+
+"""
+Replace the backend query methods of the database manager dbm with wrappers
+counting the calls. Returns a function returning the number of calls so far.
+"""
+def count_queries(dbm):
+  calls = [0]
+  lock = threading.Lock()
+
+  def wrap(fun):
+    def wrapped(*args, **kwargs):
+      with lock:
+        calls[0] += 1
+      return fun(*args, **kwargs)
+    return wrapped
+
+  for name in ["_query_raw_range", "_query_rollup_range", "_query_buckets", "_query_latest"]:
+    setattr(dbm, name, wrap(getattr(dbm, name)))
+
+  return lambda: calls[0]
+
+"""
+Calls the function directly, in place of a SingleFlight.
+"""
+class NoSingleFlight():
+  def do(self, key, fun):
+    return fun()
+
+"""
+Return the web server module, using the database manager dbm instead of the
+configured database.
+"""
+def import_webserver(dbm):
+  # the web server creates a database manager for the configured database
+  # when imported, which may not be available.
+  get_database_manager = db.get_database_manager
+  db.get_database_manager = lambda *args, **kwargs: dbm
+  try:
+    import webserver
+  finally:
+    db.get_database_manager = get_database_manager
+
+  webserver.dbm = dbm
+  return webserver
+
+"""
+Make bursts of the given number of concurrent identical /data requests for the
+whole range of the database manager dbm (see create_database), which contains
+n data points, with and without the SingleFlight of the web server. Returns a
+list of tuples (mode, database queries per burst, time per burst in seconds,
+number of failed requests).
+"""
+def run_singleflight_benchmark(dbm, n, clients, bursts, poll_interval = 10.):
+  webserver = import_webserver(dbm)
+  queries = count_queries(dbm)
+  query = {"s": 0., "e": n * poll_interval}
+  singleflight = webserver.singleflight
+
+  results = []
+  try:
+    for mode in ["direct", "singleflight"]:
+      webserver.singleflight = NoSingleFlight() if mode == "direct" else singleflight
+      errors = [0]
+      lock = threading.Lock()
+      # start all the requests of a burst at the same time
+      barrier = threading.Barrier(clients)
+
+      def client():
+        test_client = webserver.app.test_client()
+        for _ in range(bursts):
+          barrier.wait()
+          resp = test_client.get("/data", query_string = query)
+          resp.get_data()
+          if resp.status_code != 200:
+            with lock:
+              errors[0] += 1
+
+      threads = [threading.Thread(target = client) for _ in range(clients)]
+      queries_before = queries()
+      t = time.perf_counter()
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      elapsed = time.perf_counter() - t
+
+      results.append((mode, (queries() - queries_before) / bursts, elapsed / bursts, errors[0]))
+
+  finally:
+    webserver.singleflight = singleflight
+
+  return results
+
+if __name__ == "__main__":
+  import argparse
+
+  ap = argparse.ArgumentParser(description = "Benchmark range query downsampling methods.")
+
+  ap.add_argument("-n", "--count",
+      dest = "counts",
+      type = int,
+      nargs = "+",
+      default = [100000, 1000000, 3000000],
+      help = "Number(s) of data points in the queried range. Default 100000 1000000 3000000."
+      )
+
+  ap.add_argument("-m", "--max-items",
+      dest = "max_items",
+      type = int,
+      default = 1000,
+      help = "The maximum number of items to return, as range_query_max_items. Default 1000."
+      )
+
+  ap.add_argument("--singleflight",
+      dest = "clients",
+      type = int,
+      nargs = "*",
+      help = "Benchmark coalescing identical concurrent /data requests instead, with the given numbers of clients. Default 1 10 100."
+      )
+
+  ap.add_argument("--bursts",
+      dest = "bursts",
+      type = int,
+      default = 5,
+      help = "The number of bursts of concurrent requests, with --singleflight. Default 5."
+      )
+
+  ap.add_argument("--backend",
+      dest = "backend",
+      choices = ["sqlite", "mongomock"],
+      help = "Read the data points from a database of this kind instead of generating them in memory."
+      )
+
+  args = ap.parse_args()
+
+  if args.clients is not None:
+    # the time and the queries are per burst of requests
+    fmt = "{:>10} {:>10} {:>14} {:>10.1f} {:>10.3f} {:>10}"
+    print("{:>10} {:>10} {:>14} {:>10} {:>10} {:>10}".format("n", "clients", "mode", "queries", "time (s)", "errors"))
+
+    for n in args.counts:
+      dbm = create_database(args.backend or "sqlite", n)
+      dbm.range_query_max_items = args.max_items
+
+      for clients in args.clients or [1, 10, 100]:
+        for mode, queries, elapsed, errors in run_singleflight_benchmark(dbm, n, clients, args.bursts):
+          print(fmt.format(n, clients, mode, queries, elapsed, errors))
+        sys.stdout.flush()
+
+    sys.exit(0)
+
+  if args.backend is not None:
+    # inserting the data points is not included in the timings.
+    fmt = "{:>10} {:>10} {:>10.3f} {:>10}"
+    print("{:>10} {:>10} {:>10} {:>10}".format("n", "method", "time (s)", "returned"))
+
+    for n in args.counts:
+      for name, elapsed, n_returned in run_backend_benchmark(args.backend, n, args.max_items):
+        print(fmt.format(n, name, elapsed, n_returned))
+      sys.stdout.flush()
+
+    sys.exit(0)
+
+  # the cost of generating the data points is included in all timings.
+  fmt = "{:>10} {:>10} {:>10.3f} {:>10} {:>12.1f}"
+  print("{:>10} {:>10} {:>10} {:>10} {:>12}".format("n", "method", "time (s)", "returned", "peak (kB)"))
+
+  for n in args.counts:
+    for name, elapsed, n_returned, peak in run_benchmark(n, args.max_items):
+      print(fmt.format(n, name, elapsed, n_returned, peak / 1024))
+    sys.stdout.flush()
@@ -0,0 +1,317 @@
+"""
+An in-process cache of range query results, so that e.g. the web server doesn't
+query the database again when the same historical window of data is requested
+repeatedly.
+
+The cached items are the query results before downsampling, for a window
+aligned to bucket boundaries (see DatabaseManager.query_range), so that
+slightly different ranges map to the same entry. A window that ends before the
+latest data point can't change anymore and is cached until it's evicted, while
+a window containing the present expires after a short time or when data is
+inserted into it. The least recently used entries are evicted when the total
+size exceeds the configured maximum.
+
+The cache is enabled by setting range_cache_size in the [database] section of
+the configuration.
+
+The latest measurement is cached separately, see LatestCache. SingleFlight
+deduplicates concurrent identical calls.
+"""
+import collections
+import threading
+import time
+import sys
+import syslog
+
+# a cache entry, see RangeCache.put
+_Entry = collections.namedtuple("_Entry",
+    ["items", "timestamps", "window", "immutable", "expires", "size"]
+    )
+
+class RangeCache():
+  def __init__(self, max_bytes, ttl):
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+
+    # entries in the order of use, the least recently used first
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  """
+  Return the entry for the given key, or None if it's not cached or has
+  expired.
+  """
+  def get(self, key):
+    with self._lock:
+      entry = self._entries.get(key)
+
+      if entry is not None and not entry.immutable and entry.expires < time.time():
+        self._remove(key)
+        entry = None
+
+      if entry is None:
+        self.misses += 1
+        return None
+
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return entry
+
+  """
+  Store the list of items, which are sorted by timestamp, as the result of the
+  query for the window (start, end). The window is the range of timestamps the
+  items may have. Immutable entries don't expire. Results larger than the
+  whole cache are not stored.
+  """
+  def put(self, key, items, window, immutable):
+    timestamps = [item["timestamp"] for item in items]
+    entry = _Entry(
+        items, timestamps, window, immutable, time.time() + self.ttl, estimate_size(items)
+        )
+
+    if entry.size > self.max_bytes:
+      return entry
+
+    with self._lock:
+      if key in self._entries:
+        self._remove(key)
+
+      self._entries[key] = entry
+      self.size += entry.size
+
+      while self.size > self.max_bytes:
+        oldest = next(iter(self._entries))
+        self._remove(oldest)
+        self.evictions += 1
+
+    return entry
+
+  """
+  Remove the entries whose window overlaps the tuple (start, end), e.g. after
+  inserting data within it.
+  """
+  def invalidate(self, r):
+    (start, end) = r
+    with self._lock:
+      for key, entry in list(self._entries.items()):
+        if entry.window[0] <= end and entry.window[1] >= start:
+          self._remove(key)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.size = 0
+
+  def _remove(self, key):
+    entry = self._entries.pop(key)
+    self.size -= entry.size
+
+  """
+  Return a dictionary of the number of hits, misses, evictions and entries and
+  the current and maximum size in bytes, for tuning the cache size.
+  """
+  def stats(self):
+    with self._lock:
+      return {
+          "hits": self.hits,
+          "misses": self.misses,
+          "evictions": self.evictions,
+          "entries": len(self._entries),
+          "size": self.size,
+          "max_size": self.max_bytes,
+          }
+
+"""
+A cache of the latest measurement, so that query_latest is a memory read.
+
+If the storage backend can push updates (see DatabaseManager._watch_latest,
+e.g. a mongodb change stream), a background thread keeps the value up to date.
+Otherwise, or if watching fails, the value is fetched again when it's older
+than ttl seconds. Functions added with add_listener are called with each new
+value.
+"""
+class LatestCache():
+  # seconds to wait before trying to watch again after an error
+  RETRY_INTERVAL = 60
+
+  def __init__(self, fetch, watch, ttl):
+    self._fetch = fetch
+    self._watch = watch
+    self.ttl = ttl
+
+    self._value = None
+    self._fetched = 0.
+    self._lock = threading.Lock()
+
+    self._thread = None
+    self.watching = False
+
+    self._listeners = []
+
+    # the number of gets and of fetches made by them
+    self.gets = 0
+    self.fetches = 0
+
+  """
+  Return a copy of the latest value.
+  """
+  def get(self):
+    if self._thread is None:
+      self.start()
+
+    with self._lock:
+      self.gets += 1
+      expired = time.time() - self._fetched > self.ttl
+      if self._fetched == 0 or (expired and not self.watching):
+        self.fetches += 1
+        self._update(self._fetch())
+
+      value = self._value
+
+    return None if value is None else dict(value)
+
+  """
+  Replace the cached value, e.g. after inserting data or when an update was
+  pushed by the database.
+  """
+  def set(self, value):
+    with self._lock:
+      self._update(value)
+
+  def _update(self, value):
+    changed = value != self._value
+    self._value = value
+    self._fetched = time.time()
+
+    if changed and value is not None:
+      for fun in self._listeners:
+        try:
+          fun(dict(value))
+        except Exception as e:
+          syslog.syslog(syslog.LOG_ERR, "db: Latest value listener failed: {}".format(e))
+
+  """
+  Call fun with a copy of the latest value every time it changes.
+  """
+  def add_listener(self, fun):
+    self._listeners.append(fun)
+    if self._thread is None:
+      self.start()
+
+  def remove_listener(self, fun):
+    self._listeners.remove(fun)
+
+  def stats(self):
+    with self._lock:
+      return {"gets": self.gets, "fetches": self.fetches, "watching": self.watching}
+
+  """
+  Start watching for updates in a background thread. This is done on the first
+  call of get or add_listener.
+  """
+  def start(self):
+    if self._thread is not None:
+      return
+    self._thread = threading.Thread(target = self._run, name = "latest-cache", daemon = True)
+    self._thread.start()
+
+  def _run(self):
+    while True:
+      try:
+        stream = self._watch()
+        if stream is None:
+          # pushing updates is not supported, poll instead.
+          return
+
+        self.watching = True
+        # fetch once, in case the value changed before watching started
+        self.set(self._fetch())
+
+        for value in stream:
+          self.set(value)
+
+      except NotImplementedError as e:
+        syslog.syslog(syslog.LOG_WARNING,
+            "db: Can't watch the latest measurement, polling instead: {}".format(e))
+        return
+
+      except Exception as e:
+        syslog.syslog(syslog.LOG_WARNING,
+            "db: Watching the latest measurement failed, polling instead: {}".format(e))
+
+      finally:
+        self.watching = False
+
+      time.sleep(self.RETRY_INTERVAL)
+
+"""
+Deduplicates concurrent calls: while a call with a given key is in progress,
+other threads calling do with the same key wait for it and get the same result
+(or exception) instead of calling the function again. Nothing is cached after
+the call has finished. Used e.g. for sharing the database query and the
+encoded response between identical concurrent web requests.
+"""
+class SingleFlight():
+  def __init__(self):
+    self._lock = threading.Lock()
+    # key: call in progress
+    self._calls = {}
+
+    # the number of calls made and the number of calls that shared the result
+    # of another call
+    self.calls = 0
+    self.shared = 0
+
+  def do(self, key, fun):
+    with self._lock:
+      call = self._calls.get(key)
+      leader = call is None
+      if leader:
+        call = self._calls[key] = _Call()
+        self.calls += 1
+      else:
+        self.shared += 1
+
+    if not leader:
+      call.done.wait()
+      if call.exception is not None:
+        raise call.exception
+      return call.result
+
+    try:
+      call.result = fun()
+      return call.result
+
+    except Exception as e:
+      call.exception = e
+      raise
+
+    finally:
+      with self._lock:
+        del self._calls[key]
+      call.done.set()
+
+  def stats(self):
+    with self._lock:
+      return {"calls": self.calls, "shared": self.shared, "in_flight": len(self._calls)}
+
+class _Call():
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.exception = None
+
+"""
+Estimate the memory used by a list of flat dictionaries. The keys are not
+counted, as they are shared between the dictionaries.
+"""
+def estimate_size(items):
+  size = sys.getsizeof(items)
+  for item in items:
+    size += sys.getsizeof(item) + sum(sys.getsizeof(v) for v in item.values())
+  return size
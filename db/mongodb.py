@@ -0,0 +1,517 @@
+"""
+The MongoDB storage backend, which keeps each measurement as a document in the
+collection 'data' and the rollups in the collections 'data-<tier name>'.
+
+NOTE: The mongodb database is located in /var/lib/mongodb (default for debian
+(I think)). All db paths are handled automagically by mongodb, so we try not to
+fiddle with those at all.
+"""
+import pymongo
+import bson
+import numpy as np
+import time
+
+from . import DatabaseManager, ROLLUP_TIERS, ROLLUP_FIELDS, DUMMY_TAG, whole_buckets
+
+#TODO: does the connection need to be closd manually w/ mongodb?
+"""
+A database manager storing the data in a local mongodb database.
+"""
+class MongoDatabaseManager(DatabaseManager):
+
+  def __init__(self, config_dict, dummy = False):
+    super().__init__(config_dict, dummy)
+
+    if dummy:
+      return
+
+    # test the connection with a client with a timeout of 10ms.
+    try:
+      pymongo.MongoClient("localhost", 27017, serverSelectionTimeoutMS = 10).server_info()
+    except pymongo.errors.ServerSelectionTimeoutError as e:
+      if "Errno 111" in e.args[0]:
+        raise ConnectionRefusedError("Database connection refused. Is mongodb running?") from e
+      else:
+        raise
+
+    self.client = pymongo.MongoClient("localhost", 27017) # hard-coded local db.
+    self.db = self.client[self.db_name]
+    self.datacollection = self.db["data"]
+    self.data_latest_collection = self.db["data-latest"]
+
+    # list of (collection, bucket width) pairs, from finest to coarsest
+    self.rollup_collections = [
+        (self.db["data-" + name], width) for name, width in ROLLUP_TIERS
+        ]
+    self.rollup_collection_by_width = {w: c for c, w in self.rollup_collections}
+
+    """
+    A collection holding a single entry: the latest calibration parameters
+    in dictionary form. Another collection keeps track of the history of
+    calibration parameters. These are updated only when the calibration
+    values change.
+    """
+    #TODO: this whole thing
+    #TODO: check for changed parameters
+    self.calibration_latest_collection = self.db["calibration-latest"]
+    # this contains a history of calibration dictionaries.
+    self.calibration_history_collection = self.db["calibration-history"]
+
+    self.ensure_indexes()
+
+  ############
+  # INDEXING #
+  ############
+
+  """
+  Create the indexes needed by the range queries, dumping and cleaning. Creating
+  an index that already exists does nothing, so this is done on every startup.
+  The rollup collections are queried by _id, which is always indexed, but
+  dumping sorts them by timestamp.
+  """
+  def ensure_indexes(self):
+    self.datacollection.create_index("timestamp")
+    # only dummy entries have the dummy tag, so a sparse index stays small.
+    self.datacollection.create_index(DUMMY_TAG, sparse = True)
+    self.calibration_history_collection.create_index("timestamp")
+    for collection, _ in self.rollup_collections:
+      collection.create_index("timestamp")
+
+  """
+  Run explain() on the queries that are run often or on large collections.
+  Returns a list of tuples (description, list of stages in the winning query
+  plan).
+  """
+  def explain_queries(self):
+    t = time.time()
+    explained = []
+
+    explained.append((
+      "range query on data",
+      self.datacollection
+        .find({"timestamp": {"$gte": t - 3600, "$lte": t}}, projection = {"_id": False})
+        .sort("timestamp", pymongo.ASCENDING)
+        .explain()
+      ))
+
+    for collection, width in self.rollup_collections:
+      explained.append((
+        "range query on " + collection.name,
+        self.db.command(
+          "aggregate", collection.name,
+          pipeline = [
+            {"$match": {"_id": {"$gte": t - 1000 * width, "$lte": t}}},
+            {"$sort": {"_id": pymongo.ASCENDING}},
+            ],
+          explain = True
+          )
+        ))
+
+    explained.append((
+      "dummy entries in data",
+      self.datacollection.find({DUMMY_TAG: {"$exists": True}}).explain()
+      ))
+
+    explained.append((
+      "latest entries in data (dump)",
+      self.datacollection.find().sort("timestamp", pymongo.DESCENDING).limit(1).explain()
+      ))
+
+    return [(desc, _winning_plan_stages(e)) for desc, e in explained]
+
+
+  #############
+  # INSERTING #
+  #############
+
+  def _store_datapoints(self, datapoints, rollups, latest):
+    # insert copies as insert_many modifies the dicts ...
+    self.datacollection.insert_many([d.copy() for d in datapoints])
+
+    for width, buckets in rollups:
+      if not buckets:
+        continue
+
+      ops = []
+      for bucket_start, b in buckets.items():
+        ops.append(pymongo.UpdateOne(
+          {"_id": bucket_start},
+          {
+            "$setOnInsert": {"timestamp": bucket_start},
+            "$inc": {k: b[k] for k in b if k == "count" or k.endswith("Sum")},
+            "$min": {k: b[k] for k in b if k.endswith("Min")},
+            "$max": {k: b[k] for k in b if k.endswith("Max")},
+          },
+          upsert = True
+          ))
+
+      self.rollup_collection_by_width[width].bulk_write(ops, ordered = False)
+
+    latest = dict(latest, _id = 0)
+    self.data_latest_collection.replace_one({u"_id" : 0}, latest, upsert = True)
+
+  def _retry_store_datapoints(self, datapoints, rollups, latest):
+    # the raw data points may have been inserted and the rollups partly
+    # updated, so replace the data points and recompute their rollups.
+    timestamps = [d["timestamp"] for d in datapoints]
+    self.datacollection.delete_many({"timestamp": {"$in": timestamps}})
+    self.datacollection.insert_many([d.copy() for d in datapoints])
+
+    self.rebuild_rollups((min(timestamps), max(timestamps)))
+
+    latest = dict(latest, _id = 0)
+    self.data_latest_collection.replace_one({u"_id" : 0}, latest, upsert = True)
+
+  def _rebuild_rollups(self, r):
+    match = {field: {"$exists": True} for field in ROLLUP_FIELDS}
+
+    n_written = 0
+
+    for collection, width in self.rollup_collections:
+      # extend the range to whole buckets so that no bucket is left partial
+      start, end = whole_buckets(r, width)
+      collection.delete_many({"_id": {"$gte": start, "$lt": end}})
+      tier_match = dict(match, timestamp = {"$gte": start, "$lt": end})
+
+      group = {
+          "_id": {"$subtract": ["$timestamp", {"$mod": ["$timestamp", width]}]},
+          "count": {"$sum": 1},
+          }
+      for field in ROLLUP_FIELDS:
+        group[field + "Sum"] = {"$sum": "$" + field}
+        group[field + "Min"] = {"$min": "$" + field}
+        group[field + "Max"] = {"$max": "$" + field}
+
+      cursor = self.datacollection.aggregate(
+          [{"$match": tier_match}, {"$group": group}],
+          allowDiskUse = True
+          )
+
+      batch = []
+      for bucket in cursor:
+        bucket["timestamp"] = bucket["_id"]
+        batch.append(bucket)
+        if len(batch) >= 1000:
+          collection.insert_many(batch, ordered = False)
+          n_written += len(batch)
+          batch = []
+      if batch:
+        collection.insert_many(batch, ordered = False)
+        n_written += len(batch)
+
+    return n_written
+
+  def _get_latest_calibration(self):
+    calibration_dict_key = "calibrationDict"
+
+    old_calibration_doc = self.calibration_latest_collection.find({"_id": 0}) #["calibrationDict"]
+    assert old_calibration_doc.count() <= 1
+
+    try:
+      return old_calibration_doc[0][calibration_dict_key]
+    except IndexError:
+      # There were no records in the latest collection.
+      # A KeyError here indicates something more serious.
+      return None
+
+  def _store_calibration(self, calibration_dict, timestamp):
+    calibration_dict_key = "calibrationDict"
+
+    self.calibration_latest_collection.replace_one(
+      {"_id": 0},  # this ensures that calibrationParams will only have one value.
+      {"_id": 0, calibration_dict_key: calibration_dict},
+      upsert = True
+    )
+    self.calibration_history_collection.insert_one({"timestamp" : timestamp, calibration_dict_key: calibration_dict})
+
+  def calibration_history(self):
+    return [
+        (doc["timestamp"], doc["calibrationDict"])
+        for doc in self.calibration_history_collection.find().sort("timestamp", pymongo.ASCENDING)
+        ]
+
+  def _iter_column_chunks(self, r, fields, chunk_size):
+    (start, end) = r
+
+    cursor = (
+        self.datacollection
+        .find(
+          {"timestamp": {"$gte": start, "$lt": end}},
+          projection = {f: True for f in fields}
+          )
+        .sort("timestamp", pymongo.ASCENDING)
+        .batch_size(chunk_size)
+        )
+
+    keys, values = [], []
+    for doc in cursor:
+      keys.append(doc["_id"])
+      values.append([doc.get(f, np.nan) for f in fields])
+      if len(keys) >= chunk_size:
+        yield keys, _to_columns(values, fields)
+        keys, values = [], []
+    if keys:
+      yield keys, _to_columns(values, fields)
+
+  def _update_columns(self, keys, columns):
+    # convert to python types for bson
+    columns = {f: c.tolist() for f, c in columns.items()}
+    ops = [
+        pymongo.UpdateOne({"_id": key}, {"$set": {f: c[i] for f, c in columns.items()}})
+        for i, key in enumerate(keys)
+        ]
+    if ops:
+      self.datacollection.bulk_write(ops, ordered = False)
+
+
+  ############
+  # QUERYING #
+  ############
+
+  """
+  Query the latest measurement.
+  This assumes that data_latest_collection contains always only one record.
+  """
+  def _query_latest(self):
+    try:
+      #TODO: adjust timeout...
+      return self.data_latest_collection.find_one()
+    except pymongo.errors.ServerSelectionTimeoutError:
+      return None
+
+  """
+  Watch data-latest with a change stream. Change streams are only available
+  if mongodb is run as a replica set (a single-node one is enough).
+  """
+  def _watch_latest(self):
+    try:
+      stream = self.data_latest_collection.watch(full_document = "updateLookup")
+    except pymongo.errors.OperationFailure as e:
+      raise NotImplementedError(str(e)) from e
+
+    return (
+        change["fullDocument"] for change in stream
+        if change.get("fullDocument") is not None
+        )
+
+  """
+  Returns a pymongo cursor.
+  """
+  def _query_raw_range(self, r, projection = {}, limit = 0):
+    (start, end) = r
+
+    proj = {"_id": False}
+    proj.update(projection)
+
+    return (
+        self
+        .datacollection
+        .find({"timestamp": {"$gte": start, "$lte": end}}, projection = proj)
+        .sort("timestamp", pymongo.ASCENDING)
+        # don't return more than this many items (0 means no limit)
+        .limit(limit)
+        )
+
+  """
+  Returns a pymongo command cursor.
+  """
+  def _query_rollup_range(self, width, r, projection = {}, limit = 0):
+    (start, end) = r
+
+    fields = {"_id": False, "timestamp": True, "count": True}
+    for field in ROLLUP_FIELDS:
+      fields[field] = {"$divide": ["$" + field + "Sum", "$count"]}
+      fields[field + "Min"] = True
+      fields[field + "Max"] = True
+
+    pipeline = [
+        # include the bucket containing the start of the range
+        {"$match": {"_id": {"$gte": start - start % width, "$lte": end}}},
+        {"$sort": {"_id": pymongo.ASCENDING}},
+        ]
+    if limit:
+      pipeline.append({"$limit": limit})
+    pipeline.append({"$project": fields})
+
+    # only inclusive projections make sense for the computed fields
+    included = [k for k, v in projection.items() if v and k != "_id"]
+    if included:
+      proj = {"_id": False}
+      proj.update({k: True for k in included})
+      pipeline.append({"$project": proj})
+
+    collection = self.rollup_collection_by_width[width]
+    return collection.aggregate(pipeline, allowDiskUse = True)
+
+  """
+  Returns a pymongo command cursor.
+  """
+  def _query_buckets(self, width, source_width, r, minmax, field):
+    (start, end) = r
+
+    if source_width is None:
+      collection = self.datacollection
+      count = 1
+      values = {"Sum": "$" + field, "Min": "$" + field, "Max": "$" + field}
+      match = {field: {"$exists": True}}
+    else:
+      collection = self.rollup_collection_by_width[source_width]
+      count = "$count"
+      values = {k: "$" + field + k for k in ["Sum", "Min", "Max"]}
+      match = {}
+
+    match["timestamp"] = {"$gte": start - start % width, "$lte": end}
+
+    group = {
+        "_id": {"$subtract": ["$timestamp", {"$mod": ["$timestamp", width]}]},
+        "count": {"$sum": count},
+        "sum": {"$sum": values["Sum"]},
+        }
+    fields = {
+        "_id": False,
+        "timestamp": "$_id",
+        "count": True,
+        field: {"$divide": ["$sum", "$count"]},
+        }
+    if minmax:
+      group["min"] = {"$min": values["Min"]}
+      group["max"] = {"$max": values["Max"]}
+      fields[field + "Min"] = "$min"
+      fields[field + "Max"] = "$max"
+
+    return collection.aggregate([
+        {"$match": match},
+        {"$group": group},
+        {"$sort": {"_id": pymongo.ASCENDING}},
+        {"$project": fields},
+        ], allowDiskUse = True)
+
+
+  ########################
+  # DUMPING AND CLEANING #
+  ########################
+
+  def database_id(self):
+    return "mongodb://localhost:27017/" + self.db_name
+
+  def collection_names(self):
+    # filter out system collections
+    return list(filter(
+        lambda x: not x.startswith("system."),
+        self.db.collection_names()
+        ))
+
+  def iter_collection(self, name, count = None, since = None, batch_size = None):
+    query = {} if since is None else {"timestamp": {"$gt": since}}
+    cursor = self.db[name].find(query)
+    if batch_size is not None:
+      cursor = cursor.batch_size(batch_size)
+    if count is not None:
+      cursor = cursor.sort("timestamp", pymongo.DESCENDING).limit(count)
+
+    for record in cursor:
+      if isinstance(record["_id"], bson.ObjectId):
+        record["_id"] = {"$oid" : str(record["_id"])}
+      yield record
+
+  def insert_records(self, name, records):
+    # records without an _id would get a new ObjectId every time they're
+    # restored, so they are identified by their timestamp instead. NOTE: this
+    # lookup is unindexed while the indexes are dropped during a restore.
+    timestamps = [r["timestamp"] for r in records if "_id" not in r and "timestamp" in r]
+    existing = set()
+    if timestamps:
+      existing = set(self.db[name].distinct("timestamp", {"timestamp": {"$in": timestamps}}))
+
+    ops = []
+    for record in records:
+      _id = record.get("_id")
+      if isinstance(_id, dict) and "$oid" in _id:
+        record["_id"] = bson.ObjectId(_id["$oid"])
+        ops.append(pymongo.InsertOne(record))
+      elif _id is not None:
+        ops.append(pymongo.ReplaceOne({"_id": _id}, record, upsert = True))
+      elif "timestamp" in record:
+        if record["timestamp"] not in existing:
+          existing.add(record["timestamp"])
+          ops.append(pymongo.InsertOne(record))
+      else:
+        ops.append(pymongo.InsertOne(record))
+
+    if not ops:
+      return 0
+
+    try:
+      res = self.db[name].bulk_write(ops, ordered = False)
+      return res.inserted_count + res.upserted_count + res.modified_count
+
+    except pymongo.errors.BulkWriteError as e:
+      # ignore records that already exist (e.g. from overlapping dumps)
+      if any(err["code"] != 11000 for err in e.details["writeErrors"]):
+        raise
+      d = e.details
+      return d["nInserted"] + d["nUpserted"] + d["nModified"]
+
+  def drop_indexes(self):
+    for name in self.collection_names():
+      self.db[name].drop_indexes()
+
+  def oldest_timestamp(self, name):
+    oldest = self.db[name].find_one(
+        sort = [("timestamp", pymongo.ASCENDING)], projection = {"timestamp": True}
+        )
+    return None if oldest is None else oldest["timestamp"]
+
+  def delete_range(self, name, r):
+    (start, end) = r
+    res = self.db[name].delete_many({"timestamp": {"$gte": start, "$lt": end}})
+    return res.deleted_count if res.acknowledged else 0
+
+  def drop_collection(self, name):
+    self.db.drop_collection(name)
+
+  def count_dummy(self):
+    return self.datacollection.count_documents({DUMMY_TAG: {"$exists" : True}})
+
+  def dummy_range(self):
+    query = {DUMMY_TAG: {"$exists" : True}}
+    first = self.datacollection.find_one(query, sort = [("timestamp", pymongo.ASCENDING)])
+    if first is None:
+      return None
+    last = self.datacollection.find_one(query, sort = [("timestamp", pymongo.DESCENDING)])
+    return (first["timestamp"], last["timestamp"])
+
+  def _delete_dummy(self):
+    res = self.datacollection.delete_many({DUMMY_TAG: {"$exists" : True}})
+    return res.deleted_count if res.acknowledged else 0
+
+
+"""
+Convert a list of rows of values into a dictionary field name: numpy array.
+"""
+def _to_columns(values, fields):
+  # transpose and copy, so that each column is contiguous
+  arr = np.array(values, dtype = float).reshape(-1, len(fields)).T.copy()
+  return {f: arr[i] for i, f in enumerate(fields)}
+
+"""
+Recursively collect the names of the stages from an explain() result, ignoring
+rejected plans.
+"""
+def _winning_plan_stages(explain_result):
+  stages = []
+
+  if isinstance(explain_result, dict):
+    for k, v in explain_result.items():
+      if k == "rejectedPlans":
+        continue
+      if k == "stage":
+        stages.append(v)
+      else:
+        stages.extend(_winning_plan_stages(v))
+
+  elif isinstance(explain_result, list):
+    for v in explain_result:
+      stages.extend(_winning_plan_stages(v))
+
+  return stages
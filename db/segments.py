@@ -0,0 +1,270 @@
+"""
+An append-only store of the measurement history in fixed-width binary segments,
+for analytics and plotting which only need the timestamps and values and would
+otherwise spend most of their time decoding documents.
+
+The segments are stored column by column: for each day (UTC) and each field in
+FIELDS there is a file YYYY-MM-DD.<field> containing the little-endian values
+of that field in ascending time order, e.g. the float64 timestamps in
+YYYY-MM-DD.timestamp. Reading a column is therefore a contiguous read, and the
+segments of recently read days are kept memory mapped, so reading a short range
+returns numpy views of the files without copying or decoding anything.
+
+The store is enabled by setting segment_path in the [database] section of the
+configuration. Data points are appended by kahvid in addition to inserting them
+into the database. As the segments can't be cleaned, dummy data points are not
+stored.
+"""
+import numpy as np
+import collections
+import os
+import time
+import calendar
+
+from . import DUMMY_TAG
+
+# the stored fields and their types
+FIELDS = [
+    ("timestamp", np.dtype("<f8")),
+    ("nCups", np.dtype("<f4")),
+    ("rawValue", np.dtype("<f4")),
+    ]
+
+# the record layout of the segment files of earlier versions, which stored the
+# fields interleaved in a single YYYY-MM-DD.seg file per day. These are
+# converted to columns when the store is opened.
+RECORD_DTYPE = np.dtype(FIELDS)
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# the maximum number of days whose segments are kept memory mapped. Each
+# mapped column holds a file descriptor while it's mapped.
+MAX_MAPPED_DAYS = 32
+
+class SegmentStore():
+  def __init__(self, path):
+    self.path = path
+    if not os.path.exists(path):
+      os.makedirs(path)
+
+    # memory maps of the segments, as day: (number of records, {field: memmap}),
+    # the least recently used first
+    self._maps = collections.OrderedDict()
+
+    self._convert_record_segments()
+
+  def segment_path(self, day, field):
+    return os.path.join(
+        self.path,
+        time.strftime("%Y-%m-%d", time.gmtime(day * SECONDS_PER_DAY)) + "." + field
+        )
+
+  """
+  Return the days (as days since the epoch) that have a segment, in ascending
+  order.
+  """
+  def days(self):
+    days = []
+    for fname in os.listdir(self.path):
+      if fname.endswith(".timestamp"):
+        days.append(calendar.timegm(time.strptime(fname[:-len(".timestamp")], "%Y-%m-%d")) // SECONDS_PER_DAY)
+    return sorted(days)
+
+  """
+  Return the number of complete records of the given day, i.e. the length of
+  the shortest column. The columns may differ in length after e.g. a crash
+  during appending.
+  """
+  def _length(self, day):
+    n = None
+    for field, dtype in FIELDS:
+      try:
+        size = os.path.getsize(self.segment_path(day, field))
+      except OSError:
+        return 0
+      n = size // dtype.itemsize if n is None else min(n, size // dtype.itemsize)
+    return n
+
+  """
+  Append the given data point dictionaries to the segments of their days. The
+  data points must be newer than the ones already stored. Missing values are
+  stored as NaN.
+  """
+  def append(self, datapoints):
+    datapoints = [d for d in datapoints if not d.get(DUMMY_TAG)]
+    if not datapoints:
+      return
+
+    datapoints = sorted(datapoints, key = lambda d: d["timestamp"])
+    columns = {
+        field: np.array([d.get(field, np.nan) for d in datapoints], dtype = dtype)
+        for field, dtype in FIELDS
+        }
+
+    days = (columns["timestamp"] // SECONDS_PER_DAY).astype(int)
+    # indices where the day changes
+    bounds = [0] + list(np.flatnonzero(np.diff(days)) + 1) + [len(days)]
+
+    for i, j in zip(bounds[:-1], bounds[1:]):
+      day = int(days[i])
+      # drop a partially appended record, so that the columns stay aligned
+      n = self._length(day)
+
+      for field, dtype in FIELDS:
+        fname = self.segment_path(day, field)
+        with open(fname, "ab") as f:
+          f.truncate(n * dtype.itemsize)
+          f.write(columns[field][i:j].tobytes())
+
+  """
+  Return a dictionary field: read-only memory map of the segment of the given
+  day, or None if there is no data for that day. The maps of the least
+  recently read days are released when more than MAX_MAPPED_DAYS are mapped.
+  """
+  def _map_segment(self, day):
+    n = self._length(day)
+    if n == 0:
+      return None
+
+    cached = self._maps.pop(day, None)
+    if cached is not None and cached[0] == n:
+      self._maps[day] = cached
+      return cached[1]
+
+    maps = {
+        field: np.memmap(self.segment_path(day, field), dtype = dtype, mode = "r", shape = (n,))
+        for field, dtype in FIELDS
+        }
+    self._maps[day] = (n, maps)
+
+    while len(self._maps) > MAX_MAPPED_DAYS:
+      _, (_, evicted) = self._maps.popitem(last = False)
+      _release(evicted)
+
+    return maps
+
+  """
+  Read the records i to j of the given day, which has n records, into memory
+  without mapping the files. Returns a dictionary field name: numpy array.
+  """
+  def _read_segment(self, day, n, i = 0, j = None):
+    j = n if j is None else j
+    columns = {}
+    for field, dtype in FIELDS:
+      with open(self.segment_path(day, field), "rb") as f:
+        f.seek(i * dtype.itemsize)
+        columns[field] = np.fromfile(f, dtype = dtype, count = j - i)
+    return columns
+
+  """
+  Return the records within the tuple (start, end), inclusive, as a list of
+  dictionaries field name: numpy array, one per day. For ranges of at most
+  MAX_MAPPED_DAYS days, the arrays are views of the memory mapped segments,
+  so nothing is copied until the values are used. Longer ranges are read into
+  memory instead, so that they don't hold a file descriptor per day. If
+  concatenate is True, return a single dictionary of contiguous arrays.
+  """
+  def read_range(self, r, concatenate = False):
+    (start, end) = r
+
+    first_day = int(start // SECONDS_PER_DAY)
+    last_day = int(end // SECONDS_PER_DAY)
+
+    days = [day for day in self.days() if first_day <= day <= last_day]
+    mapped = not concatenate and len(days) <= MAX_MAPPED_DAYS
+
+    parts = []
+    for day in days:
+      if mapped:
+        columns = self._map_segment(day)
+        if columns is None:
+          continue
+        t = columns["timestamp"]
+      else:
+        n = self._length(day)
+        if n == 0:
+          continue
+        with open(self.segment_path(day, "timestamp"), "rb") as f:
+          t = np.fromfile(f, dtype = FIELDS[0][1], count = n)
+
+      i = np.searchsorted(t, start, side = "left")
+      j = np.searchsorted(t, end, side = "right")
+      if j <= i:
+        continue
+
+      if mapped:
+        parts.append({field: columns[field][i:j] for field, _ in FIELDS})
+      else:
+        part = self._read_segment(day, n, i, j)
+        part["timestamp"] = t[i:j]
+        parts.append(part)
+
+    if concatenate:
+      return {
+          field: np.concatenate([p[field] for p in parts]) if parts else np.empty(0, dtype = dtype)
+          for field, dtype in FIELDS
+          }
+
+    return parts
+
+  """
+  Replace the given field of the records with start <= timestamp < end, where
+  (start, end) = r, by the result of fun, which gets the records as a
+  dictionary field name: numpy array and returns an array of the new values.
+  The segments are modified in place through writable memory maps. Used e.g.
+  for recomputing nCups after a change of calibration.
+  """
+  def update_range(self, r, field, fun):
+    (start, end) = r
+
+    for day in self.days():
+      # NOTE: the range may be infinite, so compare times instead of days
+      if day * SECONDS_PER_DAY >= end or (day + 1) * SECONDS_PER_DAY <= start:
+        continue
+
+      n = self._length(day)
+      if n == 0:
+        continue
+
+      columns = self._read_segment(day, n)
+      t = columns["timestamp"]
+      i = np.searchsorted(t, start, side = "left")
+      j = np.searchsorted(t, end, side = "left")
+      if j <= i:
+        continue
+
+      dtype = dict(FIELDS)[field]
+      m = np.memmap(self.segment_path(day, field), dtype = dtype, mode = "r+", shape = (n,))
+      m[i:j] = fun({f: c[i:j] for f, c in columns.items()})
+      m.flush()
+      _release({field: m})
+
+  """
+  Convert the segment files of earlier versions (YYYY-MM-DD.seg, see
+  RECORD_DTYPE) into columns.
+  """
+  def _convert_record_segments(self):
+    for fname in sorted(os.listdir(self.path)):
+      if not fname.endswith(".seg"):
+        continue
+
+      path = os.path.join(self.path, fname)
+      records = np.fromfile(path, dtype = RECORD_DTYPE)
+      # the old segments were written with the same day boundaries
+      day = calendar.timegm(time.strptime(fname[:-len(".seg")], "%Y-%m-%d")) // SECONDS_PER_DAY
+      for field, dtype in FIELDS:
+        with open(self.segment_path(day, field), "wb") as f:
+          f.write(np.ascontiguousarray(records[field], dtype = dtype).tobytes())
+      os.remove(path)
+
+"""
+Close the memory maps in the dictionary maps, unless they are still used by
+views returned earlier, in which case they are closed when the views are
+garbage collected.
+"""
+def _release(maps):
+  for m in maps.values():
+    try:
+      m._mmap.close()
+    except (BufferError, AttributeError):
+      pass
@@ -0,0 +1,540 @@
+"""
+An embedded SQLite storage backend, an alternative to running a mongodb server
+on small devices. The database is a single file, which is opened in WAL mode so
+that readers (e.g. the web server) don't block the measurement daemon.
+
+The tables are named like the mongodb collections. The data points are stored
+as JSON documents with the timestamp as the primary key, and the fields used
+for querying are additionally stored as columns, so that range queries which
+only need them don't have to decode the documents. The rollup tables contain
+the same fields as the rollup collections, with the bucket start as the
+primary key.
+"""
+import sqlite3
+import threading
+import json
+import time
+import os
+import numpy as np
+
+from . import DatabaseManager, ROLLUP_TIERS, ROLLUP_FIELDS, DUMMY_TAG, whole_buckets
+
+# the fields stored as columns in the data table in addition to the document
+DATA_COLUMNS = ["timestamp"] + ROLLUP_FIELDS
+
+"""
+Return the path of the database file given by the configuration dictionary
+config_dict: sqlite_path, or db/<dbname>.sqlite if it's empty.
+"""
+def database_path(config_dict):
+  db_config = config_dict["database"]
+  path = db_config["sqlite_path"]
+  if not path:
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), db_config["dbname"] + ".sqlite")
+  return path
+
+"""
+A database manager storing the data in an SQLite database file.
+"""
+class SQLiteDatabaseManager(DatabaseManager):
+
+  def __init__(self, config_dict, dummy = False):
+    super().__init__(config_dict, dummy)
+
+    if dummy:
+      return
+
+    self.path = database_path(config_dict)
+
+    # sqlite connections can't be shared between threads, so each thread
+    # (e.g. of the web server) gets its own connection.
+    self._local = threading.local()
+
+    self.rollup_tables = ["data-" + name for name, _ in ROLLUP_TIERS]
+    self.rollup_table_by_width = {w: "data-" + name for name, w in ROLLUP_TIERS}
+
+    self._create_tables()
+    self.ensure_indexes()
+
+  """
+  Return the connection of the current thread, creating it if necessary.
+  """
+  @property
+  def connection(self):
+    conn = getattr(self._local, "connection", None)
+    if conn is None:
+      conn = sqlite3.connect(self.path, timeout = 10.)
+      conn.row_factory = sqlite3.Row
+      conn.execute("PRAGMA journal_mode = WAL")
+      # with WAL, this is safe against corruption and much faster than FULL.
+      conn.execute("PRAGMA synchronous = NORMAL")
+      self._local.connection = conn
+    return conn
+
+  def _create_tables(self):
+    rollup_columns = ", ".join(
+        "{0}Sum REAL, {0}Min REAL, {0}Max REAL".format(field) for field in ROLLUP_FIELDS
+        )
+
+    with self.connection as conn:
+      conn.execute(
+          'CREATE TABLE IF NOT EXISTS "data" ('
+          'timestamp REAL PRIMARY KEY, nCups REAL, rawValue REAL, {} INTEGER, doc TEXT NOT NULL'
+          ') WITHOUT ROWID'.format(DUMMY_TAG)
+          )
+      conn.execute(
+          'CREATE TABLE IF NOT EXISTS "data-latest" (id INTEGER PRIMARY KEY, doc TEXT NOT NULL)'
+          )
+      for table in self.rollup_tables:
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS "{}" (timestamp REAL PRIMARY KEY, count INTEGER, {}) WITHOUT ROWID'
+            .format(table, rollup_columns)
+            )
+      conn.execute(
+          'CREATE TABLE IF NOT EXISTS "calibration-latest" (id INTEGER PRIMARY KEY, doc TEXT NOT NULL)'
+          )
+      conn.execute(
+          'CREATE TABLE IF NOT EXISTS "calibration-history" (timestamp REAL, doc TEXT NOT NULL)'
+          )
+
+  ############
+  # INDEXING #
+  ############
+
+  """
+  The data and rollup tables are ordered by their primary key, the timestamp,
+  so only the dummy tag and the calibration history need indexes.
+  """
+  def ensure_indexes(self):
+    with self.connection as conn:
+      # only dummy entries have the dummy tag, so a partial index stays small.
+      conn.execute(
+          'CREATE INDEX IF NOT EXISTS "data-{0}" ON "data" ({0}) WHERE {0} IS NOT NULL'
+          .format(DUMMY_TAG)
+          )
+      conn.execute(
+          'CREATE INDEX IF NOT EXISTS "calibration-history-timestamp" ON "calibration-history" (timestamp)'
+          )
+
+  """
+  Run EXPLAIN QUERY PLAN on the queries that are run often or on large tables.
+  A plan step that scans a whole table without using an index, or sorts the
+  whole table, is marked as 'COLLSCAN'.
+  """
+  def explain_queries(self):
+    t = time.time()
+
+    queries = [
+        ("range query on data",
+          'SELECT * FROM "data" WHERE timestamp BETWEEN ? AND ? ORDER BY timestamp',
+          (t - 3600, t)),
+        ]
+    for name, width in ROLLUP_TIERS:
+      queries.append((
+        "range query on data-" + name,
+        'SELECT * FROM "data-{}" WHERE timestamp BETWEEN ? AND ? ORDER BY timestamp'.format(name),
+        (t - 1000 * width, t)
+        ))
+    queries.append((
+      "dummy entries in data",
+      'SELECT * FROM "data" WHERE {} IS NOT NULL'.format(DUMMY_TAG),
+      ()
+      ))
+    queries.append((
+      "latest entries in data (dump)",
+      'SELECT * FROM "data" ORDER BY timestamp DESC LIMIT 1',
+      ()
+      ))
+
+    explained = []
+    for desc, sql, params in queries:
+      stages = []
+      for row in self.connection.execute("EXPLAIN QUERY PLAN " + sql, params):
+        detail = row["detail"]
+        filtered = "WHERE" in sql
+        if ("TEMP B-TREE" in detail or
+            (filtered and detail.startswith("SCAN") and "INDEX" not in detail)):
+          stages.append("COLLSCAN ({})".format(detail))
+        else:
+          stages.append(detail)
+      explained.append((desc, stages))
+
+    return explained
+
+
+  #############
+  # INSERTING #
+  #############
+
+  def _store_datapoints(self, datapoints, rollups, latest):
+    rows = [
+        [d["timestamp"]] + [d.get(f) for f in ROLLUP_FIELDS] +
+        [1 if d.get(DUMMY_TAG) else None, json.dumps(d)]
+        for d in datapoints
+        ]
+
+    fields = ["count"]
+    for field in ROLLUP_FIELDS:
+      fields += [field + "Sum", field + "Min", field + "Max"]
+
+    updates = []
+    for f in fields:
+      if f.endswith("Min"):
+        updates.append("{0} = min({0}, excluded.{0})".format(f))
+      elif f.endswith("Max"):
+        updates.append("{0} = max({0}, excluded.{0})".format(f))
+      else:
+        updates.append("{0} = {0} + excluded.{0}".format(f))
+
+    # everything is written in a single transaction.
+    with self.connection as conn:
+      conn.executemany(
+          'INSERT INTO "data" (timestamp, nCups, rawValue, {}, doc) VALUES (?, ?, ?, ?, ?)'
+          .format(DUMMY_TAG),
+          rows
+          )
+
+      for width, buckets in rollups:
+        conn.executemany(
+            'INSERT INTO "{}" (timestamp, {}) VALUES (?, {}) ON CONFLICT (timestamp) DO UPDATE SET {}'.format(
+              self.rollup_table_by_width[width],
+              ", ".join(fields),
+              ", ".join("?" for _ in fields),
+              ", ".join(updates)
+              ),
+            [[t] + [b[f] for f in fields] for t, b in buckets.items()]
+            )
+
+      conn.execute(
+          'INSERT OR REPLACE INTO "data-latest" (id, doc) VALUES (0, ?)',
+          (json.dumps(latest),)
+          )
+
+  def _rebuild_rollups(self, r):
+    aggregates = ["COUNT(*)"]
+    for field in ROLLUP_FIELDS:
+      aggregates += ["SUM({})".format(field), "MIN({})".format(field), "MAX({})".format(field)]
+
+    not_null = " AND ".join("{} IS NOT NULL".format(field) for field in ROLLUP_FIELDS)
+
+    n_written = 0
+
+    with self.connection as conn:
+      for table, (_, width) in zip(self.rollup_tables, ROLLUP_TIERS):
+
+        # extend the range to whole buckets so that no bucket is left partial
+        start, end = whole_buckets(r, width)
+        conn.execute('DELETE FROM "{}" WHERE timestamp >= ? AND timestamp < ?'.format(table), (start, end))
+        where, params = not_null + " AND timestamp >= ? AND timestamp < ?", (start, end)
+
+        # NOTE: the % operator of sqlite works on integers, so use division.
+        bucket = "CAST(timestamp / {0} AS INTEGER) * {0}".format(width)
+        cur = conn.execute(
+            'INSERT INTO "{}" SELECT {} AS bucket, {} FROM "data" WHERE {} GROUP BY bucket'
+            .format(table, bucket, ", ".join(aggregates), where),
+            params
+            )
+        n_written += cur.rowcount
+
+    return n_written
+
+  def _get_latest_calibration(self):
+    row = self.connection.execute('SELECT doc FROM "calibration-latest" WHERE id = 0').fetchone()
+    return None if row is None else json.loads(row["doc"])
+
+  def _store_calibration(self, calibration_dict, timestamp):
+    doc = json.dumps(calibration_dict)
+    with self.connection as conn:
+      conn.execute('INSERT OR REPLACE INTO "calibration-latest" (id, doc) VALUES (0, ?)', (doc,))
+      conn.execute('INSERT INTO "calibration-history" (timestamp, doc) VALUES (?, ?)', (timestamp, doc))
+
+  def calibration_history(self):
+    return [
+        (row["timestamp"], json.loads(row["doc"]))
+        for row in self.connection.execute('SELECT timestamp, doc FROM "calibration-history" ORDER BY timestamp')
+        ]
+
+  """
+  The chunks are read with separate queries continuing from the last
+  timestamp, so that updating the data between chunks is safe.
+  """
+  def _iter_column_chunks(self, r, fields, chunk_size):
+    (start, end) = r
+
+    columns = [
+        f if f in DATA_COLUMNS else "json_extract(doc, '$.{}')".format(f)
+        for f in fields
+        ]
+    sql = 'SELECT timestamp, {} FROM "data" WHERE timestamp {} ? AND timestamp < ? ORDER BY timestamp LIMIT {:d}'
+
+    op = ">="
+    while True:
+      rows = self.connection.execute(
+          sql.format(", ".join(columns), op, chunk_size), (start, end)
+          ).fetchall()
+      if not rows:
+        return
+
+      # NULLs become NaN. Transpose and copy, so that each column is contiguous.
+      arr = np.array([tuple(row)[1:] for row in rows], dtype = float).reshape(-1, len(fields)).T.copy()
+      yield [row[0] for row in rows], {f: arr[i] for i, f in enumerate(fields)}
+
+      start = rows[-1][0]
+      op = ">"
+
+  def _update_columns(self, keys, columns):
+    fields = list(columns)
+
+    # the values are set in the document, and in the columns which duplicate
+    # the document fields. Booleans have to be converted to JSON explicitly.
+    paths = []
+    for f in fields:
+      if columns[f].dtype == bool:
+        paths.append("'$.{}', json(CASE ? WHEN 1 THEN 'true' ELSE 'false' END)".format(f))
+      else:
+        paths.append("'$.{}', ?".format(f))
+    assignments = ["doc = json_set(doc, {})".format(", ".join(paths))]
+    assignments += ["{} = ?".format(f) for f in fields if f in DATA_COLUMNS]
+
+    values = [columns[f].tolist() for f in fields]
+    values += [columns[f].tolist() for f in fields if f in DATA_COLUMNS]
+    rows = zip(*values, keys)
+
+    with self.connection as conn:
+      conn.executemany(
+          'UPDATE "data" SET {} WHERE timestamp = ?'.format(", ".join(assignments)),
+          rows
+          )
+
+
+  ############
+  # QUERYING #
+  ############
+
+  def _query_latest(self):
+    row = self.connection.execute('SELECT doc FROM "data-latest" WHERE id = 0').fetchone()
+    return None if row is None else json.loads(row["doc"])
+
+  """
+  If the projection only includes fields that are stored as columns, the
+  documents are not decoded at all.
+  """
+  def _query_raw_range(self, r, projection = {}, limit = 0):
+    (start, end) = r
+
+    included = [k for k, v in projection.items() if v and k != "_id"]
+    excluded = [k for k, v in projection.items() if not v and k != "_id"]
+
+    sql = 'SELECT {} FROM "data" WHERE timestamp BETWEEN ? AND ? ORDER BY timestamp'
+    if limit:
+      sql += " LIMIT {:d}".format(limit)
+
+    if included and all(k in DATA_COLUMNS for k in included):
+      cur = self.connection.execute(sql.format(", ".join(included)), (start, end))
+      return (dict(row) for row in cur)
+
+    cur = self.connection.execute(sql.format("doc"), (start, end))
+    return (_project(json.loads(row["doc"]), included, excluded) for row in cur)
+
+  def _query_rollup_range(self, width, r, projection = {}, limit = 0):
+    (start, end) = r
+
+    columns = ["timestamp", "count"]
+    for field in ROLLUP_FIELDS:
+      columns += [
+          "{0}Sum / count AS {0}".format(field),
+          "{}Min".format(field),
+          "{}Max".format(field),
+          ]
+
+    sql = 'SELECT {} FROM "{}" WHERE timestamp >= ? AND timestamp <= ? ORDER BY timestamp'.format(
+        ", ".join(columns), self.rollup_table_by_width[width]
+        )
+    if limit:
+      sql += " LIMIT {:d}".format(limit)
+
+    included = [k for k, v in projection.items() if v and k != "_id"]
+
+    # include the bucket containing the start of the range
+    cur = self.connection.execute(sql, (start - start % width, end))
+    return (_project(dict(row), included, []) for row in cur)
+
+  def _query_buckets(self, width, source_width, r, minmax, field):
+    (start, end) = r
+
+    if source_width is None:
+      table = "data"
+      aggregates = ["COUNT({0})", "SUM({0})", "MIN({0})", "MAX({0})"]
+    else:
+      table = self.rollup_table_by_width[source_width]
+      aggregates = ["SUM(count)", "SUM({0}Sum)", "MIN({0}Min)", "MAX({0}Max)"]
+    aggregates = [a.format(field) for a in aggregates]
+
+    # NOTE: the % operator of sqlite works on integers, so use division.
+    columns = ["CAST(timestamp / :w AS INTEGER) * :w AS timestamp", "{} AS count".format(aggregates[0]),
+        "{} / {} AS {}".format(aggregates[1], aggregates[0], field)]
+    if minmax:
+      columns += [
+          "{} AS {}Min".format(aggregates[2], field),
+          "{} AS {}Max".format(aggregates[3], field),
+          ]
+
+    # group and sort by the first column, the bucket
+    cur = self.connection.execute(
+        'SELECT {} FROM "{}" '
+        'WHERE timestamp >= :start AND timestamp <= :end AND {} IS NOT NULL '
+        'GROUP BY 1 ORDER BY 1'.format(
+          ", ".join(columns), table, "count" if source_width else field
+          ),
+        {"w": width, "start": start - start % width, "end": end}
+        )
+    return (dict(row) for row in cur)
+
+
+  ########################
+  # DUMPING AND CLEANING #
+  ########################
+
+  def database_id(self):
+    return "sqlite:" + os.path.abspath(self.path)
+
+  def collection_names(self):
+    return [
+        row["name"] for row in self.connection.execute(
+          "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+          )
+        ]
+
+  def iter_collection(self, name, count = None, since = None, batch_size = None):
+    # use a separate connection, so that iterating doesn't interfere with
+    # other queries.
+    conn = sqlite3.connect(self.path, timeout = 10.)
+    conn.row_factory = sqlite3.Row
+
+    try:
+      columns = [row["name"] for row in conn.execute('PRAGMA table_info("{}")'.format(name))]
+
+      sql = 'SELECT * FROM "{}"'.format(name)
+      params = ()
+      if since is not None and "timestamp" in columns:
+        sql += " WHERE timestamp > ?"
+        params = (since,)
+      if count is not None and "timestamp" in columns:
+        sql += " ORDER BY timestamp DESC LIMIT {:d}".format(count)
+
+      for row in conn.execute(sql, params):
+        yield _row_to_record(name, dict(row))
+
+    finally:
+      conn.close()
+
+  def insert_records(self, name, records):
+    if name == "data":
+      rows = [
+          [d["timestamp"]] + [d.get(f) for f in ROLLUP_FIELDS] +
+          [1 if d.get(DUMMY_TAG) else None, json.dumps(d)]
+          for d in records
+          ]
+      sql = 'INSERT OR IGNORE INTO "data" (timestamp, nCups, rawValue, {}, doc) VALUES (?, ?, ?, ?, ?)'.format(DUMMY_TAG)
+
+    elif name == "data-latest":
+      rows = [(json.dumps({k: v for k, v in d.items() if k != "_id"}),) for d in records]
+      sql = 'INSERT OR REPLACE INTO "data-latest" (id, doc) VALUES (0, ?)'
+
+    elif name == "calibration-latest":
+      rows = [(json.dumps(d["calibrationDict"]),) for d in records]
+      sql = 'INSERT OR REPLACE INTO "calibration-latest" (id, doc) VALUES (0, ?)'
+
+    elif name == "calibration-history":
+      rows = [(d["timestamp"], json.dumps(d["calibrationDict"]), d["timestamp"]) for d in records]
+      sql = ('INSERT INTO "calibration-history" (timestamp, doc) SELECT ?, ? '
+             'WHERE NOT EXISTS (SELECT 1 FROM "calibration-history" WHERE timestamp = ?)')
+
+    elif name in self.rollup_tables:
+      fields = ["timestamp", "count"]
+      for field in ROLLUP_FIELDS:
+        fields += [field + "Sum", field + "Min", field + "Max"]
+      rows = [[d.get(f) for f in fields] for d in records]
+      sql = 'INSERT OR REPLACE INTO "{}" ({}) VALUES ({})'.format(
+          name, ", ".join(fields), ", ".join("?" for _ in fields)
+          )
+
+    else:
+      raise ValueError("Unknown table: {}".format(name))
+
+    with self.connection as conn:
+      before = conn.total_changes
+      conn.executemany(sql, rows)
+      return conn.total_changes - before
+
+  def drop_indexes(self):
+    with self.connection as conn:
+      conn.execute('DROP INDEX IF EXISTS "data-{}"'.format(DUMMY_TAG))
+      conn.execute('DROP INDEX IF EXISTS "calibration-history-timestamp"')
+
+  def oldest_timestamp(self, name):
+    return self.connection.execute('SELECT MIN(timestamp) FROM "{}"'.format(name)).fetchone()[0]
+
+  def delete_range(self, name, r):
+    with self.connection as conn:
+      cur = conn.execute('DELETE FROM "{}" WHERE timestamp >= ? AND timestamp < ?'.format(name), r)
+    return cur.rowcount
+
+  def drop_collection(self, name):
+    with self.connection as conn:
+      conn.execute('DROP TABLE IF EXISTS "{}"'.format(name))
+    # mongodb creates collections when they're first used, so recreate the
+    # table empty to keep the database usable.
+    self._create_tables()
+    self.ensure_indexes()
+
+  def count_dummy(self):
+    return self.connection.execute(
+        'SELECT COUNT(*) FROM "data" WHERE {} IS NOT NULL'.format(DUMMY_TAG)
+        ).fetchone()[0]
+
+  def dummy_range(self):
+    row = self.connection.execute(
+        'SELECT MIN(timestamp), MAX(timestamp) FROM "data" WHERE {} IS NOT NULL'.format(DUMMY_TAG)
+        ).fetchone()
+    return None if row[0] is None else (row[0], row[1])
+
+  def _delete_dummy(self):
+    with self.connection as conn:
+      cur = conn.execute('DELETE FROM "data" WHERE {} IS NOT NULL'.format(DUMMY_TAG))
+    return cur.rowcount
+
+
+"""
+Convert a row of the given table into a record in the same format as the
+corresponding mongodb document.
+"""
+def _row_to_record(table, row):
+  if table == "data":
+    return json.loads(row["doc"])
+
+  if table == "data-latest":
+    return dict(json.loads(row["doc"]), _id = 0)
+
+  if table == "calibration-latest":
+    return {"_id": 0, "calibrationDict": json.loads(row["doc"])}
+
+  if table == "calibration-history":
+    return {"timestamp": row["timestamp"], "calibrationDict": json.loads(row["doc"])}
+
+  if table.startswith("data-"):
+    # rollups use the bucket start as the id
+    row["_id"] = row["timestamp"]
+
+  return row
+
+"""
+Apply a projection to a document, given the lists of included and excluded
+fields.
+"""
+def _project(doc, included, excluded):
+  if included:
+    return {k: doc[k] for k in included if k in doc}
+  for k in excluded:
+    doc.pop(k, None)
+  return doc
@@ -0,0 +1,317 @@
+"""
+Latency and size metrics of the web server and its database queries, for
+finding out where the time goes when requests are slow. The metrics are kept
+in memory and served in the Prometheus text format, see
+https://prometheus.io/docs/instrumenting/exposition_formats/
+
+Nothing is instrumented unless the metrics are enabled (metrics in the
+[webserver] section of the configuration), as the instrument_* functions
+replace the measured functions with wrappers only when called.
+"""
+
+import threading
+import time
+
+# the default histogram buckets, for latencies in seconds
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.
+    )
+
+# histogram buckets for sizes in bytes
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# histogram buckets for numbers of documents
+COUNT_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+"""
+A collection of metrics, rendered together with render.
+"""
+class Registry():
+  def __init__(self):
+    self._lock = threading.Lock()
+    # name: metric, in the order of registration
+    self._metrics = {}
+    self._collectors = []
+
+  """
+  Return the counter with the given name, creating it if needed. labels is a
+  list of the label names, whose values are given when incrementing.
+  """
+  def counter(self, name, help, labels = ()):
+    return self._get(Counter, name, help, labels)
+
+  """
+  Return the histogram with the given name, creating it if needed.
+  """
+  def histogram(self, name, help, labels = (), buckets = LATENCY_BUCKETS):
+    return self._get(Histogram, name, help, labels, buckets)
+
+  def _get(self, cls, name, *args):
+    with self._lock:
+      if name not in self._metrics:
+        self._metrics[name] = cls(name, *args)
+      return self._metrics[name]
+
+  """
+  Add gauges (or counters, whose names are listed in counters) read from the
+  dictionary returned by stats when rendering, e.g. RangeCache.stats. Each key
+  becomes a metric named prefix_key. stats may return None if there's nothing
+  to report.
+  """
+  def add_stats(self, prefix, help, stats, counters = ()):
+    self._collectors.append((prefix, help, stats, counters))
+
+  """
+  Return the metrics in the Prometheus text format.
+  """
+  def render(self):
+    lines = []
+    with self._lock:
+      metrics = list(self._metrics.values())
+
+    for metric in metrics:
+      lines += metric.render()
+
+    for prefix, help, stats, counters in self._collectors:
+      values = stats()
+      if not values:
+        continue
+      for key, value in values.items():
+        kind = "counter" if key in counters else "gauge"
+        name = "{}_{}{}".format(prefix, key, "_total" if kind == "counter" else "")
+        lines.append("# HELP {} {} ({})".format(name, help, key.replace("_", " ")))
+        lines.append("# TYPE {} {}".format(name, kind))
+        lines.append("{} {}".format(name, format_value(value)))
+
+    return "\n".join(lines) + "\n"
+
+class Counter():
+  def __init__(self, name, help, labels):
+    self.name = name
+    self.help = help
+    self.labels = tuple(labels)
+    self._lock = threading.Lock()
+    # label values: count
+    self._values = {}
+
+  def inc(self, *label_values, amount = 1):
+    with self._lock:
+      self._values[label_values] = self._values.get(label_values, 0) + amount
+
+  def render(self):
+    lines = [
+        "# HELP {} {}".format(self.name, self.help),
+        "# TYPE {} counter".format(self.name),
+        ]
+    with self._lock:
+      for label_values, value in sorted(self._values.items()):
+        lines.append("{}{} {}".format(
+            self.name, format_labels(self.labels, label_values), format_value(value)
+            ))
+    return lines
+
+class Histogram():
+  def __init__(self, name, help, labels, buckets):
+    self.name = name
+    self.help = help
+    self.labels = tuple(labels)
+    self.buckets = tuple(buckets)
+    self._lock = threading.Lock()
+    # label values: (count of each bucket and the overflow, sum)
+    self._values = {}
+
+  def observe(self, value, *label_values):
+    # the first bucket the value fits in, the counts are made cumulative when
+    # rendering.
+    i = 0
+    while i < len(self.buckets) and value > self.buckets[i]:
+      i += 1
+
+    with self._lock:
+      counts, total = self._values.get(label_values, (None, 0.))
+      if counts is None:
+        counts = [0] * (len(self.buckets) + 1)
+      counts[i] += 1
+      self._values[label_values] = (counts, total + value)
+
+  """
+  Measure the time spent within the with statement, e.g.
+    with histogram.time("data"):
+      ...
+  """
+  def time(self, *label_values):
+    return _Timer(self, label_values)
+
+  def render(self):
+    lines = [
+        "# HELP {} {}".format(self.name, self.help),
+        "# TYPE {} histogram".format(self.name),
+        ]
+    with self._lock:
+      values = sorted((k, (list(c), s)) for k, (c, s) in self._values.items())
+
+    for label_values, (counts, total) in values:
+      cumulative = 0
+      for bound, count in zip(self.buckets + (float("inf"),), counts):
+        cumulative += count
+        lines.append("{}_bucket{} {}".format(
+            self.name,
+            format_labels(self.labels + ("le",), label_values + (format_value(bound),)),
+            cumulative
+            ))
+      labels = format_labels(self.labels, label_values)
+      lines.append("{}_sum{} {}".format(self.name, labels, format_value(total)))
+      lines.append("{}_count{} {}".format(self.name, labels, cumulative))
+
+    return lines
+
+class _Timer():
+  def __init__(self, histogram, label_values):
+    self.histogram = histogram
+    self.label_values = label_values
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+
+  def __exit__(self, *exc_info):
+    self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+def format_labels(names, values):
+  if not names:
+    return ""
+  return "{" + ",".join(
+      '{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+      for n, v in zip(names, values)
+      ) + "}"
+
+def format_value(value):
+  if value == float("inf"):
+    return "+Inf"
+  if isinstance(value, bool):
+    return str(int(value))
+  return repr(value) if isinstance(value, float) else str(value)
+
+
+"""
+Measure the latency, status and response size of each request to the flask
+app, by endpoint. The latency includes streaming the response.
+"""
+def instrument_app(registry, app):
+  from flask import request, g
+
+  latency = registry.histogram("kahvi_http_request_duration_seconds",
+      "Time spent handling a request, including streaming the response.",
+      ["endpoint", "status"])
+  size = registry.histogram("kahvi_http_response_size_bytes",
+      "Size of the response body, after compression.",
+      ["endpoint"], buckets = SIZE_BUCKETS)
+
+  @app.before_request
+  def start_timer():
+    g.metrics_start = time.perf_counter()
+
+  @app.after_request
+  def observe(resp):
+    start = g.get("metrics_start")
+    if start is None:
+      return resp
+    endpoint = request.endpoint or "unknown"
+    status = str(resp.status_code)
+
+    if resp.is_streamed:
+      resp.response = _count_bytes(resp.response, size, endpoint)
+    else:
+      size.observe(resp.content_length or 0, endpoint)
+
+    resp.call_on_close(lambda: latency.observe(time.perf_counter() - start, endpoint, status))
+    return resp
+
+def _count_bytes(chunks, histogram, endpoint):
+  total = 0
+  try:
+    for chunk in chunks:
+      total += len(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+      yield chunk
+  finally:
+    histogram.observe(total, endpoint)
+
+"""
+Measure the time spent in the database queries of the database manager dbm,
+and the numbers of documents scanned and items returned by the database, by
+replacing its backend query methods with measuring wrappers. The range queries
+return cursors that are read lazily, so the time spent reading them is
+measured as well.
+
+The range queries scan the documents they return. The bucket queries scan the
+raw data points they aggregate, which is the sum of the counts of the buckets,
+or the rollup buckets they aggregate, which is estimated as the number of
+rollup buckets each returned bucket covers, assuming none are empty.
+"""
+def instrument_db(registry, dbm):
+  latency = registry.histogram("kahvi_db_query_duration_seconds",
+      "Time spent querying the database, including reading the results.",
+      ["query"])
+  returned = registry.histogram("kahvi_db_items_returned",
+      "Number of documents or buckets returned by the database per query.",
+      ["query"], buckets = COUNT_BUCKETS)
+  scanned = registry.histogram("kahvi_db_documents_scanned",
+      "Number of documents read by the database per query (estimated for buckets aggregated from rollups).",
+      ["query"], buckets = COUNT_BUCKETS)
+
+  if dbm.dummy:
+    return
+
+  def wrap_iterable(query, fun, scan_cost = None):
+    def wrapped(*args, **kwargs):
+      start = time.perf_counter()
+      result = fun(*args, **kwargs)
+      cost = scan_cost(*args, **kwargs) if scan_cost is not None else None
+      return _measure_iter(result, latency, returned, scanned, query, time.perf_counter() - start, cost)
+    return wrapped
+
+  # the number of documents scanned for each returned bucket
+  def bucket_scan_cost(width, source_width, *args, **kwargs):
+    if source_width is None:
+      return lambda bucket: bucket["count"]
+    covered = max(int(width // source_width), 1)
+    return lambda bucket: min(bucket["count"], covered)
+
+  def wrap_call(query, fun):
+    def wrapped(*args, **kwargs):
+      with latency.time(query):
+        return fun(*args, **kwargs)
+    return wrapped
+
+  dbm._query_raw_range = wrap_iterable("raw_range", dbm._query_raw_range)
+  dbm._query_rollup_range = wrap_iterable("rollup_range", dbm._query_rollup_range)
+  dbm._query_buckets = wrap_iterable("buckets", dbm._query_buckets, bucket_scan_cost)
+  dbm._query_latest = wrap_call("latest", dbm._query_latest)
+  if dbm.latest_cache is not None:
+    # the cache keeps a reference to the unwrapped method
+    dbm.latest_cache._fetch = dbm._query_latest
+
+"""
+Yield the items of iterable, measuring the time spent reading them. cost is a
+function returning the number of documents scanned for an item, or None if
+each item is a scanned document.
+"""
+def _measure_iter(iterable, latency, returned, scanned, query, elapsed, cost = None):
+  count = 0
+  n_scanned = 0
+  iterator = iter(iterable)
+  try:
+    while True:
+      start = time.perf_counter()
+      try:
+        item = next(iterator)
+      except StopIteration:
+        return
+      finally:
+        elapsed += time.perf_counter() - start
+      count += 1
+      n_scanned += 1 if cost is None else cost(item)
+      yield item
+  finally:
+    latency.observe(elapsed, query)
+    returned.observe(count, query)
+    scanned.observe(n_scanned, query)
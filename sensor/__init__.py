@@ -8,14 +8,16 @@ Needs to be run as root to access the GPIO pins.
 
 
 import time, os, sys, syslog
-#from math import sqrt
-from statistics import stdev, mean, median
+import numpy as np
 try:
   import config
 except ImportError:
   print("Could not import config, try adding the kiltiskahvi folder to your PYTHONPATH. Exiting.")
   sys.exit(1)
 
+from sensor.filters import FilterChain
+from sensor.sampling import Sampler
+
 # fall back to dummy driver if GPIO is not available
 try:
   from sensor.drivers import hx711 as driver
@@ -47,12 +49,31 @@ class Sensor():
 
     self.averaging_time = float(cfg_dict["general"]["averaging_time"])
 
+    # the filters reducing the samples of a poll to a single value
+    self.filters = FilterChain.from_config(cfg_dict)
+
+    # the samples of a poll, grown when needed
+    self._samples = np.empty(1024)
+
     # this attribute can be used to check if the GPIO module is working
     self.is_dummy = DUMMY_DRIVER
 
+    # sample continuously in the background, if enabled (see sensor/sampling.py)
+    self.sampler = None
+    sensor_config = cfg_dict["sensor"]
+    if sensor_config.getboolean("continuous_sampling"):
+      sample_interval = float(sensor_config["sample_interval"])
+      # keep twice the averaging time, for polls with a longer averaging time
+      capacity = int(2 * self.averaging_time / sample_interval) + 1
+      self.sampler = Sampler(driver.read_adc, sample_interval, capacity)
+      self.sampler.start()
+
   """
   The function that returns the sensor value after averaging,
   this is supposed to be called externally.
+  With continuous sampling, the samples of the last averaging_time seconds
+  are used and this returns immediately, avg_interval is ignored. Otherwise
+  the sensor is sampled every avg_interval seconds for averaging_time seconds.
   Returns: a dictionary containing the averaged raw sensor value and the
   current no. of cups we have determined to be in the coffee machine.
   """
@@ -60,31 +81,27 @@ class Sensor():
     if not averaging_time:
       averaging_time = self.averaging_time
 
-    start = time.time()
-
-    datapoints = []
+    if self.sampler is not None:
+      samples = self.sampler.samples(averaging_time)
+      n = len(samples)
 
-    while time.time() - start < averaging_time:
-      adc_result = driver.read_adc()
-      datapoints.append(adc_result)
+    else:
+      start = time.time()
 
-      time.sleep(avg_interval)
+      samples = self._samples
+      n = 0
 
+      while time.time() - start < averaging_time:
+        if n == len(samples):
+          samples = self._samples = np.concatenate((samples, np.empty(len(samples))))
 
-    #s = sum(datapoints)
-    n = len(datapoints)
-    #raw_value = s / n
+        samples[n] = driver.read_adc()
+        n += 1
 
-    # apply median filtering (NOTE: doesn't work if the erroneous result is at the edge...
-    datapoints.insert(0, datapoints[0])
-    datapoints.append(datapoints[-1])
-    datapoints = [median(datapoints[i:i+3]) for i in range(len(datapoints) - 2)]
+        time.sleep(avg_interval)
 
-    raw_value = mean(datapoints)
-
-    # standard deviation
-    #std = sqrt(sum([(x - raw_value) ** 2 for x in datapoints]) / (n - 1))
-    std = stdev(datapoints, raw_value)
+    # filter and average the samples, see sensor/filters.py
+    datapoints, raw_value, std = self.filters.reduce(samples[:n])
 
     nCups = self.compute_nCups(raw_value)
 
@@ -108,7 +125,7 @@ class Sensor():
 
     coffeeComing = False
     max_nCups = float(self.calibration["max_ncups"])
-    if nCups / max_nCups > 1.2: #TODO: make this magic number configurable?
+    if nCups / max_nCups > config.COFFEE_COMING_RATIO: #TODO: make this magic number configurable?
       # Simple method of detecting whether coffee is being made.
       # Assuming that the scale is at the back of the coffee maker, which means
       # that coffee is coming if the computed no. of cups exceeds the maximum.
@@ -116,11 +133,11 @@ class Sensor():
 
     nCups = max(min(nCups, max_nCups), 0)
 
-    relative_std = std / abs(raw_value)
+    relative_std = std / abs(raw_value) if raw_value else 0.
     if relative_std > 0.5:
       syslog.syslog(syslog.LOG_WARNING,
           "sensor: unusually high std. raw_value: {raw_value}, n: {n}, std: {std} (relative: {relative_std:.2f})".format(**locals()))
-      result["datapoints"] = datapoints[:] # store datapoints to investigate high stds...
+      result["datapoints"] = datapoints.tolist() # store datapoints to investigate high stds...
 
 
     result["rawValue"] = raw_value
@@ -133,6 +150,14 @@ class Sensor():
 
     return result
 
+  """
+  Stop the background sampling, if any. Must be done before cleaning up the
+  driver.
+  """
+  def stop(self):
+    if self.sampler is not None:
+      self.sampler.stop()
+
   """
   Compute the number of cups a given raw sensor value corresponds to, using the
   calibration parameters.
@@ -157,10 +182,8 @@ class Sensor():
 
     # TODO
     if True:
-      empty_val = float(cal["coffee_empty_decanter_value"])
-      full_val = float(cal["coffee_full_value"])
-      max_nCups = float(cal["max_ncups"])
-      nCups = (raw_value - empty_val) / (full_val - empty_val) * max_nCups
+      # the formula is shared with the recomputation of stored data, see db.
+      nCups = config.compute_nCups(raw_value, cal)
 
       ##TODO: make this magic number configurable???
       #if nCups / max_nCups >= 1.2:
@@ -198,5 +221,6 @@ if __name__ == "__main__":
       time.sleep(0.05)
 
   except Exception:
+    s.stop()
     driver.cleanup()
     raise
@@ -0,0 +1,115 @@
+"""
+A small script for comparing the cost of reducing the samples of a poll to a
+single value (see Sensor.poll and sensor/filters.py) with numpy against the
+original implementation using lists and the statistics module. The samples
+are generated in memory, imitating a noisy HX711 reading with occasional
+spikes, so no sensor is required.
+
+  python3 -m sensor.benchmark -n 100 1000 10000 100000
+"""
+
+import sys
+import time
+import statistics
+
+import numpy as np
+
+from sensor.filters import FilterChain
+
+"""
+Generate n synthetic ADC samples.
+"""
+def generate_samples(n, value = 420000., noise = 200., spike_probability = 0.01):
+  rng = np.random.default_rng(0)
+  samples = value + rng.normal(0, noise, n)
+  spikes = rng.random(n) < spike_probability
+  samples[spikes] += rng.choice([-1, 1], spikes.sum()) * 50000
+  return np.round(samples)
+
+"""
+The original reduction of Sensor.poll: a 3-sample median filter with the
+edges repeated, then the mean and the standard deviation around it. Returns a
+tuple (value, standard deviation).
+"""
+def reduce_statistics(datapoints):
+  datapoints = list(datapoints)
+  datapoints.insert(0, datapoints[0])
+  datapoints.append(datapoints[-1])
+  datapoints = [statistics.median(datapoints[i:i+3]) for i in range(len(datapoints) - 2)]
+
+  raw_value = statistics.mean(datapoints)
+  std = statistics.stdev(datapoints, raw_value)
+  return raw_value, std
+
+"""
+Return the best time of the given number of calls of fun(*args), in seconds,
+and the result of the last call.
+"""
+def best_time(fun, args, repeat):
+  best = float("inf")
+  for _ in range(repeat):
+    t = time.perf_counter()
+    result = fun(*args)
+    best = min(best, time.perf_counter() - t)
+  return best, result
+
+"""
+Reduce n generated samples with each implementation. Returns a list of tuples
+(name, elapsed time in seconds, value, standard deviation).
+"""
+def run_benchmark(n, repeat):
+  samples = generate_samples(n)
+  # the original implementation collects the samples in a list
+  sample_list = samples.tolist()
+
+  chains = [
+      ("numpy", FilterChain()),
+      ("hampel", FilterChain(hampel_width = 7)),
+      ("trimmed", FilterChain(trim = 0.1)),
+      ]
+
+  results = []
+
+  elapsed, (value, std) = best_time(reduce_statistics, [sample_list], repeat)
+  results.append(("statistics", elapsed, value, std))
+
+  for name, chain in chains:
+    elapsed, (_, value, std) = best_time(chain.reduce, [samples], repeat)
+    results.append((name, elapsed, value, std))
+
+  return results
+
+if __name__ == "__main__":
+  import argparse
+
+  ap = argparse.ArgumentParser(description = "Benchmark the reduction of sensor samples.")
+
+  ap.add_argument("-n", "--count",
+      dest = "counts",
+      type = int,
+      nargs = "+",
+      default = [100, 1000, 10000, 100000],
+      help = "Number(s) of samples per poll. Default 100 1000 10000 100000."
+      )
+
+  ap.add_argument("-r", "--repeat",
+      dest = "repeat",
+      type = int,
+      default = 5,
+      help = "Number of repetitions, the best time is shown. Default 5."
+      )
+
+  args = ap.parse_args()
+
+  # 'statistics' is the original implementation, 'numpy' the same filters
+  # with numpy, and the others the optional filters.
+  fmt = "{:>8} {:>11} {:>10.3f} {:>10.1f} {:>14.3f} {:>10.3f}"
+  print("{:>8} {:>11} {:>10} {:>10} {:>14} {:>10}".format(
+      "n", "method", "time (ms)", "speedup", "value", "std"))
+
+  for n in args.counts:
+    results = run_benchmark(n, args.repeat)
+    reference = results[0][1]
+    for name, elapsed, value, std in results:
+      print(fmt.format(n, name, elapsed * 1000, reference / elapsed, value, std))
+    sys.stdout.flush()
@@ -0,0 +1,135 @@
+"""
+Filtering of the raw ADC samples collected by Sensor.poll, vectorized with
+numpy. The samples of a poll are reduced to a single raw value by a chain of
+filters, configured in the [sensor] section of the configuration:
+
+  1. Hampel outlier rejection (hampel_width): samples further than
+     hampel_sigmas standard deviations (estimated from the median absolute
+     deviation) from the median of their neighbourhood are replaced by the
+     median.
+  2. Median filtering (median_width): each sample is replaced by the median
+     of the median_width samples around it.
+  3. Trimmed mean (trim): the mean of the samples after removing this
+     proportion of the smallest and the largest ones.
+
+A width of 0 or 1 disables a filter. The default chain, a 3-sample median
+filter and the mean, is the same as the original implementation of poll.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# scales the median absolute deviation of normally distributed values to
+# their standard deviation
+MAD_SCALE = 1.4826
+
+class FilterChain():
+  def __init__(self, median_width = 3, hampel_width = 0, hampel_sigmas = 3., trim = 0.):
+    assert median_width >= 0 and hampel_width >= 0, "Filter widths must not be negative."
+    assert 0 <= trim < 0.5, "The trimmed proportion must be at least 0 and less than 0.5."
+
+    self.median_width = median_width
+    self.hampel_width = hampel_width
+    self.hampel_sigmas = hampel_sigmas
+    self.trim = trim
+
+  """
+  Create the filter chain configured in the [sensor] section of the
+  configuration dictionary cfg_dict.
+  """
+  @classmethod
+  def from_config(cls, cfg_dict):
+    sensor_config = cfg_dict["sensor"]
+    return cls(
+        median_width = int(sensor_config["median_width"]),
+        hampel_width = int(sensor_config["hampel_width"]),
+        hampel_sigmas = float(sensor_config["hampel_sigmas"]),
+        trim = float(sensor_config["trim"]),
+        )
+
+  """
+  Apply the outlier rejection and median filters to the numpy array samples.
+  Returns a new array of the same length.
+  """
+  def apply(self, samples):
+    filtered = np.asarray(samples, dtype = float)
+
+    if self.hampel_width > 1:
+      filtered = hampel_filter(filtered, self.hampel_width, self.hampel_sigmas)
+
+    if self.median_width > 1:
+      filtered = median_filter(filtered, self.median_width)
+
+    return filtered
+
+  """
+  Filter the samples and reduce them to a single value. Returns a tuple
+  (filtered samples, value, standard deviation of the filtered samples around
+  the value).
+  """
+  def reduce(self, samples):
+    filtered = self.apply(samples)
+    n = len(filtered)
+
+    value = trimmed_mean(filtered, self.trim)
+
+    std = 0.
+    if n > 1:
+      deviations = filtered - value
+      std = float(np.sqrt(np.dot(deviations, deviations) / (n - 1)))
+
+    return filtered, value, std
+
+"""
+Return the sliding windows of the given width around each element of x, with
+the edges padded by repeating the first and last element.
+"""
+def _windows(x, width):
+  before = (width - 1) // 2
+  padded = np.pad(x, (before, width - 1 - before), mode = "edge")
+  return sliding_window_view(padded, width)
+
+"""
+Replace each element of x by the median of the width elements around it.
+"""
+def median_filter(x, width):
+  if len(x) == 0:
+    return np.array(x, dtype = float)
+
+  if width == 3:
+    # the median of three is much faster to compute directly
+    padded = np.pad(x, 1, mode = "edge")
+    a, b, c = padded[:-2], padded[1:-1], padded[2:]
+    return np.maximum(np.minimum(a, b), np.minimum(np.maximum(a, b), c))
+
+  return np.median(_windows(x, width), axis = 1)
+
+"""
+Replace the elements of x that are more than n_sigmas standard deviations
+from the median of the width elements around them by the median. The standard
+deviation is estimated from the median absolute deviation of the window.
+"""
+def hampel_filter(x, width, n_sigmas = 3.):
+  if len(x) == 0:
+    return np.array(x, dtype = float)
+
+  windows = _windows(x, width)
+  medians = np.median(windows, axis = 1)
+  mad = np.median(np.abs(windows - medians[:, None]), axis = 1)
+
+  outliers = np.abs(x - medians) > n_sigmas * MAD_SCALE * mad
+  return np.where(outliers, medians, x)
+
+"""
+Return the mean of x after removing the given proportion of the smallest and
+of the largest elements.
+"""
+def trimmed_mean(x, proportion = 0.):
+  n = len(x)
+  k = int(n * proportion)
+  if k == 0:
+    return float(np.mean(x))
+
+  # only the order of the trimmed elements matters
+  x = np.partition(x, [k, n - k - 1])
+  return float(np.mean(x[k:n - k]))
@@ -0,0 +1,115 @@
+"""
+Continuous sampling of the sensor in a background thread. The samples are
+stored with their timestamps in a fixed-size ring buffer, so that Sensor.poll
+can return the statistics of the last averaging_time seconds immediately
+instead of sampling for that long. The sample rate is set by sample_interval
+in the [sensor] section of the configuration, independently of how often the
+sensor is polled.
+"""
+
+import threading
+import time
+import syslog
+
+import numpy as np
+
+"""
+A fixed-size buffer of (timestamp, value) pairs, overwriting the oldest ones
+when full. The timestamps must be appended in ascending order.
+"""
+class RingBuffer():
+  def __init__(self, capacity):
+    self.capacity = int(capacity)
+    self.times = np.empty(self.capacity)
+    self.values = np.empty(self.capacity)
+
+    # the index of the next sample and the number of samples in the buffer
+    self._next = 0
+    self.count = 0
+    self._lock = threading.Lock()
+
+  def append(self, t, value):
+    with self._lock:
+      self.times[self._next] = t
+      self.values[self._next] = value
+      self._next = (self._next + 1) % self.capacity
+      self.count = min(self.count + 1, self.capacity)
+
+  """
+  Return a tuple of numpy arrays (timestamps, values) of the samples taken at
+  or after time t, in chronological order.
+  """
+  def since(self, t):
+    with self._lock:
+      if self.count < self.capacity:
+        times = self.times[:self.count].copy()
+        values = self.values[:self.count].copy()
+      else:
+        # the oldest sample is the next one to be overwritten
+        times = np.concatenate((self.times[self._next:], self.times[:self._next]))
+        values = np.concatenate((self.values[self._next:], self.values[:self._next]))
+
+    i = np.searchsorted(times, t)
+    return times[i:], values[i:]
+
+"""
+Reads the sensor with the function read every interval seconds in a daemon
+thread, into a ring buffer holding capacity samples.
+"""
+class Sampler():
+  def __init__(self, read, interval, capacity):
+    self._read = read
+    self.interval = interval
+    self.buffer = RingBuffer(capacity)
+
+    self._thread = None
+    self._stopped = threading.Event()
+
+  def start(self):
+    if self._thread is not None:
+      return
+    self._thread = threading.Thread(target = self._run, name = "sensor-sampler", daemon = True)
+    self._thread.start()
+
+  """
+  Stop sampling, e.g. before cleaning up the GPIO pins.
+  """
+  def stop(self):
+    self._stopped.set()
+    if self._thread is not None:
+      self._thread.join()
+
+  def _run(self):
+    next_time = time.time()
+    failing = False
+
+    while not self._stopped.is_set():
+      try:
+        value = self._read()
+        self.buffer.append(time.time(), value)
+        failing = False
+
+      except Exception as e:
+        # log only the first of consecutive errors
+        if not failing:
+          syslog.syslog(syslog.LOG_ERR, "sensor: Reading the sensor failed: {}".format(e))
+        failing = True
+
+      next_time += self.interval
+      delay = next_time - time.time()
+      if delay > 0:
+        self._stopped.wait(delay)
+      else:
+        # reading took longer than the interval, don't try to catch up.
+        next_time = time.time()
+
+  """
+  Return the values of the samples taken during the last duration seconds as
+  a numpy array, waiting for the first sample if there are none yet.
+  """
+  def samples(self, duration):
+    while True:
+      _, values = self.buffer.since(time.time() - duration)
+      if len(values) > 0 or self._stopped.is_set():
+        return values
+      time.sleep(self.interval)
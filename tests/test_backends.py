@@ -0,0 +1,244 @@
+"""
+Tests checking that the MongoDB and SQLite backends return the same results,
+run on an in-memory mongomock database and a temporary SQLite file. The
+expected results are computed from the inserted data points in Python.
+"""
+
+import pytest
+
+import config
+import db
+
+# two days of data points at a five minute poll interval (to keep mongomock
+# fast), starting at midnight
+POLL_INTERVAL = 300.
+START = 1499990400.
+N_POINTS = 2 * 24 * 12
+
+BACKENDS = ["mongomock", "sqlite"]
+
+def generate_datapoints(n = N_POINTS, start = START):
+  return [
+      {
+        "timestamp": start + i * POLL_INTERVAL,
+        "nCups": (i % 37) / 4,
+        "rawValue": 340000. + i,
+        "isCoffee": i % 37 > 2,
+      }
+      for i in range(n)
+      ]
+
+"""
+Return a configuration dictionary for a database of the given backend named
+dbname, with the caches disabled.
+"""
+def make_config(backend, tmp_path, dbname = "kahvidb_test"):
+  cfg = config.get_config_dict()
+  cfg["general"]["poll_interval"] = str(POLL_INTERVAL)
+
+  db_config = cfg["database"]
+  db_config["backend"] = "mongodb" if backend == "mongomock" else backend
+  db_config["dbname"] = dbname
+  db_config["sqlite_path"] = str(tmp_path / (dbname + ".sqlite"))
+  db_config["segment_path"] = ""
+  db_config["range_cache_size"] = "0"
+  db_config["latest_cache_ttl"] = "0"
+  for name in ["raw", "minute", "hour", "day"]:
+    db_config["retain_{}_days".format(name)] = "0"
+  return cfg
+
+@pytest.fixture(params = BACKENDS)
+def backend(request, monkeypatch):
+  if request.param == "mongomock":
+    mongomock = pytest.importorskip("mongomock")
+    import pymongo
+    # a single client, so that all the managers see the same databases
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(pymongo, "MongoClient", lambda *args, **kwargs: client)
+  return request.param
+
+@pytest.fixture
+def cfg(backend, tmp_path):
+  return make_config(backend, tmp_path)
+
+@pytest.fixture
+def datapoints():
+  return generate_datapoints()
+
+@pytest.fixture
+def dbm(cfg, datapoints):
+  dbm = db.get_database_manager(cfg)
+  # insert_data adds the _id of MongoDB to the dictionaries
+  dbm.insert_data([dict(d) for d in datapoints])
+  return dbm
+
+def strip(record, fields):
+  return {k: record[k] for k in fields if k in record}
+
+def test_insert_data(dbm, datapoints):
+  stored = sorted(dbm.iter_collection("data"), key = lambda d: d["timestamp"])
+  fields = ["timestamp", "nCups", "rawValue", "isCoffee"]
+  assert [strip(d, fields) for d in stored] == datapoints
+
+def test_insert_data_retry(dbm, datapoints):
+  # a batch whose insertion failed before storing anything
+  batch = generate_datapoints(10, start = datapoints[-1]["timestamp"] + POLL_INTERVAL)
+  dbm.insert_data([dict(d) for d in batch], retry = True)
+
+  datapoints = datapoints + batch
+  assert sum(1 for _ in dbm.iter_collection("data")) == len(datapoints)
+  assert dbm.query_latest()["timestamp"] == batch[-1]["timestamp"]
+  for name, width in db.ROLLUP_TIERS:
+    expected = db.compute_rollup_buckets(datapoints, width)
+    stored = {b["timestamp"]: b["count"] for b in dbm.iter_collection("data-" + name)}
+    assert stored == {t: b["count"] for t, b in expected.items()}
+
+def test_query_range_raw(dbm, datapoints):
+  r = (START + 3600, START + 2 * 3600)
+  result = list(dbm.query_range(r))
+
+  expected = [d for d in datapoints if r[0] <= d["timestamp"] <= r[1]]
+  assert len(result) == len(expected) <= dbm.range_query_max_items
+  for d, e in zip(result, expected):
+    assert d["timestamp"] == e["timestamp"]
+    assert d["nCups"] == pytest.approx(e["nCups"])
+
+@pytest.mark.parametrize("name, width", db.ROLLUP_TIERS)
+def test_query_range_rollups(dbm, datapoints, name, width):
+  r = (START, START + N_POINTS * POLL_INTERVAL - 1)
+  # the finest tier with at least max_items buckets is chosen
+  max_items = int((r[1] - r[0]) // width)
+  dbm.range_query_max_items = max_items
+  assert dbm.select_tier(r) == width
+
+  result = list(dbm.query_range(r, downsample = "truncate"))
+
+  expected = sorted(db.compute_rollup_buckets(datapoints, width).items())[:max_items]
+  assert len(result) == len(expected)
+  for d, (t, b) in zip(result, expected):
+    assert d["timestamp"] == t
+    assert d["count"] == b["count"]
+    assert d["nCups"] == pytest.approx(b["nCupsSum"] / b["count"])
+    assert d["nCupsMin"] == pytest.approx(b["nCupsMin"])
+    assert d["nCupsMax"] == pytest.approx(b["nCupsMax"])
+
+def test_query_range_downsampled(dbm):
+  r = (START, START + N_POINTS * POLL_INTERVAL - 1)
+  dbm.range_query_max_items = 100
+
+  result = list(dbm.query_range(r, downsample = "minmax"))
+
+  assert 0 < len(result) <= 100
+  timestamps = [d["timestamp"] for d in result]
+  assert timestamps == sorted(timestamps)
+
+@pytest.mark.parametrize("agg", ["mean", "minmax"])
+@pytest.mark.parametrize("width", [300, 1800, 3600, 86400])
+def test_query_buckets(dbm, datapoints, agg, width):
+  # the range is extended to whole buckets like the web server does, as the
+  # buckets computed from the rollups always contain whole rollup buckets.
+  end = START + 10 * 3600 + 1234.5
+  r = (START + 1800, end - end % width + width - 1)
+  result = list(dbm.query_buckets(r, width, agg = agg))
+
+  start = r[0] - r[0] % width
+  within = [d for d in datapoints if start <= d["timestamp"] <= r[1]]
+  expected = sorted(db.compute_rollup_buckets(within, width).items())
+  assert len(result) == len(expected) == db.count_buckets(r, width)
+  for d, (t, b) in zip(result, expected):
+    assert d["timestamp"] == t
+    assert d["count"] == b["count"]
+    assert d["nCups"] == pytest.approx(b["nCupsSum"] / b["count"])
+    if agg == "minmax":
+      assert d["nCupsMin"] == pytest.approx(b["nCupsMin"])
+      assert d["nCupsMax"] == pytest.approx(b["nCupsMax"])
+    else:
+      assert "nCupsMin" not in d
+
+def test_query_buckets_too_many(dbm):
+  width = 300
+  r = (START, START + dbm.range_query_max_items * width)
+  with pytest.raises(db.DBException):
+    dbm.query_buckets(r, width)
+
+def test_query_latest(dbm, datapoints):
+  latest = dbm.query_latest()
+  assert latest["timestamp"] == datapoints[-1]["timestamp"]
+  assert latest["nCups"] == pytest.approx(datapoints[-1]["nCups"])
+
+def test_apply_retention(dbm, datapoints):
+  dbm.retention_days = {"data": 1, "data-minute": 0, "data-hour": 0, "data-day": 0}
+  now = START + 2 * 86400 + 600
+
+  deleted = dbm.apply_retention(now = now)
+
+  # whole days older than the retention time are deleted
+  cutoff = START + 86400
+  assert deleted == {"data": sum(1 for d in datapoints if d["timestamp"] < cutoff)}
+  stored = [d["timestamp"] for d in dbm.iter_collection("data")]
+  assert min(stored) == cutoff
+  assert len(stored) == sum(1 for d in datapoints if d["timestamp"] >= cutoff)
+
+  # the rollups still cover the deleted data
+  r = (START, START + 86400 - 1)
+  hours = list(dbm.query_buckets(r, 3600))
+  assert len(hours) == 24
+  assert sum(b["count"] for b in hours) == 86400 / POLL_INTERVAL
+
+def test_query_range_after_retention(dbm, datapoints):
+  dbm.retention_days = {"data": 1, "data-minute": 0, "data-hour": 0, "data-day": 0}
+  dbm.apply_retention(now = START + 2 * 86400 + 600)
+
+  # a short range whose raw data was deleted (all of the test data is older
+  # than a day) is read from the minute rollup
+  r = (START + 3600, START + 2 * 3600)
+  assert dbm.select_tier(r) == 60
+  result = list(dbm.query_range(r))
+
+  expected = [d for d in datapoints if r[0] <= d["timestamp"] <= r[1]]
+  assert [d["timestamp"] for d in result] == [d["timestamp"] for d in expected]
+  assert all(d["count"] == 1 for d in result)
+
+@pytest.mark.parametrize("rebuild", ["rebuild_rollups", "recompute_nCups"])
+def test_rebuild_after_retention(dbm, datapoints, cfg, rebuild):
+  dbm.retention_days = {"data": 1, "data-minute": 0, "data-hour": 0, "data-day": 0}
+  dbm.apply_retention(now = START + 2 * 86400 + 600)
+
+  if rebuild == "rebuild_rollups":
+    dbm.rebuild_rollups()
+  else:
+    dbm.recompute_nCups(calibration = dict(cfg["calibration"]))
+
+  # the aggregates of the deleted raw data are kept
+  r = (START, START + 86400 - 1)
+  hours = list(dbm.query_buckets(r, 3600))
+  assert len(hours) == 24
+  assert sum(b["count"] for b in hours) == 86400 / POLL_INTERVAL
+
+  # and the ones of the remaining raw data are rebuilt
+  r = (START + 86400, START + 2 * 86400 - 1)
+  assert sum(b["count"] for b in dbm.query_buckets(r, 3600)) == 86400 / POLL_INTERVAL
+
+def test_dump_and_restore(dbm, backend, tmp_path, monkeypatch):
+  # dump_database changes the working directory
+  monkeypatch.chdir(tmp_path)
+  dump_path = str(tmp_path / "dump")
+  db.dump_database(dump_path, make_config(backend, tmp_path), assume_yes = True)
+
+  restored_cfg = make_config(backend, tmp_path, dbname = "kahvidb_restored")
+  # restoring twice doesn't duplicate anything
+  db.restore_database(dump_path, restored_cfg)
+  db.restore_database(dump_path, restored_cfg, assume_yes = True)
+  restored = db.get_database_manager(restored_cfg)
+
+  def contents(manager, name):
+    return sorted(
+        (sorted((k, v) for k, v in d.items() if k != "_id") for d in manager.iter_collection(name)),
+        key = repr
+        )
+
+  for name in ["data", "data-latest"] + ["data-" + tier for tier, _ in db.ROLLUP_TIERS]:
+    assert contents(restored, name) == contents(dbm, name), name
+
+  r = (START, START + N_POINTS * POLL_INTERVAL - 1)
+  assert list(restored.query_buckets(r, 3600)) == list(dbm.query_buckets(r, 3600))
@@ -1,8 +1,159 @@
 $(function () {
 	//Mostly copied from http://www.highcharts.com/stock/demo/lazy-loading
 
-    // convert an object into an array, used for handling data
-    function objToArray(o) { return Object.keys(o).map(function(k) {return [parseInt(k), o[k]];}) }
+    // convert the columns returned by the server into [time in ms, value]
+    // pairs. The times are delta-encoded milliseconds.
+    function toSeries(columns) {
+        var t = 0;
+        return columns.dt.map(function(dt, i) {
+            t += dt;
+            return [t, columns.v[i]];
+        });
+    }
+
+    // The data is loaded in tiles: fixed ranges of TILE_BUCKETS buckets of one
+    // of the bucket widths of the server (see db.BUCKET_WIDTHS, in seconds),
+    // chosen so that a view shows at most about MAX_POINTS points. The tiles
+    // are kept in an LRU cache, so zooming and panning around data that has
+    // been seen before needs no requests, and the tiles next to the view are
+    // fetched in advance.
+    var BUCKET_WIDTHS = [
+        10, 30, 60, 5 * 60, 10 * 60, 30 * 60,
+        3600, 3 * 3600, 6 * 3600, 12 * 3600,
+        86400, 7 * 86400, 30 * 86400
+    ];
+    var MAX_POINTS = Config.maxPoints || 1000;
+    var TILE_BUCKETS = 200;
+    var MAX_TILES = Config.maxTiles || 500;
+    // tiles containing the present are fetched again after this many ms
+    var OPEN_TILE_TTL = 10 * 1000;
+
+    function TileCache(maxTiles) {
+        this.maxTiles = maxTiles;
+        // key: {series, expires}, the least recently used first
+        this.tiles = new Map();
+        // key: promise of the series of a tile being fetched
+        this.pending = {};
+        // increased on every load, so that late responses for a previous
+        // view are not shown
+        this.generation = 0;
+    }
+
+    // the smallest bucket width (in seconds) with which the range min-max (in
+    // ms) has at most MAX_POINTS buckets
+    TileCache.prototype.bucketWidth = function(min, max) {
+        var span = (max - min) / 1000;
+        for (var i = 0; i < BUCKET_WIDTHS.length; i++) {
+            if (span / BUCKET_WIDTHS[i] <= MAX_POINTS) {
+                return BUCKET_WIDTHS[i];
+            }
+        }
+        return BUCKET_WIDTHS[BUCKET_WIDTHS.length - 1];
+    };
+
+    // the tiles of the given bucket width covering the range min-max (in ms)
+    TileCache.prototype.tilesFor = function(min, max, width) {
+        var tileSpan = TILE_BUCKETS * width * 1000;
+        var result = [];
+        for (var i = Math.floor(min / tileSpan); i * tileSpan <= max; i++) {
+            result.push({key: width + ':' + i, width: width, start: i * tileSpan, end: (i + 1) * tileSpan});
+        }
+        return result;
+    };
+
+    TileCache.prototype.get = function(key) {
+        var tile = this.tiles.get(key);
+        if (tile === undefined) {
+            return undefined;
+        }
+        this.tiles.delete(key);
+        if (tile.expires < Date.now()) {
+            return undefined;
+        }
+        // most recently used
+        this.tiles.set(key, tile);
+        return tile.series;
+    };
+
+    TileCache.prototype.put = function(key, series, expires) {
+        this.tiles.delete(key);
+        this.tiles.set(key, {series: series, expires: expires});
+        while (this.tiles.size > this.maxTiles) {
+            this.tiles.delete(this.tiles.keys().next().value);
+        }
+    };
+
+    // return the series of the tile, or a promise of it if it's not cached. A
+    // tile is requested only once at a time.
+    TileCache.prototype.fetch = function(tile) {
+        var series = this.get(tile.key);
+        if (series !== undefined) {
+            return series;
+        }
+
+        var self = this;
+        if (!this.pending[tile.key]) {
+            // the server extends the range to whole buckets, so end the range
+            // within the last bucket of the tile. The server uses seconds.
+            var params = {
+                s: tile.start / 1000, e: tile.end / 1000 - tile.width / 2,
+                bucket: tile.width, agg: 'mean', format: 'columns', delta: 1
+            };
+
+            this.pending[tile.key] = $.getJSON(Config.url, params).then(function(columns) {
+                var series = toSeries(columns);
+                // data is only added to the tile containing the present
+                var expires = tile.end > Date.now() ? Date.now() + OPEN_TILE_TTL : Infinity;
+                self.put(tile.key, series, expires);
+                return series;
+            }).always(function() {
+                delete self.pending[tile.key];
+            });
+        }
+        return this.pending[tile.key];
+    };
+
+    // call callback with the series of the range min-max (in ms) once all of
+    // its tiles are available, fetching only the missing ones. Then fetch the
+    // tiles next to the range in the background.
+    TileCache.prototype.load = function(min, max, callback, fail) {
+        var self = this;
+        var generation = ++this.generation;
+        var width = this.bucketWidth(min, max);
+        var parts = this.tilesFor(min, max, width).map(function(tile) {
+            return self.fetch(tile);
+        });
+
+        $.when.apply($, parts).done(function() {
+            if (generation !== self.generation) {
+                return;
+            }
+            var data = [].concat.apply([], Array.prototype.slice.call(arguments, 0, parts.length));
+            callback(data);
+            self.prefetch(min, max, width);
+        }).fail(function() {
+            if (generation === self.generation && fail) {
+                fail();
+            }
+        });
+    };
+
+    // fetch the tiles of the ranges of the same length before and after the
+    // range min-max (in ms), except for the future.
+    TileCache.prototype.prefetch = function(min, max, width) {
+        var self = this;
+        var span = max - min;
+        var now = Date.now();
+        this.tilesFor(min - span, min, width)
+            .concat(this.tilesFor(max, Math.min(max + span, now), width))
+            .forEach(function(tile) {
+                if (tile.start <= now) {
+                    self.fetch(tile);
+                }
+            });
+    };
+
+    var tiles = new TileCache(MAX_TILES);
 
     function afterSetExtremes(e) {
 
@@ -12,42 +163,22 @@ $(function () {
 
         chart.showLoading('Fetching data...');
 
-        url = Config.url;
-
-        $.getJSON(url, {s: e.min, e: e.max}, function(data) {
-
-          data = objToArray(data);
+        tiles.load(e.min, e.max, function(data) {
 
 		      //TODO: multiple series
           chart.series[0].setData(data);
-        
-        });
 
-        chart.hideLoading();
+          chart.hideLoading();
+        }, function() {
+          chart.hideLoading();
+        });
 
     }
 
 
- 	//TODO: see https://github.com/highcharts/highcharts/blob/master/samples/data/from-sql.php on how to set up the queries for averaged data. most importantly:
+	// the minute, hour and day aggregates are chosen by the server according to
+	// the bucket width, see webserver.get_data.
 	//TODO: also check out how meso does this and consider that as well
-	/*
-		// find the right table
-		// two days range loads minute data
-		if ($range < 2 * 24 * 3600 * 1000) {
-			$table = 'stockquotes';
-			
-		// one month range loads hourly data
-		} elseif ($range < 31 * 24 * 3600 * 1000) {
-			$table = 'stockquotes_hour';
-			
-		// one year range loads daily data
-		} elseif ($range < 15 * 31 * 24 * 3600 * 1000) {
-			$table = 'stockquotes_day';
-		// greater range loads monthly data
-		} else {
-			$table = 'stockquotes_month';
-		} 
-	 */
 
     // url from original example
     // url = "https://www.highcharts.com/samples/data/from-sql.php?callback=?"
@@ -59,11 +190,9 @@ $(function () {
     start = new Date(2016, 1, 1).getTime() // TODO: adjust this via config or query from server or something.
     end = new Date().getTime()
 
-    $.getJSON(url, {s: start, e: end}, function (data) {
+    tiles.load(start, end, function (data) {
 
 
-        data = objToArray(data);
-
         //data = [].concat(data, [[Date.UTC(2014, 9, 14, 19, 59), null]]);
         data = [].concat(data, [[new Date().getTime(), null]]);
 
@@ -143,7 +272,40 @@ $(function () {
                 }
             }]
         });
+
+        listenLatest();
     }); //NOTE
 
+    // append each new measurement pushed by the server to the chart, so that
+    // it stays up to date without re-fetching the data.
+    function listenLatest() {
+        if (!window.EventSource) {
+            return;
+        }
+
+        var streamUrl = Config.streamUrl || Config.url.replace(/data\/?$/, 'stream');
+        var source = new EventSource(streamUrl);
+
+        source.onmessage = function(e) {
+            var latest = JSON.parse(e.data);
+            var chart = Highcharts.charts[0];
+            var series = chart.series[0];
+            var extremes = chart.xAxis[0].getExtremes();
+
+            // only follow the data if the present is in view
+            if (extremes.max < extremes.dataMax) {
+                return;
+            }
+
+            // the chart may already have this point if it was loaded just now
+            var last = series.xData[series.xData.length - 1];
+            if (last !== undefined && latest.timestamp * 1000 <= last) {
+                return;
+            }
+
+            series.addPoint([latest.timestamp * 1000, latest.nCups], true, false);
+        };
+    }
+
 });
 
@@ -2,20 +2,40 @@
 This module is responsible for handling web requests using Flask. 
 
 Requests are of the form (start, end) in unix time and are passed on to the db
-manager, which then returns the appropriate data to be sent back as JSON.
+manager, which then returns the appropriate data to be sent back as JSON. Long
+ranges can be aggregated in time buckets by the database, see get_data. The
+responses carry ETags and Cache-Control headers, so that browsers and proxies
+can cache them, see cache_validators. The whole history can be downloaded from
+/export, see get_export. New measurements are pushed to clients of /stream as
+server-sent events, see get_stream.
 """
 
 #TODO: turn this into a daemon
 
-from flask import Flask, request, current_app, jsonify, make_response
+from flask import Flask, Response, request, current_app, jsonify, make_response, json, stream_with_context
 from functools import update_wrapper
+import numpy as np
+import itertools
+import bisect
+import threading
+import asyncio
+import syslog
+import queue
+import time
+import csv
+import io
+import hashlib
+import gzip
+import zlib
 import db
 import config
+import metrics
+from db.cache import SingleFlight
 
 app = Flask(__name__)
 
 cfg = config.get_config_dict()
-dbm = db.DatabaseManager(cfg)
+dbm = db.get_database_manager(cfg)
 
 # Allow cross domain requests, see http://flask.pocoo.org/snippets/56/
 # Stripped down version, not general at all but gets the job done
@@ -37,23 +57,592 @@ def crossdomain(origin = None):
     return update_wrapper(wrapped_function, f)
   return decorator
 
+"""
+Compute the HTTP cache validators for a /data request with the given range and
+bucket parameter. Returns a tuple (ETag, max-age in seconds).
+The data of a range that ends, including its last (possibly partial) bucket,
+before the latest measurement doesn't change anymore, so its ETag depends only
+on the request parameters and it may be cached for a long time. Otherwise, the
+ETag also depends on the latest measurement. variant distinguishes the
+representations negotiated from the request headers (format and encoding).
+"""
+def cache_validators(data_range, bucket, variant = None):
+  if bucket is None:
+    width = dbm.select_tier(data_range)
+  elif bucket == "auto":
+    width = dbm.select_bucket_width(data_range)
+  else:
+    width = float(bucket)
+
+  end = data_range[1]
+  if width and width > 0:
+    end += width - end % width
+
+  latest = dbm.query_latest()
+  latest_timestamp = 0. if latest is None else latest["timestamp"]
+
+  closed = end < latest_timestamp
+
+  params = sorted(request.args.items(multi = True))
+  etag = hashlib.sha1(
+      repr((params, variant, None if closed else latest_timestamp)).encode()
+      ).hexdigest()
+
+  web_config = cfg["webserver"]
+  max_age = int(web_config["cache_max_age_past" if closed else "cache_max_age_open"])
+
+  return etag, max_age
+
+"""
+Return the data within the range given by the parameters s and e (unix time in
+seconds).
+
+If the parameter bucket is given, the data is aggregated by the database in
+buckets of that many seconds, or of a width chosen so that the number of
+buckets is limited if bucket is 'auto' (see DatabaseManager.query_buckets).
+The range is extended to whole buckets. The parameter agg chooses what is
+returned for each bucket: 'mean' (default) or 'minmax' for the mean, minimum
+and maximum. Without bucket, the data points
+are returned as they are, downsampled if there are too many of them.
+
+The format of the response is chosen with the parameter format or the Accept
+header, see negotiate_format and encode_data, and it's compressed with gzip or
+deflate if the client accepts it. The 'ndjson' and 'csv' formats, and the
+'objects' format if the parameter stream is given, are streamed as the data is
+read from the database instead of encoding all of it first, see stream_data.
+"""
 @app.route("/data", methods=["GET", "OPTIONS"])
 @crossdomain(origin="*")
 def get_data():
   #print("getting data: {}".format(request))
   try:
 
-    data_range = (int(float(request.args["s"])), int(float(request.args.get("e"))))
+    data_range = (float(request.args["s"]), float(request.args["e"]))
 
-    datapoints = dbm.query_range(data_range)
+    bucket = request.args.get("bucket")
 
-    #return jsonify([[i * 100 + data_range[0], x] for i, x in enumerate(datapoints)])
-    return jsonify(datapoints)
+    fmt = negotiate_format()
+    delta = request.args.get("delta", "0") not in ["0", "false"]
+    encoding = request.accept_encodings.best_match(["gzip", "deflate"])
+    stream = request.args.get("stream", "0") not in ["0", "false"]
+    if stream and fmt not in STREAMABLE_FORMATS:
+      raise ValueError("Format {} can't be streamed".format(fmt))
 
+    etag = None
+    if not dbm.dummy:
+      etag, max_age = cache_validators(data_range, bucket, variant = (fmt, encoding))
 
-  #TODO
-  except db.DBException:
-    raise
+      if etag in request.if_none_match:
+        # the client already has this data, don't query the database.
+        return set_cache_headers(make_response("", 304), etag, max_age)
+
+    width = None
+    agg = request.args.get("agg", "mean")
+    if bucket is not None:
+      width, data_range = normalize_bucket_range(data_range, bucket)
+
+    def query():
+      if bucket is None and dbm.dummy:
+        return dbm.query_range(data_range)
+      if bucket is None:
+        # requests of almost the same range share the query of a whole range
+        tier, window = normalize_raw_range(data_range)
+        items = singleflight.do(("range", window), lambda: list(dbm.query_range(window)))
+        return slice_range(items, data_range, tier)
+      return dbm.query_buckets(data_range, width, agg = agg)
+
+    if fmt in STREAM_FORMATS or stream:
+      resp = stream_response(query(), fmt, encoding)
+
+    else:
+      def encode():
+        body, headers = encode_data(query(), fmt, delta)
+
+        if encoding is not None and len(body) >= COMPRESS_MIN_SIZE:
+          body = compress(body, encoding)
+          headers["Content-Encoding"] = encoding
+
+        return body, headers
+
+      # identical concurrent requests share the query and the encoded body.
+      key = (data_range, bucket is not None, width, agg, fmt, delta, encoding)
+      body, headers = singleflight.do(key, encode)
+
+      #return jsonify([[i * 100 + data_range[0], x] for i, x in enumerate(datapoints)])
+      resp = make_response(body)
+      resp.headers.update(headers)
+
+    resp.vary.update(["Accept", "Accept-Encoding"])
+
+    if etag is not None:
+      set_cache_headers(resp, etag, max_age)
+
+    return resp
+
+  except (KeyError, ValueError, db.DBException) as e:
+    return jsonify({"error": str(e)}), 400
+
+singleflight = SingleFlight()
+
+"""
+Resolve the bucket width of a bucketed /data request, and extend the range to
+whole buckets. Requests made at almost the same time, e.g. by many clients
+loading the page at once, then have the same range and can share the query.
+Returns a tuple (width, range), where width is None if it's chosen by the
+(dummy) db manager.
+"""
+def normalize_bucket_range(data_range, bucket):
+  if bucket != "auto":
+    width = float(bucket)
+  elif not dbm.dummy:
+    width = dbm.select_bucket_width(data_range)
+  else:
+    return None, data_range
+
+  if width <= 0:
+    # let query_buckets complain
+    return width, data_range
+
+  (start, end) = data_range
+  # up to the end of the last bucket, excluding the start of the next one
+  end = np.nextafter(end - end % width + width, -np.inf)
+  return width, (start - start % width, float(end))
+
+"""
+Extend the range of a raw /data request to whole minutes, or to whole buckets
+of the rollup that query_range will read, like the range cache does (see
+DatabaseManager._query_range_cached). Requests with a moving end, e.g. the last
+24 hours polled by many clients, then query the same range. Returns a tuple
+(width, range), where width is the rollup width or None for the raw data.
+"""
+def normalize_raw_range(data_range):
+  (start, end) = data_range
+  width = dbm.select_tier(data_range)
+  unit = width if width is not None else db.ROLLUP_TIERS[0][1]
+  return width, (start - start % unit, end - end % unit + unit)
+
+"""
+Return the items of a query of a normalized range (see normalize_raw_range)
+that are within data_range, including the bucket containing its start if
+width is not None.
+"""
+def slice_range(items, data_range, width):
+  (start, end) = data_range
+  if width is not None:
+    start -= start % width
+
+  timestamps = [item["timestamp"] for item in items]
+  i = bisect.bisect_left(timestamps, start)
+  j = bisect.bisect_right(timestamps, end)
+  return items[i:j]
+
+# the response formats of /data and their content types
+FORMATS = {
+    "objects": "application/json",
+    "columns": "application/json",
+    "binary": "application/octet-stream",
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    }
+
+# the formats that are always streamed, and those that can be
+STREAM_FORMATS = ["ndjson", "csv"]
+STREAMABLE_FORMATS = ["objects"] + STREAM_FORMATS
+
+# the number of data points encoded at once when streaming
+STREAM_BATCH_SIZE = 1000
+
+"""
+The columns of the columnar formats and the fields of the data points or
+buckets they contain. The minimum and maximum are included only if they are
+present in the data.
+"""
+COLUMNS = [
+    ("t", "timestamp"),
+    ("v", "nCups"),
+    ("min", "nCupsMin"),
+    ("max", "nCupsMax"),
+    ]
+
+# responses smaller than this are not compressed
+COMPRESS_MIN_SIZE = 1024
+
+"""
+Choose the response format of /data: the format parameter if it's given,
+otherwise 'binary' if the Accept header prefers application/octet-stream over
+JSON, and 'objects' if not.
+"""
+def negotiate_format():
+  fmt = request.args.get("format")
+
+  if fmt is None:
+    best = request.accept_mimetypes.best_match(["application/json", "application/octet-stream"])
+    fmt = "binary" if best == "application/octet-stream" else "objects"
+
+  if fmt not in FORMATS:
+    raise ValueError("Invalid format: {}".format(fmt))
+
+  return fmt
+
+"""
+Encode the data points or buckets in the given format. Returns a tuple (body,
+dictionary of headers).
+  "objects": a JSON array of objects, one per data point.
+  "columns": a JSON object of arrays, {"t": [...], "v": [...]}, see COLUMNS.
+    If delta is True, instead of "t" there is "dt", containing the first
+    timestamp followed by the differences between consecutive timestamps, all
+    in integer milliseconds.
+  "binary": the columns as little-endian float64 timestamps followed by
+    float32 arrays of the other columns, which are named in the X-Columns
+    header. Missing values are NaN.
+"""
+def encode_data(datapoints, fmt, delta = False):
+  headers = {"Content-Type": FORMATS[fmt]}
+
+  if fmt == "objects":
+    return json.dumps(list(datapoints)), headers
+
+  datapoints = list(datapoints)
+  present = datapoints[0] if datapoints else {}
+  columns = [(c, f) for c, f in COLUMNS if c in ["t", "v"] or f in present]
+
+  if fmt == "binary":
+    arrays = []
+    for c, f in columns:
+      values = [d.get(f) for d in datapoints]
+      arrays.append(np.array(values, dtype = "<f8" if c == "t" else "<f4"))
+    headers["X-Columns"] = ",".join(c for c, _ in columns)
+    return b"".join(a.tobytes() for a in arrays), headers
+
+  data = {c: [d.get(f) for d in datapoints] for c, f in columns}
+  if delta:
+    t = np.round(np.array(data.pop("t"), dtype = float) * 1000).astype(np.int64)
+    data["dt"] = np.diff(t, prepend = 0).tolist()
+
+  return json.dumps(data), headers
+
+"""
+Export the raw data within the range given by the parameters s and e (unix
+time in seconds, default: the whole history) as a file, without downsampling.
+The parameter format is 'ndjson' (default), 'csv' or 'objects' (a JSON array).
+The response is streamed straight from the database, so the memory use doesn't
+depend on the length of the range.
+"""
+@app.route("/export", methods=["GET"])
+@crossdomain(origin="*")
+def get_export():
+  try:
+    data_range = (float(request.args.get("s", 0)), float(request.args.get("e", time.time())))
+
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in STREAMABLE_FORMATS:
+      raise ValueError("Invalid export format: {}".format(fmt))
+
+    encoding = request.accept_encodings.best_match(["gzip", "deflate"])
+
+    datapoints = dbm.iter_range(data_range, projection = {"_id": False})
+
+    resp = stream_response(datapoints, fmt, encoding)
+    resp.vary.add("Accept-Encoding")
+    resp.headers["Content-Disposition"] = "attachment; filename=kahvi.{}".format(
+        "json" if fmt == "objects" else fmt
+        )
+    return resp
+
+  except (ValueError, db.DBException) as e:
+    return jsonify({"error": str(e)}), 400
+
+"""
+Return a response streaming the data points in the given format, compressed
+with the given encoding if it's not None.
+"""
+def stream_response(datapoints, fmt, encoding = None):
+  chunks = stream_data(datapoints, fmt)
+
+  headers = {"Content-Type": FORMATS[fmt]}
+  if encoding is not None:
+    chunks = compress_stream(chunks, encoding)
+    headers["Content-Encoding"] = encoding
+
+  return Response(stream_with_context(chunks), headers = headers)
+
+"""
+Encode the data points in the given format a batch at a time, yielding the
+encoded chunks, so that the data points don't have to be in memory all at
+once.
+  "objects": a JSON array of objects, the same as encode_data.
+  "ndjson": one JSON object per line.
+  "csv": comma-separated values with a header line. The columns are the fields
+    of the first data point.
+"""
+def stream_data(datapoints, fmt):
+  datapoints = iter(datapoints)
+  batches = iter(lambda: list(itertools.islice(datapoints, STREAM_BATCH_SIZE)), [])
+
+  if fmt == "objects":
+    sep = "["
+    for batch in batches:
+      yield sep + ",".join(json.dumps(d) for d in batch)
+      sep = ","
+    yield "[]" if sep == "[" else "]"
+
+  elif fmt == "ndjson":
+    for batch in batches:
+      yield "".join(json.dumps(d) + "\n" for d in batch)
+
+  elif fmt == "csv":
+    buf = io.StringIO()
+    writer = None
+    for batch in batches:
+      if writer is None:
+        writer = csv.DictWriter(buf, list(batch[0]), extrasaction = "ignore")
+        writer.writeheader()
+      writer.writerows(batch)
+      yield buf.getvalue()
+      buf.seek(0)
+      buf.truncate()
+
+def compress_stream(chunks, encoding):
+  # gzip uses the same compression with a different header
+  wbits = 16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS
+  compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+  for chunk in chunks:
+    data = compressor.compress(chunk.encode("utf-8"))
+    if data:
+      yield data
+  yield compressor.flush()
+
+"""
+Return the latest measurement as JSON, or null if it's not available.
+"""
+@app.route("/latest", methods=["GET"])
+@crossdomain(origin="*")
+def get_latest():
+  latest = dbm.query_latest()
+  if latest is not None:
+    latest.pop("_id", None)
+
+  resp = jsonify(latest)
+  resp.cache_control.no_cache = True
+  return resp
+
+"""
+A stream of server-sent events, one for each new measurement, with the
+measurement as JSON in the data field. The latest measurement is sent right
+after connecting. All clients are served by a single watcher, see
+LatestBroadcaster.
+"""
+@app.route("/stream", methods=["GET"])
+@crossdomain(origin="*")
+def get_stream():
+  q = broadcaster.subscribe()
+
+  def events():
+    try:
+      sent = None
+      latest = dbm.query_latest()
+      if latest is not None:
+        yield sse_event(latest)
+        sent = latest["timestamp"]
+
+      while True:
+        try:
+          latest = q.get(timeout = SSE_KEEPALIVE_INTERVAL)
+        except queue.Empty:
+          # a comment line, so that proxies don't close idle connections
+          yield ": keepalive\n\n"
+          continue
+
+        if latest["timestamp"] != sent:
+          yield sse_event(latest)
+          sent = latest["timestamp"]
+
+    finally:
+      # the client disconnected
+      broadcaster.unsubscribe(q)
+
+  resp = Response(events(), mimetype = "text/event-stream")
+  resp.cache_control.no_cache = True
+  # don't let e.g. nginx buffer the events
+  resp.headers["X-Accel-Buffering"] = "no"
+  return resp
+
+# seconds between keepalive comments in idle event streams
+SSE_KEEPALIVE_INTERVAL = 15
+
+def sse_event(latest):
+  latest = {k: v for k, v in latest.items() if k != "_id"}
+  return "id: {}\ndata: {}\n\n".format(latest["timestamp"], json.dumps(latest))
+
+"""
+Fans the latest measurement out to all connected event stream clients, so that
+the database load doesn't depend on the number of clients. New measurements
+come from the latest measurement cache of the db manager, which is updated by a
+change stream if possible (see db.cache.LatestCache). In addition, a single
+thread polls query_latest every interval seconds, which is a memory read if the
+cache is enabled.
+"""
+class LatestBroadcaster():
+  # the number of events buffered for a slow client before dropping old ones
+  QUEUE_SIZE = 16
+
+  def __init__(self, dbm, interval):
+    self.dbm = dbm
+    self.interval = interval
+
+    self._subscribers = set()
+    self._lock = threading.Lock()
+    self._last_timestamp = None
+    self._thread = None
+
+  """
+  Return a queue that receives the new measurements until unsubscribe is
+  called with it.
+  """
+  def subscribe(self):
+    q = queue.Queue(maxsize = self.QUEUE_SIZE)
+    self.add_listener(q)
+    return q
+
+  def unsubscribe(self, q):
+    self.remove_listener(q)
+
+  """
+  Add a subscriber, which is either a queue.Queue or a function that is called
+  with each new measurement from the broadcasting thread, and must not block.
+  """
+  def add_listener(self, listener):
+    with self._lock:
+      self._subscribers.add(listener)
+      if self._thread is None:
+        self._start()
+
+  def remove_listener(self, listener):
+    with self._lock:
+      self._subscribers.discard(listener)
+
+  def _start(self):
+    if getattr(self.dbm, "latest_cache", None) is not None:
+      self.dbm.latest_cache.add_listener(self.publish)
+
+    self._thread = threading.Thread(target = self._poll, name = "latest-broadcaster", daemon = True)
+    self._thread.start()
+
+  def _poll(self):
+    while True:
+      try:
+        latest = self.dbm.query_latest()
+        if latest is not None:
+          self.publish(latest)
+      except Exception as e:
+        syslog.syslog(syslog.LOG_WARNING, "webserver: Polling the latest measurement failed: {}".format(e))
+      time.sleep(self.interval)
+
+  """
+  Send the measurement to all subscribers, unless it was already sent.
+  """
+  def publish(self, latest):
+    with self._lock:
+      if latest["timestamp"] == self._last_timestamp:
+        return
+      self._last_timestamp = latest["timestamp"]
+
+      for listener in self._subscribers:
+        if isinstance(listener, queue.Queue):
+          offer(listener, latest)
+        else:
+          listener(latest)
+
+"""
+Put the item in a queue.Queue or an asyncio.Queue without blocking, dropping
+the oldest item if the queue is full, so that a slow client can't block others.
+"""
+def offer(q, item):
+  while True:
+    try:
+      q.put_nowait(item)
+      return
+    except (queue.Full, asyncio.QueueFull):
+      try:
+        q.get_nowait()
+      except (queue.Empty, asyncio.QueueEmpty):
+        pass
+
+broadcaster = LatestBroadcaster(dbm, float(cfg["general"]["poll_interval"]) / 2)
+
+def compress(body, encoding):
+  if isinstance(body, str):
+    body = body.encode("utf-8")
+  if encoding == "gzip":
+    return gzip.compress(body, compresslevel = 6)
+  return zlib.compress(body, 6)
+
+def set_cache_headers(resp, etag, max_age):
+  resp.set_etag(etag)
+  resp.cache_control.public = True
+  resp.cache_control.max_age = max_age
+  return resp
+
+"""
+Measure the request latencies, the time spent in the database and in the
+phases of /data requests, the response sizes and the cache hit rates, and
+serve them at /metrics in the Prometheus text format. This is done only if
+metrics is enabled in the [webserver] section of the configuration, otherwise
+nothing is measured. See metrics.py.
+"""
+def enable_metrics():
+  global registry, encode_data, compress
+
+  registry = metrics.Registry()
+  metrics.instrument_app(registry, app)
+  metrics.instrument_db(registry, dbm)
+
+  phases = registry.histogram("kahvi_data_phase_duration_seconds",
+      "Time spent in each phase of a non-streamed /data request: querying the data"
+      " (including downsampling), encoding and compressing it.",
+      ["phase"])
+  returned = registry.histogram("kahvi_data_items_returned",
+      "Number of data points or buckets returned by a non-streamed /data request.",
+      buckets = metrics.COUNT_BUCKETS)
+
+  encode = encode_data
+  def measured_encode_data(datapoints, fmt, delta = False):
+    with phases.time("query"):
+      datapoints = list(datapoints)
+    returned.observe(len(datapoints))
+    with phases.time("encode"):
+      return encode(datapoints, fmt, delta)
+  encode_data = measured_encode_data
+
+  compress_body = compress
+  def measured_compress(body, encoding):
+    with phases.time("compress"):
+      return compress_body(body, encoding)
+  compress = measured_compress
+
+  # the database manager is looked up when rendering, as it's replaced by the
+  # dummy one when testing.
+  registry.add_stats("kahvi_range_cache", "Range query cache",
+      lambda: dbm.range_cache.stats() if getattr(dbm, "range_cache", None) else None,
+      counters = ["hits", "misses", "evictions"])
+  registry.add_stats("kahvi_latest_cache", "Latest measurement cache",
+      lambda: dbm.latest_cache.stats() if dbm.latest_cache is not None else None,
+      counters = ["gets", "fetches"])
+  registry.add_stats("kahvi_singleflight", "Coalescing of identical /data requests",
+      singleflight.stats,
+      counters = ["calls", "shared"])
+
+  app.add_url_rule("/metrics", "metrics", get_metrics)
+
+"""
+Return the metrics in the Prometheus text format.
+"""
+def get_metrics():
+  return Response(registry.render(), mimetype = "text/plain; version=0.0.4")
+
+registry = None
+if cfg["webserver"].getboolean("metrics"):
+  enable_metrics()
 
 def main():
   pass
@@ -77,7 +666,8 @@ if __name__ == "__main__":
 
   # initialize a dummy database, which returns random values.
   #TODO
-  dbm = db.DatabaseManager("dummy")
+  dbm = db.get_database_manager(cfg, dummy = True)
+  broadcaster = LatestBroadcaster(dbm, broadcaster.interval)
   
   app.debug = args.debug
 
@@ -0,0 +1,283 @@
+"""
+An ASGI front end for the web server, for running it in production with e.g.
+uvicorn instead of the single-process Flask development server:
+
+  python3 webserver_asgi.py --port 5000
+  (or: uvicorn webserver_asgi:app --port 5000)
+
+The requests are handled by the Flask app in webserver.py, which runs in a pool
+of threads next to the event loop. At most max_concurrency requests (see the
+[webserver] section of the configuration) are processed at a time, the others
+wait in the event loop without holding a thread or a database connection, so
+a few slow queries of wide ranges don't stall everything else and the database
+is not flooded when there are many clients.
+
+The event stream /stream is served directly by the event loop, so that the
+clients waiting for new measurements don't occupy threads at all.
+"""
+
+import asyncio
+import concurrent.futures
+import threading
+import sys
+import io
+
+import webserver
+
+max_concurrency = int(webserver.cfg["webserver"]["max_concurrency"])
+
+# the threads running the flask app, one per concurrently processed request.
+executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers = max_concurrency, thread_name_prefix = "webserver"
+    )
+
+# created in the event loop on the first request
+_semaphore = None
+
+"""
+The ASGI application.
+"""
+async def app(scope, receive, send):
+  if scope["type"] == "lifespan":
+    await lifespan(receive, send)
+    return
+
+  if scope["type"] != "http":
+    return
+
+  if scope["path"] == "/stream":
+    await stream_events(scope, receive, send)
+  else:
+    await call_flask(scope, receive, send)
+
+async def lifespan(receive, send):
+  while True:
+    message = await receive()
+    if message["type"] == "lifespan.startup":
+      await send({"type": "lifespan.startup.complete"})
+    elif message["type"] == "lifespan.shutdown":
+      executor.shutdown(wait = False)
+      await send({"type": "lifespan.shutdown.complete"})
+      return
+
+"""
+Handle a request with the flask app in the thread pool, waiting for a free slot
+first. The response body is passed from the thread to the event loop one chunk
+at a time, so streamed responses (e.g. /export) are streamed here as well.
+"""
+async def call_flask(scope, receive, send):
+  global _semaphore
+  if _semaphore is None:
+    _semaphore = asyncio.Semaphore(max_concurrency)
+
+  body = b""
+  more_body = True
+  while more_body:
+    message = await receive()
+    body += message.get("body", b"")
+    more_body = message.get("more_body", False)
+
+  environ = wsgi_environ(scope, body)
+
+  loop = asyncio.get_running_loop()
+  # the response start and the body chunks, None marks the end. The queue is
+  # small, so that a slow client slows down the thread instead of the chunks
+  # piling up in memory.
+  chunks = asyncio.Queue(maxsize = 4)
+  disconnected = threading.Event()
+
+  async with _semaphore:
+    worker = loop.run_in_executor(executor, run_wsgi, environ, chunks, loop, disconnected)
+
+    try:
+      while True:
+        item = await chunks.get()
+        if item is None:
+          break
+        await send(item)
+      await send({"type": "http.response.body", "body": b""})
+
+    except OSError:
+      # the client went away, stop the flask app.
+      disconnected.set()
+      # let the worker finish putting its pending chunk
+      while not worker.done():
+        try:
+          chunks.get_nowait()
+        except asyncio.QueueEmpty:
+          await asyncio.sleep(0.01)
+
+    await worker
+
+"""
+Run the flask app for one request in a worker thread and pass the response to
+the event loop through the asyncio queue chunks. The whole response is iterated
+in the same thread, as flask keeps the request context in thread-local
+variables while streaming.
+"""
+def run_wsgi(environ, chunks, loop, disconnected):
+  def put(item):
+    asyncio.run_coroutine_threadsafe(chunks.put(item), loop).result()
+
+  started = []
+
+  def start_response(status, headers, exc_info = None):
+    started.append({
+      "type": "http.response.start",
+      "status": int(status.split(" ", 1)[0]),
+      "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+      })
+
+  result = webserver.app(environ, start_response)
+  try:
+    for data in result:
+      if disconnected.is_set():
+        break
+      if started:
+        put(started.pop())
+      if data:
+        put({"type": "http.response.body", "body": data, "more_body": True})
+
+    if started:
+      # the body was empty
+      put(started.pop())
+
+  finally:
+    if hasattr(result, "close"):
+      result.close()
+    put(None)
+
+"""
+Build a WSGI environ dictionary from an ASGI HTTP connection scope and the
+request body.
+"""
+def wsgi_environ(scope, body):
+  server = scope.get("server") or ("localhost", 80)
+  client = scope.get("client") or ("", 0)
+
+  environ = {
+      "REQUEST_METHOD": scope["method"],
+      "SCRIPT_NAME": scope.get("root_path", ""),
+      "PATH_INFO": scope["path"],
+      "QUERY_STRING": scope["query_string"].decode("latin-1"),
+      "SERVER_NAME": server[0],
+      "SERVER_PORT": str(server[1]),
+      "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+      "REMOTE_ADDR": client[0],
+      "wsgi.version": (1, 0),
+      "wsgi.url_scheme": scope.get("scheme", "http"),
+      "wsgi.input": io.BytesIO(body),
+      "wsgi.errors": sys.stderr,
+      "wsgi.multithread": True,
+      "wsgi.multiprocess": False,
+      "wsgi.run_once": False,
+      "CONTENT_LENGTH": str(len(body)),
+      }
+
+  for name, value in scope["headers"]:
+    name = name.decode("latin-1").upper().replace("-", "_")
+    value = value.decode("latin-1")
+    if name == "CONTENT_TYPE":
+      environ["CONTENT_TYPE"] = value
+    elif name != "CONTENT_LENGTH":
+      key = "HTTP_" + name
+      environ[key] = environ[key] + "," + value if key in environ else value
+
+  return environ
+
+"""
+Serve the server-sent events of new measurements (see webserver.get_stream)
+from the event loop. The measurements are passed from the broadcaster thread to
+the event loop with call_soon_threadsafe.
+"""
+async def stream_events(scope, receive, send):
+  loop = asyncio.get_running_loop()
+  q = asyncio.Queue(maxsize = webserver.LatestBroadcaster.QUEUE_SIZE)
+
+  def listener(latest):
+    loop.call_soon_threadsafe(webserver.offer, q, latest)
+
+  webserver.broadcaster.add_listener(listener)
+
+  # set when the client disconnects
+  disconnected = asyncio.ensure_future(wait_disconnect(receive))
+
+  try:
+    await send({
+      "type": "http.response.start",
+      "status": 200,
+      "headers": [
+        (b"content-type", b"text/event-stream"),
+        (b"cache-control", b"no-cache"),
+        (b"x-accel-buffering", b"no"),
+        (b"access-control-allow-origin", b"*"),
+        ],
+      })
+
+    sent = None
+    latest = await loop.run_in_executor(executor, webserver.dbm.query_latest)
+
+    while not disconnected.done():
+      if latest is not None and latest["timestamp"] != sent:
+        event = webserver.sse_event(latest)
+        await send({"type": "http.response.body", "body": event.encode(), "more_body": True})
+        sent = latest["timestamp"]
+
+      getter = asyncio.ensure_future(q.get())
+      done, _ = await asyncio.wait(
+          [getter, disconnected],
+          timeout = webserver.SSE_KEEPALIVE_INTERVAL,
+          return_when = asyncio.FIRST_COMPLETED
+          )
+
+      if getter in done:
+        latest = getter.result()
+      else:
+        getter.cancel()
+        latest = None
+        if not done:
+          # a comment line, so that proxies don't close idle connections
+          await send({"type": "http.response.body", "body": b": keepalive\n\n", "more_body": True})
+
+  except OSError:
+    # the client went away
+    pass
+
+  finally:
+    webserver.broadcaster.remove_listener(listener)
+    disconnected.cancel()
+
+async def wait_disconnect(receive):
+  while True:
+    message = await receive()
+    if message["type"] == "http.disconnect":
+      return
+
+
+if __name__ == "__main__":
+  import argparse
+
+  ap = argparse.ArgumentParser(description = "Run the web server with uvicorn.")
+
+  ap.add_argument("--host",
+      dest = "host",
+      default = "127.0.0.1",
+      help = "the address to listen on, default 127.0.0.1. Use 0.0.0.0 to make the server publicly visible."
+      )
+
+  ap.add_argument("--port",
+      dest = "port",
+      type = int,
+      default = 5000,
+      help = "the port to listen on, default 5000."
+      )
+
+  args = ap.parse_args()
+
+  try:
+    import uvicorn
+  except ImportError:
+    print("uvicorn is required for running the ASGI web server (pip3 install uvicorn).")
+    sys.exit(1)
+
+  uvicorn.run(app, host = args.host, port = args.port)
@@ -0,0 +1,340 @@
+"""
+A load-testing benchmark for the /data endpoint of the web server.
+
+A separate database is seeded with synthetic measurements at the poll interval
+of the configuration, and the Flask app in webserver.py is driven by concurrent
+clients requesting ranges of different widths at random positions within the
+data. With the SQLite backend, the database is a temporary file, or the file
+given with --sqlite-path, whose data is replaced. With MongoDB, it's the
+database given with --dbname (kahvidb_benchmark by default). The configured
+database is never used.
+
+The throughput and the latency percentiles of each range class are printed as
+a table, and written as JSON with --output for comparing the results between
+commits:
+
+  python3 webserver_benchmark.py --days 1 30 365 --output before.json
+
+With several volumes (--days), the database is grown from the smallest to the
+largest one and the requests are repeated for each. --mongomock uses an
+in-memory mongomock database instead of the local mongod, which needs no
+server but is much slower and is only practical for up to a few months of data.
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import platform
+import subprocess
+import threading
+
+import numpy as np
+
+# the width of each range class in seconds
+RANGE_CLASSES = [
+    ("hour", 60 * 60),
+    ("day", 24 * 60 * 60),
+    ("week", 7 * 24 * 60 * 60),
+    ("month", 30 * 24 * 60 * 60),
+    ("year", 365 * 24 * 60 * 60),
+    ("5years", 5 * 365 * 24 * 60 * 60),
+    ]
+
+# the extra parameters of each request mode
+MODES = {
+    "raw": {},
+    "auto": {"bucket": "auto"},
+    "minmax": {"bucket": "auto", "agg": "minmax"},
+    }
+
+# the number of data points inserted at a time when seeding
+SEED_BATCH_SIZE = 10000
+
+# the timestamp of the last synthetic data point, so that the data and the
+# requests are the same on every run.
+SEED_END = 1500000000.
+
+"""
+Generate the synthetic data points within the range (start, end) at the given
+poll interval, as inserted by kahvid: the coffee maker is filled and then
+emptied every few hours.
+"""
+def generate_datapoints(start, end, poll_interval):
+  rng = random.Random(int(start))
+  brew_interval = 3 * 60 * 60
+  t = start - start % poll_interval
+  if t < start:
+    t += poll_interval
+
+  while t < end:
+    phase = (t % brew_interval) / brew_interval
+    nCups = max(10. * (1 - 4 * phase), 0.) + rng.gauss(0, 0.1)
+    yield {
+        "timestamp": t,
+        "rawValue": 340000 + 16300 * nCups,
+        "nCups": nCups,
+        "isCoffee": nCups > 0.5,
+        }
+    t += poll_interval
+
+"""
+Insert the synthetic data points within the range (start, end) into the
+database in batches. Returns the number of inserted data points.
+"""
+def seed(dbm, start, end, poll_interval):
+  count = 0
+  batch = []
+  for datapoint in generate_datapoints(start, end, poll_interval):
+    batch.append(datapoint)
+    if len(batch) >= SEED_BATCH_SIZE:
+      dbm.insert_data(batch)
+      count += len(batch)
+      batch = []
+
+  dbm.insert_data(batch)
+  return count + len(batch)
+
+"""
+Make n requests for ranges of the given width within the range data_range
+from the given number of concurrent clients, with the extra request
+parameters params. Returns a dictionary of the results.
+"""
+def run_requests(app, data_range, width, params, n, clients):
+  rng = random.Random(int(width))
+  latencies = []
+  errors = [0]
+  sizes = [0]
+  lock = threading.Lock()
+  pending = iter(range(n))
+
+  def client():
+    test_client = app.test_client()
+    while True:
+      with lock:
+        if next(pending, None) is None:
+          return
+        end = rng.uniform(data_range[0] + width, data_range[1])
+
+      query = dict(params, s = end - width, e = end)
+
+      t = time.perf_counter()
+      resp = test_client.get("/data", query_string = query)
+      data = resp.get_data()
+      elapsed = time.perf_counter() - t
+
+      with lock:
+        latencies.append(elapsed)
+        sizes[0] += len(data)
+        if resp.status_code != 200:
+          errors[0] += 1
+
+  threads = [threading.Thread(target = client) for _ in range(clients)]
+  t = time.perf_counter()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.perf_counter() - t
+
+  p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+  return {
+      "requests": n,
+      "errors": errors[0],
+      "elapsed": elapsed,
+      "throughput": n / elapsed,
+      "latency_mean": float(np.mean(latencies)),
+      "latency_p50": float(p50),
+      "latency_p95": float(p95),
+      "latency_p99": float(p99),
+      "bytes_mean": sizes[0] / n,
+      }
+
+"""
+Return the current git commit of the repository, or None if it's not known.
+"""
+def git_commit():
+  try:
+    return subprocess.check_output(
+        ["git", "rev-parse", "HEAD"], stderr = subprocess.DEVNULL,
+        cwd = sys.path[0] or "."
+        ).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def run_benchmark(args):
+  import config
+  import db
+
+  cfg = config.get_config_dict()
+  db_config = cfg["database"]
+  configured_dbname = db_config["dbname"]
+
+  if args.mongomock:
+    import mongomock
+    import pymongo
+    # a single client, so that all the connections see the same data
+    client = mongomock.MongoClient()
+    pymongo.MongoClient = lambda *a, **kw: client
+    db_config["backend"] = "mongodb"
+
+  elif db_config["backend"].lower() == "sqlite":
+    from db.sqlite import database_path
+    configured_path = os.path.abspath(database_path(cfg))
+
+    if args.sqlite_path is None:
+      if args.keep:
+        print("Error: --keep requires --sqlite-path with the SQLite backend. Aborting.", file = sys.stderr)
+        sys.exit(1)
+
+      import tempfile
+      import shutil
+      import atexit
+      path = tempfile.mkdtemp()
+      atexit.register(shutil.rmtree, path, True)
+      args.sqlite_path = os.path.join(path, "benchmark.sqlite")
+
+    if os.path.abspath(args.sqlite_path) == configured_path:
+      print("Error: {} is the configured database. Aborting.".format(configured_path), file = sys.stderr)
+      sys.exit(1)
+    db_config["sqlite_path"] = args.sqlite_path
+
+  elif args.dbname == configured_dbname:
+    print("Error: {} is the configured database. Aborting.".format(configured_dbname), file = sys.stderr)
+    sys.exit(1)
+
+  db_config["dbname"] = args.dbname
+  dbm = db.get_database_manager(cfg)
+
+  if not args.keep:
+    for name in dbm.collection_names():
+      dbm.drop_collection(name)
+  dbm.ensure_indexes()
+
+  # the web server creates its own database manager for the configured
+  # database when imported, use the seeded one instead.
+  from db.benchmark import import_webserver
+  webserver = import_webserver(dbm)
+
+  poll_interval = float(cfg["general"]["poll_interval"])
+  modes = args.modes or list(MODES)
+
+  result = {
+      "commit": git_commit(),
+      "python": platform.python_version(),
+      "backend": "mongomock" if args.mongomock else cfg["database"]["backend"],
+      "poll_interval": poll_interval,
+      "clients": args.clients,
+      "requests": args.requests,
+      "range_cache_size": float(cfg["database"]["range_cache_size"]),
+      "volumes": [],
+      }
+
+  row = "{:>6} {:>8} {:>7} {:>6} {:>9} {:>9} {:>9} {:>9} {:>10}"
+  print(row.format("days", "range", "mode", "errors", "req/s", "p50 (ms)", "p95 (ms)", "p99 (ms)", "kB"),
+      file = sys.stderr)
+
+  seeded_start = SEED_END
+  for days in sorted(args.days):
+    start = SEED_END - days * 24 * 60 * 60
+
+    if start < seeded_start and not args.keep:
+      t = time.perf_counter()
+      seed(dbm, start, seeded_start, poll_interval)
+      print("seeded {:g} days in {:.1f} s".format(days, time.perf_counter() - t), file = sys.stderr)
+      seeded_start = start
+
+    volume = {"days": days, "samples": int(days * 24 * 60 * 60 / poll_interval), "results": []}
+
+    for name, width in RANGE_CLASSES:
+      if width > days * 24 * 60 * 60:
+        continue
+
+      for mode in modes:
+        stats = run_requests(webserver.app, (start, SEED_END), width, MODES[mode],
+            args.requests, args.clients)
+        volume["results"].append(dict(stats, range = name, width = width, mode = mode))
+
+        print(row.format("{:g}".format(days), name, mode, stats["errors"], "{:.1f}".format(stats["throughput"]),
+            *["{:.1f}".format(stats[key] * 1000) for key in ["latency_p50", "latency_p95", "latency_p99"]],
+            "{:.1f}".format(stats["bytes_mean"] / 1024)),
+            file = sys.stderr)
+        sys.stderr.flush()
+
+    result["volumes"].append(volume)
+
+  return result
+
+if __name__ == "__main__":
+  import argparse
+
+  ap = argparse.ArgumentParser(description = "Benchmark the /data endpoint of the web server.")
+
+  ap.add_argument("-d", "--days",
+      dest = "days",
+      type = float,
+      nargs = "+",
+      default = [1, 30],
+      help = "The amount(s) of data in days, from the smallest to the largest. Default 1 30."
+      )
+
+  ap.add_argument("-c", "--clients",
+      dest = "clients",
+      type = int,
+      default = 8,
+      help = "The number of concurrent clients. Default 8."
+      )
+
+  ap.add_argument("-n", "--requests",
+      dest = "requests",
+      type = int,
+      default = 100,
+      help = "The number of requests per range class and mode. Default 100."
+      )
+
+  ap.add_argument("-m", "--modes",
+      dest = "modes",
+      nargs = "+",
+      choices = list(MODES),
+      help = "The kinds of requests to make: 'raw' (data points), 'auto' (buckets) and 'minmax' (buckets with minimum and maximum). Default all."
+      )
+
+  ap.add_argument("--dbname",
+      dest = "dbname",
+      default = "kahvidb_benchmark",
+      help = "The MongoDB database to use, its contents are replaced. Must not be the configured one. Default kahvidb_benchmark."
+      )
+
+  ap.add_argument("--sqlite-path",
+      dest = "sqlite_path",
+      help = "The SQLite database file to use with the SQLite backend, its contents are replaced. Must not be the configured one. Default a temporary file."
+      )
+
+  ap.add_argument("--keep",
+      dest = "keep",
+      action = "store_true",
+      help = "Use the existing data in the database instead of seeding it again. Requires --sqlite-path with the SQLite backend."
+      )
+
+  ap.add_argument("--mongomock",
+      dest = "mongomock",
+      action = "store_true",
+      help = "Use an in-memory mongomock database instead of the local mongod."
+      )
+
+  ap.add_argument("-o", "--output",
+      dest = "output",
+      help = "Write the results as JSON into this file ('-' for standard output)."
+      )
+
+  args = ap.parse_args()
+
+  result = run_benchmark(args)
+
+  if args.output == "-":
+    json.dump(result, sys.stdout, indent = 2)
+    print()
+  elif args.output:
+    with open(args.output, "w") as f:
+      json.dump(result, f, indent = 2)